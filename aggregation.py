@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, delete, func, insert, or_, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.schema import CreateTable
+from config import AGGREGATION_ROLLUPS
+from metrics import timed
+from models import Activity, ActivityRollup, GameSession, GameSessionRollup, RollupDefinition
+from persistence import batches, dialect_insert
+from sql_functions import interval_seconds
+
+logger = logging.getLogger(__name__)
+
+class Aggregate:
+    # GROUP BY keys over a raw interaction table, optionally restricted to the
+    # rows matching `where`. Measures are SQL aggregate expressions; the max of
+    # each timestamp column is kept so that results can be refreshed
+    # incrementally: select(since) re-aggregates only the groups with rows
+    # stamped at or after `since`, in full.
+
+    def __init__(self, model, keys, measures, timestamps, rollup=None, where=None):
+        self.model = model
+        self.keys = keys
+        self.measures = measures
+        self.timestamps = timestamps
+        self.rollup = rollup
+        self.where = where
+
+    def filtered(self, query):
+        return query if self.where is None else query.where(self.where)
+
+    @property
+    def columns(self):
+        return self.keys + list(self.measures) + self.timestamps
+
+    def touched(self, since):
+        keys = [getattr(self.model, key) for key in self.keys]
+        return self.filtered(select(*keys).where(or_(*[getattr(self.model, column) >= since for column in self.timestamps]))).distinct().subquery()
+
+    def select(self, since=None):
+        keys = [getattr(self.model, key) for key in self.keys]
+        query = select(
+            *keys,
+            *[measure.label(name) for name, measure in self.measures.items()],
+            *[func.max(getattr(self.model, column)).label(column) for column in self.timestamps],
+        ).where(and_(*[key.isnot(None) for key in keys]))
+        query = self.filtered(query)
+        if since is not None:
+            touched = self.touched(since)
+            query = query.join(touched, and_(*[getattr(self.model, key) == touched.c[key] for key in self.keys]))
+        return query.group_by(*keys)
+
+    def select_rollup(self, since=None):
+        query = select(*[getattr(self.rollup, column) for column in self.columns])
+        if since is not None:
+            query = query.where(or_(*[getattr(self.rollup, column) >= since for column in self.timestamps]))
+        return query
+
+    def frame(self, rows):
+        columns = list(zip(*rows)) if rows else [() for _ in self.columns]
+        frame = {}
+        for name, values in zip(self.columns, columns):
+            if name in self.keys:
+                frame[name] = np.asarray(values, dtype=np.int64)
+            elif name in self.timestamps:
+                frame[name] = pd.to_datetime(pd.Series(values, dtype=object))
+            else:
+                frame[name] = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+        return pd.DataFrame(frame).reset_index(drop=True)
+
+# One row per (user, item) in place of every raw row
+AGGREGATES = {
+    "game_session_totals": Aggregate(
+        GameSession, ['user_id', 'game_id'],
+        {
+            'play_seconds': func.coalesce(func.sum(interval_seconds(GameSession.session_total_time)), 0),
+            'sessions': func.count(),
+            'score_sum': func.coalesce(func.sum(GameSession.session_total_score), 0),
+        },
+        ['created_at', 'updated_at'], rollup=GameSessionRollup,
+    ),
+    # Game targets only: target_id is a game id for these rows alone, and the
+    # counts are keyed into the shared "game" id map
+    "activity_counts": Aggregate(
+        Activity, ['user_id', 'target_id'],
+        {'engagement': func.count(Activity.timestamp)},
+        ['timestamp'], rollup=ActivityRollup, where=Activity.target_type == 'game',
+    ),
+}
+
+def rollup_fingerprint(aggregate, dialect):
+    # Changes whenever what the rollup holds does: its query (e.g. a new
+    # `where`) or its table
+    query = aggregate.select().compile(dialect=dialect)
+    table = CreateTable(aggregate.rollup.__table__).compile(dialect=dialect)
+    definition = f"{query}\n{sorted((name, repr(value)) for name, value in query.params.items())}\n{table}"
+    return hashlib.sha256(definition.encode()).hexdigest()
+
+async def sync_rollup_tables(connection):
+    # Startup step (see migrations.migrate) when AGGREGATION_ROLLUPS is on, so
+    # the read path never runs DDL. A rollup built by another definition, or
+    # before definitions were recorded, is dropped and recreated empty; the
+    # next refresh_rollup fills it from the raw table.
+    if connection.dialect.name == "postgresql":
+        await connection.run_sync(lambda sync: RollupDefinition.__table__.create(sync, checkfirst=True))
+        await connection.execute(text(f"LOCK TABLE {RollupDefinition.__tablename__} IN EXCLUSIVE MODE"))
+    rollups = [aggregate for aggregate in AGGREGATES.values() if aggregate.rollup is not None]
+    await connection.run_sync(lambda sync: RollupDefinition.metadata.create_all(sync, tables=[RollupDefinition.__table__] + [aggregate.rollup.__table__ for aggregate in rollups]))
+    stored = dict((await connection.execute(select(RollupDefinition.name, RollupDefinition.fingerprint))).all())
+    for aggregate in rollups:
+        table = aggregate.rollup.__table__
+        fingerprint = rollup_fingerprint(aggregate, connection.dialect)
+        if stored.get(table.name) == fingerprint:
+            continue
+        logger.info("Rebuilding %s for its current definition", table.name)
+        await connection.run_sync(lambda sync, table=table: (table.drop(sync), table.create(sync)))
+        await connection.execute(delete(RollupDefinition).where(RollupDefinition.name == table.name))
+        await connection.execute(insert(RollupDefinition).values(name=table.name, fingerprint=fingerprint))
+
+async def refresh_rollup(db: AsyncSession, name):
+    # Upserts the re-aggregated groups touched since the rollup's latest
+    # timestamp and commits. Run by the rollups job (pipelines.refresh_rollups),
+    # never from a read. Returns the number of groups written.
+    aggregate = AGGREGATES[name]
+    rollup = aggregate.rollup
+    watermark = None
+    for column in aggregate.timestamps:
+        latest = (await db.execute(select(func.max(getattr(rollup, column))))).scalar()
+        if latest is not None and (watermark is None or latest > watermark):
+            watermark = latest
+
+    result = await db.execute(aggregate.select(since=watermark))
+    rows = [dict(zip(aggregate.columns, row)) for row in result.all()]
+    for batch in batches(rows):
+        statement = dialect_insert(db, rollup).values(batch)
+        if hasattr(statement, 'on_conflict_do_update'):
+            statement = statement.on_conflict_do_update(
+                index_elements=[getattr(rollup, key) for key in aggregate.keys],
+                set_={column: statement.excluded[column] for column in aggregate.columns if column not in aggregate.keys},
+            )
+        await db.execute(statement)
+    await db.commit()
+    return len(rows)
+
+@timed("aggregate")
+async def fetch_aggregate(db: AsyncSession, name, since=None, rollups=AGGREGATION_ROLLUPS):
+    # Frame of the aggregate's groups, all of them or those touched since `since`
+    aggregate = AGGREGATES[name]
+    if rollups and aggregate.rollup is not None:
+        # As of the last rollups job; reads never write
+        query = aggregate.select_rollup(since)
+    else:
+        query = aggregate.select(since)
+    result = await db.execute(query)
+    return aggregate.frame(result.all())
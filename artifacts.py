@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from config import MODEL_ARTIFACT_DIR, MODEL_ARTIFACT_MAX_AGE_SECONDS, MODEL_ARTIFACT_POLL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Layout under MODEL_ARTIFACT_DIR:
+#   <name>/CURRENT            version string of the live artifact
+#   <name>/<version>/manifest.json
+#   <name>/<version>/<array>.npy
+# Version directories are immutable once published. Workers np.load them with
+# mmap_mode='r', so every process on the host shares one page-cache copy.
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "refit.lock"
+
+def new_version():
+    return datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+
+def write_atomic(path, text):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "w") as tmp:
+        tmp.write(text)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.replace(tmp_path, path)
+
+class ArtifactStore:
+
+    def __init__(self, root=MODEL_ARTIFACT_DIR, poll_interval=MODEL_ARTIFACT_POLL_SECONDS, max_age=MODEL_ARTIFACT_MAX_AGE_SECONDS):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.max_age = max_age
+        # name -> (version, manifest, arrays)
+        self.loaded = {}
+        self.checked_at = {}
+
+    @property
+    def enabled(self):
+        return bool(self.root)
+
+    def path(self, name, *parts):
+        return os.path.join(self.root, name, *parts)
+
+    def save(self, name, arrays, manifest):
+        # Writes into a hidden directory and renames it into place, then flips
+        # CURRENT; readers never observe a partially written version
+        version = manifest.get("version") or new_version()
+        manifest = dict(manifest, name=name, version=version, created_at=time.time(), arrays=sorted(arrays))
+        os.makedirs(self.path(name), exist_ok=True)
+
+        staging = tempfile.mkdtemp(dir=self.path(name), prefix=".staging-")
+        try:
+            for array_name, array in arrays.items():
+                np.save(os.path.join(staging, f"{array_name}.npy"), np.ascontiguousarray(array), allow_pickle=False)
+            with open(os.path.join(staging, MANIFEST_FILE), "w") as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.rename(staging, self.path(name, version))
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        write_atomic(self.path(name, CURRENT_FILE), version)
+        logger.info("Published %s model artifact %s", name, version)
+        return version
+
+    def current_version(self, name):
+        try:
+            with open(self.path(name, CURRENT_FILE)) as current:
+                return current.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self, name, version):
+        directory = self.path(name, version)
+        with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+        arrays = {
+            array_name: np.load(os.path.join(directory, f"{array_name}.npy"), mmap_mode="r", allow_pickle=False)
+            for array_name in manifest["arrays"]
+        }
+        return manifest, arrays
+
+    def get(self, name):
+        # Returns (version, manifest, arrays) for the live artifact, swapping to a
+        # newer version when CURRENT changes. CURRENT is polled at most once per
+        # poll_interval.
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        loaded = self.loaded.get(name)
+        if loaded is not None and now - self.checked_at.get(name, 0) < self.poll_interval:
+            return loaded
+
+        self.checked_at[name] = now
+        version = self.current_version(name)
+        if version is None:
+            return loaded
+        if loaded is None or loaded[0] != version:
+            try:
+                manifest, arrays = self.load(name, version)
+            except (OSError, ValueError) as e:
+                logger.warning("Could not load %s model artifact %s: %s", name, version, e)
+                return loaded
+            loaded = (version, manifest, arrays)
+            self.loaded[name] = loaded
+            logger.info("Swapped to %s model artifact %s", name, version)
+        return loaded
+
+    def is_stale(self, manifest):
+        return self.max_age is not None and time.time() - manifest.get("created_at", 0) > self.max_age
+
+    def try_claim_refit(self, name):
+        # Cross-process guard so only one worker refits a stale artifact; a lock
+        # older than max_age is treated as abandoned
+        os.makedirs(self.path(name), exist_ok=True)
+        lock_path = self.path(name, LOCK_FILE)
+        try:
+            if self.max_age is not None and time.time() - os.path.getmtime(lock_path) > self.max_age:
+                os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def release_refit(self, name):
+        try:
+            os.remove(self.path(name, LOCK_FILE))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, name, keep=2):
+        # Remove old versions; open mmaps keep working after unlink on POSIX
+        current = self.current_version(name)
+        versions = sorted(
+            entry for entry in os.listdir(self.path(name))
+            if not entry.startswith(".") and os.path.isdir(self.path(name, entry))
+        )
+        for version in versions[:-keep]:
+            if version != current:
+                shutil.rmtree(self.path(name, version), ignore_errors=True)
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from sqlalchemy import delete, event, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import DynamicItem, DynamicItemPriority
+from persistence import get_or_create_dynamic_items, replace_item_priorities, to_priority_scores
+
+# The benchmark writes and wipes its own copies of dynamic_item and
+# dynamic_item_priority in this schema, never the service's tables
+BENCH_SCHEMA = 'bench_bulk_write'
+
+def synthetic_recommendations(users, playlists, per_user, seed):
+    rng = np.random.default_rng(seed)
+    user_ids = np.repeat(np.arange(1, users + 1), per_user)
+    playlist_ids = rng.integers(1, playlists + 1, size=len(user_ids))
+    scores = rng.random(len(user_ids))
+    return user_ids, playlist_ids, scores
+
+async def reset_tables(session):
+    await session.execute(delete(DynamicItemPriority))
+    await session.execute(delete(DynamicItem))
+    await session.commit()
+
+async def write_row_by_row(session, user_ids, playlist_ids, scores):
+    # The original write path: one item plus a flush, then one priority, per recommendation
+    priority_scores = to_priority_scores(scores)
+    seen = set()
+    for user_id, playlist_id, score in zip(user_ids.tolist(), playlist_ids.tolist(), priority_scores.tolist()):
+        if (user_id, playlist_id) in seen:
+            continue
+        seen.add((user_id, playlist_id))
+        dynamic_item = DynamicItem(item_type='playlist_recommendation', content={"playlist_id": playlist_id}, created_at=datetime.utcnow())
+        session.add(dynamic_item)
+        await session.flush()
+        session.add(DynamicItemPriority(item_id=dynamic_item.item_id, user_id=user_id, priority_score=score))
+    await session.commit()
+    return len(seen)
+
+async def write_bulk(session, user_ids, playlist_ids, scores):
+    item_ids = await get_or_create_dynamic_items(session, 'playlist_recommendation', [{"playlist_id": playlist_id} for playlist_id in playlist_ids.tolist()])
+    rows = await replace_item_priorities(session, 'playlist_recommendation', item_ids, user_ids, scores)
+    await session.commit()
+    return rows
+
+def bench_engine(database_url):
+    engine = create_async_engine(database_url, execution_options={"schema_translate_map": {None: BENCH_SCHEMA}})
+    if engine.dialect.name == 'sqlite':
+        # SQLite schemas are attached databases; keep it in a file beside the main one
+        path = engine.url.database
+        attached = f"{path}.{BENCH_SCHEMA}" if path and path != ':memory:' else ':memory:'
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def attach(connection, _):
+            connection.execute(f"ATTACH DATABASE '{attached}' AS {BENCH_SCHEMA}")
+    return engine
+
+async def run(database_url, users, playlists, per_user, row_limit, seed):
+    engine = bench_engine(database_url)
+    async with engine.begin() as connection:
+        if engine.dialect.name != 'sqlite':
+            await connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {BENCH_SCHEMA}"))
+        await connection.run_sync(DynamicItem.metadata.create_all, tables=[DynamicItem.__table__, DynamicItemPriority.__table__])
+    SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    user_ids, playlist_ids, scores = synthetic_recommendations(users, playlists, per_user, seed)
+    result = {"database": engine.dialect.name, "users": users, "playlists": playlists, "recommendations": len(user_ids)}
+
+    strategies = [("bulk", write_bulk)]
+    if len(user_ids) <= row_limit:
+        strategies.insert(0, ("row_by_row", write_row_by_row))
+    for name, write in strategies:
+        async with SessionLocal() as session:
+            await reset_tables(session)
+            start = time.perf_counter()
+            rows = await write(session, user_ids, playlist_ids, scores)
+            elapsed = time.perf_counter() - start
+        result[f"{name}_seconds"] = elapsed
+        result[f"{name}_rows_per_second"] = rows / elapsed if elapsed else None
+
+    await engine.dispose()
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure dynamic_item_priority write throughput")
+    parser.add_argument('--database-url', help="defaults to a throwaway SQLite file; tables are written in the bench_bulk_write schema")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--playlists', type=int, default=500)
+    parser.add_argument('--per-user', type=int, default=5)
+    parser.add_argument('--row-limit', type=int, default=20000, help="skip the row-by-row path above this many recommendations")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    database_url = args.database_url or f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench-bulk-write-'), 'bench.db')}"
+
+    for users in args.users:
+        print(json.dumps(asyncio.run(run(database_url, users, args.playlists, args.per_user, args.row_limit, args.seed))))
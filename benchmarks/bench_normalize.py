@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# data_processing pulls in db, which needs a database URL to build its engine
+os.environ.setdefault('DATABASE_URL', 'sqlite+aiosqlite:///:memory:')
+
+from data_processing import normalize
+
+def normalize_loop(matrix):
+    # The original per-row implementation, kept as the baseline
+    norm_matrix = matrix.astype(np.float32)
+    for i in range(len(norm_matrix)):
+        row_max = max(norm_matrix[i])
+        if row_max > 0:
+            norm_matrix[i] = norm_matrix[i] / row_max
+    return norm_matrix
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def run(users, items, density, repeat, loop_limit, seed):
+    sparse = sparse_random(users, items, density=density, format='csr', dtype=np.float32, random_state=seed)
+    sparse.data *= 100
+    dense = sparse.toarray()
+
+    result = {"users": users, "items": items, "density": density, "nnz": int(sparse.nnz)}
+    if users <= loop_limit:
+        result["loop_seconds"] = best_of(lambda: normalize_loop(dense), repeat)
+    result["dense_seconds"] = best_of(lambda: normalize(dense), repeat)
+    result["dense_inplace_seconds"] = best_of(lambda: normalize(dense.copy(), inplace=True), repeat)
+    for strategy in ("row_max", "l2", "log"):
+        result[f"csr_{strategy}_seconds"] = best_of(lambda: normalize(sparse, strategy), repeat)
+    if "loop_seconds" in result:
+        result["dense_speedup"] = result["loop_seconds"] / result["dense_seconds"]
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the vectorized normalize with the original row loop")
+    parser.add_argument('--users', type=int, nargs='+', default=[10**4, 10**5, 10**6])
+    parser.add_argument('--items', type=int, default=64)
+    parser.add_argument('--density', type=float, default=0.02)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--loop-limit', type=int, default=10**6, help="skip the row loop above this many users")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for users in args.users:
+        print(json.dumps(run(users, args.items, args.density, args.repeat, args.loop_limit, args.seed)))
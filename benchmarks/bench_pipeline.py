@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Pipeline modules build their engine from DATABASE_URL at import time, so
+# they are imported in run() once the benchmark database URL is set
+
+INSERT_BATCH_SIZE = 50_000
+
+def skewed_choice(rng, n, size, exponent=1.1):
+    # Zipf-like popularity over 1..n: a few items get most of the traffic
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return rng.choice(n, size=size, p=weights / weights.sum()) + 1
+
+def per_user_counts(rng, users, mean):
+    # Heavy-tailed activity: most users do little, a few do a lot
+    counts = rng.lognormal(np.log(mean) - 0.5, 1.0, size=users)
+    return np.maximum(0, np.round(counts)).astype(np.int64)
+
+def unique_pairs(first, second):
+    pairs = np.unique(np.column_stack([first, second]), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+def synthetic_tables(users, seed, now):
+    # Rows per table, as lists of dicts ready for executemany, shaped like
+    # the production schema with skewed item popularity and user activity
+    rng = np.random.default_rng(seed)
+    games = max(10, users // 20)
+    playlists = max(5, users // 50)
+    tags = 20
+    user_ids = np.arange(1, users + 1)
+
+    def stamps(size):
+        return (now - rng.random(size) * timedelta(days=30)).tolist()
+
+    tables = {}
+    tables['users'] = [{"id": user_id, "username": f"user{user_id}", "password": "x", "created_date": now} for user_id in user_ids.tolist()]
+    tables['games'] = [{"id": game_id, "user_id": int(rng.integers(1, users + 1)), "title": f"game{game_id}", "created_at": now, "updated_at": now} for game_id in range(1, games + 1)]
+    tables['playlist'] = [{"id": playlist_id, "owner_id": int(rng.integers(1, users + 1)), "created_at": now, "updated_at": now} for playlist_id in range(1, playlists + 1)]
+    tables['tags'] = [{"id": tag_id, "name": f"tag{tag_id}"} for tag_id in range(1, tags + 1)]
+    game_ids, tag_ids = unique_pairs(np.repeat(np.arange(1, games + 1), 3), skewed_choice(rng, tags, games * 3))
+    tables['game_tags'] = [{"game_id": game_id, "tag_id": tag_id} for game_id, tag_id in zip(game_ids.tolist(), tag_ids.tolist())]
+
+    session_users = np.repeat(user_ids, per_user_counts(rng, users, 8))
+    session_games = skewed_choice(rng, games, len(session_users))
+    session_seconds = rng.integers(30, 3600, size=len(session_users))
+    session_stamps = stamps(len(session_users))
+    tables['game_session'] = [
+        {"game_session_id": session_id, "game_id": game_id, "user_id": user_id, "created_at": stamp, "updated_at": stamp,
+         "session_total_time": str(timedelta(seconds=seconds)), "session_total_score": seconds % 100}
+        for session_id, (user_id, game_id, seconds, stamp) in enumerate(zip(session_users.tolist(), session_games.tolist(), session_seconds.tolist(), session_stamps), 1)
+    ]
+
+    activity_users = np.repeat(user_ids, per_user_counts(rng, users, 5))
+    activity_types = np.where(rng.random(len(activity_users)) < 0.3, 'active', 'passive')
+    tables['activity'] = [
+        {"user_id": user_id, "target_id": target_id, "activity_type": activity_type, "target_type": "game", "timestamp": stamp}
+        for user_id, target_id, activity_type, stamp in zip(activity_users.tolist(), skewed_choice(rng, games, len(activity_users)).tolist(), activity_types.tolist(), stamps(len(activity_users)))
+    ]
+
+    review_users = np.repeat(user_ids, per_user_counts(rng, users, 2))
+    review_users, review_games = unique_pairs(review_users, skewed_choice(rng, games, len(review_users)))
+    tables['reviews'] = [
+        {"user_id": user_id, "game_id": game_id, "rating": rating}
+        for user_id, game_id, rating in zip(review_users.tolist(), review_games.tolist(), rng.integers(0, 6, size=len(review_users)).tolist())
+    ]
+
+    favorite_users = np.repeat(user_ids, per_user_counts(rng, users, 1))
+    favorite_users, favorite_games = unique_pairs(favorite_users, skewed_choice(rng, games, len(favorite_users)))
+    tables['favorites'] = [
+        {"user_id": user_id, "game_id": game_id, "timestamp": stamp}
+        for user_id, game_id, stamp in zip(favorite_users.tolist(), favorite_games.tolist(), stamps(len(favorite_users)))
+    ]
+
+    # Follows concentrate on a few popular accounts
+    follower_ids = np.repeat(user_ids, per_user_counts(rng, users, 4))
+    follower_ids, following_ids = unique_pairs(follower_ids, skewed_choice(rng, users, len(follower_ids)))
+    keep = follower_ids != following_ids
+    tables['follows'] = [
+        {"follower_id": follower_id, "following_id": following_id, "timestamp": stamp}
+        for follower_id, following_id, stamp in zip(follower_ids[keep].tolist(), following_ids[keep].tolist(), stamps(int(keep.sum())))
+    ]
+
+    playlist_users = np.repeat(user_ids, per_user_counts(rng, users, 2))
+    playlist_stamps = stamps(len(playlist_users))
+    tables['playlist_session'] = [
+        {"user_id": user_id, "playlist_id": playlist_id, "completed": completed, "created_at": stamp, "updated_at": stamp}
+        for user_id, playlist_id, completed, stamp in zip(playlist_users.tolist(), skewed_choice(rng, playlists, len(playlist_users)).tolist(), (rng.random(len(playlist_users)) < 0.5).tolist(), playlist_stamps)
+    ]
+
+    # Feed candidates scored by populate_priorities
+    items = [("activity", 60), ("recommendation", 20), ("ad", 5)]
+    tables['dynamic_item'] = [
+        {"item_type": item_type, "content": {"n": n}, "created_at": now - timedelta(days=int(rng.integers(0, 30)))}
+        for item_type, count in items for n in range(count)
+    ]
+    return tables
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class Stages:
+    def __init__(self):
+        self.results = {}
+
+    async def time(self, name, fn, rows=None):
+        # rows: count of rows processed, or a callable computing it from the result
+        start = time.perf_counter()
+        result = await fn()
+        elapsed = time.perf_counter() - start
+        count = rows(result) if callable(rows) else rows
+        self.results[name] = {
+            "seconds": elapsed,
+            "rows": count,
+            "rows_per_second": count / elapsed if count is not None and elapsed else None,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        return result
+
+async def write_tables(engine, tables):
+    from models import Base
+    if engine.dialect.name != 'sqlite':
+        raise RuntimeError(f"refusing to drop the tables of a {engine.dialect.name} database; the benchmark only runs on SQLite")
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all)
+        await connection.run_sync(Base.metadata.create_all)
+        for name, rows in tables.items():
+            table = Base.metadata.tables[name]
+            for start in range(0, len(rows), INSERT_BATCH_SIZE):
+                await connection.execute(table.insert(), rows[start:start + INSERT_BATCH_SIZE])
+    return sum(len(rows) for rows in tables.values())
+
+async def time_requests(app, paths):
+    import httpx
+    # Misses (e.g. 404 for an id outside the model) are timed and counted, not raised
+    timings, errors = [], 0
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for path in paths:
+            start = time.perf_counter()
+            response = await client.get(path)
+            timings.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+    return np.array(timings), int(errors)
+
+async def run(users, seed, top_n, requests):
+    import db
+    from data_processing import fetch_data, normalize, svd_factors
+    from factor_model import factor_models
+    from feed import build_user_feeds
+    from main import app
+    from personas import build_personas
+    from pipelines import get_playlist_model, update_playlist_recommendations
+    from priority import populate_priorities
+    from recommendation import build_game_signals, get_game_model, stream_game_signals
+
+    db.engine.echo = False
+    stages = Stages()
+    result = {"database": db.engine.dialect.name, "users": users, "seed": seed}
+
+    tables = await stages.time("generate", lambda: asyncio.to_thread(synthetic_tables, users, seed, datetime.utcnow()), rows=lambda tables: sum(len(rows) for rows in tables.values()))
+    result["rows"] = {name: len(rows) for name, rows in tables.items()}
+    await stages.time("write", lambda: write_tables(db.engine, tables), rows=lambda written: written)
+    del tables
+
+    async with db.SessionLocal() as session:
+        # Before fetch_data: peak RSS only grows, so this is the streamed build's own peak
+        streamed = await stages.time("stream_matrices", lambda: stream_game_signals(session), rows=lambda signals: sum(int(matrices.matrix.nnz) for _, matrices, _ in signals))
+        del streamed
+        data = await stages.time("fetch_data", lambda: fetch_data(session), rows=lambda data: sum(len(frame) for frame in data.values()))
+        signals = await stages.time("build_matrices", lambda: asyncio.to_thread(build_game_signals, data), rows=lambda signals: sum(int(matrices.matrix.nnz) for _, matrices, _ in signals))
+        matrix = signals[0][1].matrix
+        await stages.time("normalize", lambda: asyncio.to_thread(normalize, matrix), rows=matrix.shape[0])
+        await stages.time("svd", lambda: asyncio.to_thread(svd_factors, normalize(matrix)), rows=matrix.shape[0])
+        del data, signals, matrix
+
+        factor_models.clear()
+        await stages.time("fit_models", lambda: asyncio.gather(get_game_model(session), get_playlist_model(session)), rows=lambda models: sum(model.shape[0] for model in models if model is not None))
+        await stages.time("playlist_recommendations", lambda: update_playlist_recommendations(session), rows=lambda written: written)
+
+        async def priorities():
+            written = await populate_priorities(session, top_n=top_n)
+            await session.commit()
+            return written
+        await stages.time("priorities", priorities, rows=lambda written: written)
+
+        async def feeds():
+            feed = await build_user_feeds(session)
+            await session.commit()
+            return len(feed)
+        await stages.time("feeds", feeds, rows=lambda written: written)
+        await stages.time("personas", lambda: build_personas(session, full=True), rows=lambda written: written)
+
+    # Warm paths only: models, indexes and the social graph are built above
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(1, users + 1, size=requests).tolist()
+    game_ids = rng.integers(1, max(10, users // 20) + 1, size=requests).tolist()
+    endpoints = {
+        "recommendations": [f"/recommendations/{user_id}" for user_id in user_ids],
+        "persona": [f"/persona/{user_id}" for user_id in user_ids],
+        "similar": [f"/similar/{game_id}" for game_id in game_ids],
+        "social": [f"/social/{user_id}" for user_id in user_ids],
+        "feed": [f"/feed/{user_id}" for user_id in user_ids],
+    }
+    result["http"] = {}
+    for name, paths in endpoints.items():
+        start = time.perf_counter()
+        timings, errors = await time_requests(app, paths)
+        result["http"][name] = {
+            "requests": len(paths),
+            "errors": errors,
+            "p50_ms": float(np.percentile(timings, 50) * 1000),
+            "p99_ms": float(np.percentile(timings, 99) * 1000),
+            "requests_per_second": len(paths) / (time.perf_counter() - start),
+        }
+
+    result["stages"] = stages.results
+    result["peak_rss_mb"] = peak_rss_mb()
+    await db.engine.dispose()
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time each recommendation pipeline stage on seeded synthetic data")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--database', default='bench_pipeline.db', help="SQLite file, recreated per run")
+    parser.add_argument('--top-n', type=int, default=10, help="priorities kept per user")
+    parser.add_argument('--requests', type=int, default=100, help="requests timed per endpoint")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if len(args.users) > 1:
+        # One process per scale so peak RSS and the module-level caches do not carry over
+        for users in args.users:
+            command = [sys.executable, os.path.abspath(__file__), '--users', str(users), '--database', args.database,
+                       '--top-n', str(args.top_n), '--requests', str(args.requests), '--seed', str(args.seed)]
+            subprocess.run(command, check=True)
+    else:
+        # Every table is dropped and recreated, so the service's own database is
+        # never used; nor are its shared artifacts and Redis caches
+        os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{args.database}'
+        os.environ.pop('MODEL_ARTIFACT_DIR', None)
+        os.environ['RESPONSE_CACHE_BACKEND'] = 'memory'
+        os.environ['FEED_STORE_BACKEND'] = 'memory'
+        print(json.dumps(asyncio.run(run(args.users[0], args.seed, args.top_n, args.requests))), flush=True)
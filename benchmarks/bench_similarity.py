@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# data_processing pulls in db, which needs a database URL to build its engine
+os.environ.setdefault('DATABASE_URL', 'sqlite+aiosqlite:///:memory:')
+
+from similarity import ExactIndex, LSHIndex
+
+def brute_force(vectors, position, k):
+    # Reference neighbours: full cosine scan and sort, no blocking or caching
+    norms = np.linalg.norm(vectors, axis=1)
+    scores = vectors @ vectors[position] / (norms * norms[position])
+    scores[position] = -np.inf
+    return set(np.argsort(-scores, kind='stable')[:k].tolist())
+
+def latencies(index, positions, k):
+    timings = []
+    for position in positions:
+        start = time.perf_counter()
+        index.search([position], k)
+        timings.append(time.perf_counter() - start)
+    return np.array(timings)
+
+def recall(index, positions, k, truth):
+    hits = 0
+    for position in positions:
+        _, neighbours, _ = index.search([position], k)
+        hits += len(truth[position] & set(neighbours.tolist()))
+    return hits / (k * len(positions))
+
+def run(items, dim, k, queries, bits, tables, seed):
+    rng = np.random.default_rng(seed)
+    # Clustered vectors so that neighbourhoods are meaningful
+    centers = rng.standard_normal((max(1, items // 100), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), items)] + 0.3 * rng.standard_normal((items, dim)).astype(np.float32)
+    ids = np.arange(items)
+    positions = rng.choice(items, size=min(queries, items), replace=False)
+
+    start = time.perf_counter()
+    for position in positions:
+        brute_force(vectors, position, k)
+    brute_seconds = (time.perf_counter() - start) / len(positions)
+    truth = {position: brute_force(vectors, position, k) for position in positions}
+
+    result = {"items": items, "dim": dim, "k": k, "queries": len(positions), "brute_force_query_ms": brute_seconds * 1000}
+    for name, build in (("exact", lambda: ExactIndex(ids, vectors)), ("lsh", lambda: LSHIndex(ids, vectors, bits=bits, tables=tables, seed=seed))):
+        start = time.perf_counter()
+        index = build()
+        result[f"{name}_build_seconds"] = time.perf_counter() - start
+        timings = latencies(index, positions, k)
+        result[f"{name}_query_p50_ms"] = float(np.percentile(timings, 50) * 1000)
+        result[f"{name}_query_p99_ms"] = float(np.percentile(timings, 99) * 1000)
+        result[f"{name}_recall_at_k"] = recall(index, positions, k, truth)
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query latency and recall of the similarity indexes against brute force")
+    parser.add_argument('--items', type=int, nargs='+', default=[10**4, 10**5])
+    parser.add_argument('--dim', type=int, default=32)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--bits', type=int, default=8)
+    parser.add_argument('--tables', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for items in args.items:
+        print(json.dumps(run(items, args.dim, args.k, args.queries, args.bits, args.tables, args.seed)))
@@ -2,12 +2,13 @@ from celery import Celery
 from celery.schedules import crontab
 from config import CELERY_BROKER_URL, CELERY_RESULT_BACKEND
 
-def make_celery(app):
+def make_celery(name, broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND, **config):
+    # Without a configured broker, tasks go through Celery's in-memory
+    # transport, which is enough for tests and single-process runs
     celery = Celery(
-        app.import_name,
-        backend=app.config['CELERY_RESULT_BACKEND'],
-        broker=app.config['CELERY_BROKER_URL']
+        name,
+        backend=backend or 'cache+memory://',
+        broker=broker or 'memory://'
     )
-    celery.conf.update(app.config)
+    celery.conf.update(config)
     return celery
-
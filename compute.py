@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from config import COMPUTE_EXECUTOR, COMPUTE_MAX_CONCURRENCY, COMPUTE_MAX_WORKERS, COMPUTE_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class ComputeTimeoutError(Exception):
+    pass
+
+class SharedArray:
+    # Picklable handle to an ndarray living in a shared memory block
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+class SharedCSR:
+
+    def __init__(self, data, indices, indptr, shape):
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.shape = shape
+
+def share_array(array, blocks):
+    array = np.ascontiguousarray(array)
+    block = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    blocks.append(block)
+    return SharedArray(block.name, array.shape, array.dtype.str)
+
+def to_shared(value, blocks):
+    # Replace arrays (and CSR matrices) in args with shared memory handles so
+    # they reach process workers without being pickled
+    if isinstance(value, np.ndarray):
+        return share_array(value, blocks)
+    if issparse(value):
+        value = value.tocsr()
+        return SharedCSR(share_array(value.data, blocks), share_array(value.indices, blocks), share_array(value.indptr, blocks), value.shape)
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_shared(item, blocks) for item in value)
+    if isinstance(value, dict):
+        return {key: to_shared(item, blocks) for key, item in value.items()}
+    return value
+
+def from_shared(value, blocks):
+    if isinstance(value, SharedArray):
+        # Pool workers share the parent's resource tracker, which the parent's
+        # unlink() clears once the job is done
+        block = SharedMemory(name=value.name)
+        blocks.append(block)
+        return np.ndarray(value.shape, dtype=np.dtype(value.dtype), buffer=block.buf)
+    if isinstance(value, SharedCSR):
+        return csr_matrix((from_shared(value.data, blocks), from_shared(value.indices, blocks), from_shared(value.indptr, blocks)), shape=value.shape)
+    if isinstance(value, (list, tuple)):
+        return type(value)(from_shared(item, blocks) for item in value)
+    if isinstance(value, dict):
+        return {key: from_shared(item, blocks) for key, item in value.items()}
+    return value
+
+def run_shared(fn, args, kwargs):
+    # Runs in the worker process: attach inputs, call fn, detach. fn must not
+    # return views into its inputs since the blocks are closed afterwards.
+    blocks = []
+    try:
+        return fn(*from_shared(args, blocks), **from_shared(kwargs, blocks))
+    finally:
+        for block in blocks:
+            block.close()
+
+class ComputeExecutor:
+    # Runs CPU-bound stages off the event loop. kind='process' uses a process
+    # pool with arguments passed through shared memory; kind='thread' uses a
+    # thread pool (NumPy/SciPy release the GIL in their heavy kernels).
+    # Heavy jobs (run) get their own pool and a concurrency semaphore;
+    # run_in_thread jobs use a separate thread pool that is only bounded by its
+    # size, so a refit never queues the millisecond lookups behind it. Each job
+    # has a timeout; a timed out job is abandoned, not killed, so its worker
+    # stays busy until it ends.
+
+    def __init__(self, kind=COMPUTE_EXECUTOR, max_workers=COMPUTE_MAX_WORKERS, max_concurrency=COMPUTE_MAX_CONCURRENCY, timeout=COMPUTE_TIMEOUT_SECONDS):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown compute executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._executor = None
+        self._thread_executor = None
+        self._semaphore = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="compute")
+        return self._executor
+
+    @property
+    def thread_executor(self):
+        if self._thread_executor is None:
+            self._thread_executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="compute-thread")
+        return self._thread_executor
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _submit(self, executor, call, timeout, semaphore=None):
+        if semaphore is not None:
+            async with semaphore:
+                return await self._submit(executor, call, timeout)
+        timeout = self.timeout if timeout is None else timeout
+        future = asyncio.get_running_loop().run_in_executor(executor, call)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise ComputeTimeoutError(f"Compute job {getattr(call, 'func', call)} exceeded {timeout}s")
+
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        # fn must be a module-level function when kind='process'
+        if self.kind != "process":
+            return await self._submit(self.executor, partial(fn, *args, **kwargs), timeout, self.semaphore)
+
+        blocks = []
+        try:
+            shared_args, shared_kwargs = to_shared(args, blocks), to_shared(kwargs, blocks)
+            return await self._submit(self.executor, partial(run_shared, fn, shared_args, shared_kwargs), timeout, self.semaphore)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    async def run_in_thread(self, fn, *args, timeout=None, **kwargs):
+        # For stages that read or mutate process state (e.g. the shared id maps)
+        return await self._submit(self.thread_executor, partial(fn, *args, **kwargs), timeout)
+
+    def shutdown(self):
+        for executor in (self._executor, self._thread_executor):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._thread_executor = None
+
+compute_executor = ComputeExecutor()
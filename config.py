@@ -4,5 +4,83 @@ import os
 load_dotenv()  # This will load environment variables from a .env file
 
 DATABASE_URL = os.getenv('DATABASE_URL')
+# Log every SQL statement (SQLAlchemy echo); off by default, use METRICS_SAMPLE_RATE instead
+SQL_ECHO = os.getenv('SQL_ECHO', '').lower() in ('1', 'true', 'yes')
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
-CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
\ No newline at end of file
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
+# Minimum seconds between incremental refreshes of the in-process interaction store
+INTERACTION_STORE_REFRESH_SECONDS = float(os.getenv('INTERACTION_STORE_REFRESH_SECONDS', '5'))
+# Store versions whose changed user ids are kept for incremental model updates
+INTERACTION_STORE_CHANGE_LOG_SIZE = int(os.getenv('INTERACTION_STORE_CHANGE_LOG_SIZE', '256'))
+# Changed rows held apart from a table's frame before they are merged into it
+INTERACTION_STORE_COMPACT_ROWS = int(os.getenv('INTERACTION_STORE_COMPACT_ROWS', '50000'))
+
+# Shared directory for memory-mapped model artifacts; unset keeps models per process
+MODEL_ARTIFACT_DIR = os.getenv('MODEL_ARTIFACT_DIR')
+MODEL_ARTIFACT_POLL_SECONDS = float(os.getenv('MODEL_ARTIFACT_POLL_SECONDS', '2'))
+MODEL_ARTIFACT_MAX_AGE_SECONDS = float(os.getenv('MODEL_ARTIFACT_MAX_AGE_SECONDS', '3600'))
+
+# Executor for CPU-bound recommendation stages: 'thread' or 'process'
+COMPUTE_EXECUTOR = os.getenv('COMPUTE_EXECUTOR', 'thread')
+COMPUTE_MAX_WORKERS = int(os.getenv('COMPUTE_MAX_WORKERS', str(os.cpu_count() or 1)))
+# Heavy jobs (factorization) running at once; thread-pool lookups are not counted
+COMPUTE_MAX_CONCURRENCY = int(os.getenv('COMPUTE_MAX_CONCURRENCY', '2'))
+COMPUTE_TIMEOUT_SECONDS = float(os.getenv('COMPUTE_TIMEOUT_SECONDS', '120'))
+
+# Seconds between scheduled full recompute jobs; 0 disables the in-process schedule
+JOB_SCHEDULE_SECONDS = float(os.getenv('JOB_SCHEDULE_SECONDS', '0'))
+# Finished jobs kept for /jobs/{job_id} lookups
+JOB_HISTORY_SIZE = int(os.getenv('JOB_HISTORY_SIZE', '100'))
+
+# Fold changed users into a fitted model instead of refitting, until the share of
+# folded users passes FOLD_IN_MAX_DRIFT or the fit is FOLD_IN_MAX_AGE_SECONDS old
+FOLD_IN_MAX_DRIFT = float(os.getenv('FOLD_IN_MAX_DRIFT', '0.2'))
+FOLD_IN_MAX_AGE_SECONDS = float(os.getenv('FOLD_IN_MAX_AGE_SECONDS', '86400'))
+
+# Item similarity index: 'exact' (blocked cosine) or 'lsh' (random projections)
+SIMILARITY_INDEX = os.getenv('SIMILARITY_INDEX', 'exact')
+SIMILARITY_LSH_BITS = int(os.getenv('SIMILARITY_LSH_BITS', '8'))
+SIMILARITY_LSH_TABLES = int(os.getenv('SIMILARITY_LSH_TABLES', '8'))
+
+# Weight of "share of your follows who played it" added to game recommendation scores
+SOCIAL_RECOMMENDATION_WEIGHT = float(os.getenv('SOCIAL_RECOMMENDATION_WEIGHT', '0.1'))
+
+# Largest user_ids list and k accepted by POST /recommendations/batch
+RECOMMENDATION_BATCH_MAX_USERS = int(os.getenv('RECOMMENDATION_BATCH_MAX_USERS', '10000'))
+RECOMMENDATION_BATCH_MAX_K = int(os.getenv('RECOMMENDATION_BATCH_MAX_K', '100'))
+
+# Users ranked and encoded per chunk of the recommendation export (export.py)
+EXPORT_BLOCK_SIZE = int(os.getenv('EXPORT_BLOCK_SIZE', '1024'))
+
+# Share of requests (and background calls) that log stage timings and SQL verbosely
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', '0'))
+
+# Cached responses of the recommendation endpoints: 'memory' (per process, LRU)
+# or 'redis' (shared, needs the redis package)
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+RESPONSE_CACHE_REDIS_URL = os.getenv('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '300'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '10000'))
+
+# Precomputed per-user feeds served by GET /feed/{user_id}: 'memory' (per
+# process; entries expire after the TTL so other workers pick up rebuilds) or
+# 'redis' (shared, written by the feed builder, needs the redis package)
+FEED_STORE_BACKEND = os.getenv('FEED_STORE_BACKEND', 'memory')
+FEED_STORE_REDIS_URL = os.getenv('FEED_STORE_REDIS_URL', 'redis://localhost:6379/0')
+FEED_STORE_TTL_SECONDS = float(os.getenv('FEED_STORE_TTL_SECONDS', '300'))
+FEED_STORE_MAX_USERS = int(os.getenv('FEED_STORE_MAX_USERS', '1000000'))
+FEED_STORE_MAX_ITEMS = int(os.getenv('FEED_STORE_MAX_ITEMS', '100000'))
+FEED_PAGE_SIZE = int(os.getenv('FEED_PAGE_SIZE', '20'))
+FEED_PAGE_MAX_SIZE = int(os.getenv('FEED_PAGE_MAX_SIZE', '100'))
+
+# Read (user, item) aggregates from incrementally refreshed rollup tables
+# instead of running the GROUP BY over the raw tables on every load
+AGGREGATION_ROLLUPS = os.getenv('AGGREGATION_ROLLUPS', '').lower() in ('1', 'true', 'yes')
+# Seconds between runs of the job that brings the rollups up to date
+AGGREGATION_ROLLUP_REFRESH_SECONDS = float(os.getenv('AGGREGATION_ROLLUP_REFRESH_SECONDS', '60'))
+
+# Rows per chunk when reading tables through a server-side cursor
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '50000'))
+# Fit the game model from matrices accumulated over streamed chunks, without
+# loading its raw tables into the interaction store; the recompute job refits it
+STREAMING_INGESTION = os.getenv('STREAMING_INGESTION', '').lower() in ('1', 'true', 'yes')
@@ -1,11 +1,128 @@
+import asyncio
+import logging
 import pandas as pd
 import numpy as np
+from sqlalchemy import Boolean, Integer, TIMESTAMP
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from models import Activity, Comment, Favorite, Follow, GameSession, PlaylistSession, PlaylistUserActivity
+from config import STREAM_CHUNK_SIZE
+from db import SessionLocal
+from matrices import InteractionMatrix
+from metrics import timed
+from models import Activity, Comment, Favorite, Follow, GameSession, PlaylistSession, PlaylistUserActivity, Review
+from scipy.sparse import issparse
 from scipy.sparse.linalg import svds
 
-async def fetch_data(db: AsyncSession):
+logger = logging.getLogger(__name__)
+
+# Columns selected per table. Heavy free-text columns (tsv, comment bodies,
+# activity text) are never loaded for the recommendation paths.
+FETCH_COLUMNS = {
+    "activity": (Activity, ["id", "user_id", "target_id", "activity_type", "target_type", "timestamp"]),
+    "comment": (Comment, ["id", "user_id", "game_id", "parent_comment_id", "created_at", "updated_at"]),
+    "favorite": (Favorite, ["id", "user_id", "game_id", "timestamp"]),
+    "follow": (Follow, ["follow_id", "follower_id", "following_id", "timestamp"]),
+    "game_session": (GameSession, ["game_session_id", "game_id", "user_id", "created_at", "updated_at", "session_total_time", "session_total_score"]),
+    "playlist_session": (PlaylistSession, ["session_id", "user_id", "playlist_id", "completed", "created_at", "updated_at"]),
+    "playlist_user_activity": (PlaylistUserActivity, ["playlist_user_activity_id", "playlist_session_id", "action", "created_at", "updated_at"]),
+    "review": (Review, ["id", "user_id", "game_id", "rating"]),
+}
+
+CATEGORICAL_COLUMNS = {
+    "activity_type": ["passive", "active"],
+    "target_type": ["favorite", "game", "game_session", "playlist", "review", "comment", "share"],
+}
+
+# Stored as Text in the models but holds a Postgres interval
+INTERVAL_COLUMNS = {"session_total_time"}
+
+def _compact_column(values, column):
+    if column.name in CATEGORICAL_COLUMNS:
+        return pd.Categorical(values, categories=CATEGORICAL_COLUMNS[column.name])
+    if column.name in INTERVAL_COLUMNS:
+        return pd.to_timedelta(pd.Series(values, dtype=object), errors='coerce')
+    if isinstance(column.type, Boolean):
+        # NULL booleans fall back to the column default of False
+        return np.fromiter((bool(value) for value in values), dtype=bool, count=len(values))
+    if isinstance(column.type, Integer):
+        if any(value is None for value in values):
+            return pd.array(values, dtype='Int32')
+        return np.asarray(values, dtype=np.int32)
+    if isinstance(column.type, TIMESTAMP):
+        return pd.to_datetime(pd.Series(values, dtype=object))
+    return pd.Series(values, dtype=object)
+
+def build_frame(rows, model, names):
+    columns = list(zip(*rows)) if rows else [() for _ in names]
+    table_columns = model.__table__.c
+    frame = pd.DataFrame({
+        name: _compact_column(list(values), table_columns[name])
+        for name, values in zip(names, columns)
+    })
+    return frame.reset_index(drop=True)
+
+def frame_to_arrays(frame):
+    return {name: frame[name].values for name in frame.columns}
+
+async def stream_table(db: AsyncSession, table, columns=None, where=None, chunk_size=STREAM_CHUNK_SIZE):
+    # Yields compact frames of at most chunk_size rows read through a
+    # server-side cursor; only one chunk of raw rows is alive at a time
+    model, default_columns = FETCH_COLUMNS[table]
+    names = list(columns or default_columns)
+    query = select(*[getattr(model, name) for name in names]).execution_options(yield_per=chunk_size)
+    if where is not None:
+        query = query.where(where)
+    result = await db.stream(query)
+    async for rows in result.partitions(chunk_size):
+        yield build_frame(rows, model, names)
+
+@timed("fetch")
+async def fetch_table(db: AsyncSession, table, columns=None, chunk_size=STREAM_CHUNK_SIZE):
+    # Chunks are converted as they arrive, so the full list of row tuples and
+    # the frame never coexist
+    model, default_columns = FETCH_COLUMNS[table]
+    chunks = [chunk async for chunk in stream_table(db, table, columns, chunk_size=chunk_size)]
+    if not chunks:
+        return build_frame([], model, list(columns or default_columns))
+    return chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+
+@timed("stream")
+async def stream_matrices(db: AsyncSession, table, accumulators, columns=None, where=None, chunk_size=STREAM_CHUNK_SIZE):
+    # One pass over table: every chunk is fed to each accumulator
+    # (matrices.MatrixAccumulator, CountAccumulator) and dropped
+    async for chunk in stream_table(db, table, columns, where, chunk_size):
+        for accumulator in accumulators:
+            accumulator.add(chunk)
+    return [accumulator.result() for accumulator in accumulators]
+
+async def fetch_table_concurrently(table, columns=None):
+    # Each concurrent load gets its own pooled connection
+    async with SessionLocal() as session:
+        return await fetch_table(session, table, columns)
+
+async def fetch_data(db: AsyncSession, tables=None, columnar=True, columns=None, as_arrays=False, concurrent=False):
+    if not columnar:
+        return await fetch_orm_data(db)
+
+    # tables restricts which tables are loaded; columns optionally narrows the
+    # selected columns per table, e.g. {"follow": ["follower_id", "following_id"]};
+    # None loads every table, an empty list none
+    tables = list(FETCH_COLUMNS if tables is None else tables)
+    columns = columns or {}
+
+    if concurrent:
+        frames = await asyncio.gather(*[fetch_table_concurrently(table, columns.get(table)) for table in tables])
+        data = dict(zip(tables, frames))
+    else:
+        data = {}
+        for table in tables:
+            data[table] = await fetch_table(db, table, columns.get(table))
+
+    if as_arrays:
+        return {table: frame_to_arrays(frame) for table, frame in data.items()}
+    return data
+
+async def fetch_orm_data(db: AsyncSession):
     activity_result = await db.execute(select(Activity))
     activities = activity_result.scalars().all()
 
@@ -54,26 +171,93 @@ async def fetch_data(db: AsyncSession):
         "playlist_user_activity": playlist_user_activity_df
     }
 
-def normalize(matrix):
-    norm_matrix = matrix.astype(np.float32)
-    for i in range(len(norm_matrix)):
-        row_max = max(norm_matrix[i])
-        if row_max > 0:
-            norm_matrix[i] = norm_matrix[i] / row_max
+NORMALIZATION_STRATEGIES = ("row_max", "l2", "log")
+
+def row_scale(row_norms):
+    # 1 / norm per row; rows with no positive norm are left unscaled
+    row_norms = np.asarray(row_norms, dtype=np.float32)
+    return np.divide(1.0, row_norms, out=np.ones_like(row_norms), where=row_norms > 0)
+
+def sparse_row_reduce(matrix, reduce):
+    # Apply a ufunc reduction to the stored values of each CSR row; empty rows give 0
+    counts = np.diff(matrix.indptr)
+    result = np.zeros(matrix.shape[0], dtype=np.float32)
+    non_empty = counts > 0
+    if matrix.nnz:
+        result[non_empty] = reduce.reduceat(matrix.data, matrix.indptr[:-1][non_empty])
+    return result
+
+@timed("normalize")
+def normalize_sparse(matrix, strategy="row_max", inplace=False):
+    matrix = matrix.tocsr()
+    if matrix.dtype != np.float32:
+        matrix = matrix.astype(np.float32)
+    elif not inplace:
+        matrix = matrix.copy()
+
+    if strategy == "log":
+        np.log1p(matrix.data, out=matrix.data)
+    if strategy == "l2":
+        norms = np.sqrt(sparse_row_reduce(matrix.multiply(matrix).tocsr(), np.add))
+    else:
+        norms = sparse_row_reduce(matrix, np.maximum)
+
+    # Scale data in place; each stored value belongs to row repeat(arange, counts)
+    matrix.data *= np.repeat(row_scale(norms), np.diff(matrix.indptr))
+    return matrix
+
+@timed("normalize")
+def normalize_dense(matrix, strategy="row_max", inplace=False):
+    if inplace and isinstance(matrix, np.ndarray) and matrix.dtype == np.float32 and matrix.flags.writeable:
+        norm_matrix = matrix
+    else:
+        norm_matrix = np.array(matrix, dtype=np.float32)
+    if norm_matrix.ndim != 2 or norm_matrix.size == 0:
+        return norm_matrix
+
+    if strategy == "log":
+        np.log1p(norm_matrix, out=norm_matrix)
+    if strategy == "l2":
+        norms = np.linalg.norm(norm_matrix, axis=1)
+    else:
+        norms = norm_matrix.max(axis=1)
+
+    norm_matrix *= row_scale(norms)[:, None]
     return norm_matrix
 
-def svd_reconstruct(matrix, k=2):
-    if matrix.size == 0:
-        return np.zeros(matrix.shape)
-    
+def normalize(matrix, strategy="row_max", inplace=False):
+    # row_max: divide each row by its maximum
+    # l2: divide each row by its euclidean norm
+    # log: log1p the values, then divide each row by its maximum
+    if strategy not in NORMALIZATION_STRATEGIES:
+        raise ValueError(f"Unknown normalization strategy: {strategy}")
+    if isinstance(matrix, InteractionMatrix):
+        return matrix.with_matrix(normalize(matrix.matrix, strategy, inplace))
+    if issparse(matrix):
+        return normalize_sparse(matrix, strategy, inplace)
+    return normalize_dense(matrix, strategy, inplace)
+
+@timed("svd")
+def svd_factors(matrix, k=2):
+    # Truncated SVD folded into two factors: (U·Σ) of shape (rows, k) and Vt of
+    # shape (k, columns). An empty or failed decomposition yields zero factors.
+    if isinstance(matrix, InteractionMatrix):
+        matrix = matrix.matrix
+    rows, columns = matrix.shape
+    if matrix.size == 0 or min(matrix.shape) < 2:
+        return np.zeros((rows, 1), dtype=np.float32), np.zeros((1, columns), dtype=np.float32)
+
     min_dim = min(matrix.shape)
     k = min(k, min_dim - 1)  # Ensure k is less than the smallest dimension of the matrix
     k = max(k, 1)  # Ensure k is at least 1
 
     try:
-        U, sigma, Vt = svds(matrix, k=k)
-        sigma = np.diag(sigma)
-        return np.dot(np.dot(U, sigma), Vt)
+        U, sigma, Vt = svds(matrix.astype(np.float32), k=k)
+        return (U * sigma).astype(np.float32), Vt.astype(np.float32)
     except Exception as e:
-        print(f"Exception occurred during SVD reconstruction: {e}")
-        return np.zeros(matrix.shape)
\ No newline at end of file
+        logger.warning("SVD failed for a %s matrix: %s", matrix.shape, e)
+        return np.zeros((rows, 1), dtype=np.float32), np.zeros((1, columns), dtype=np.float32)
+
+def svd_reconstruct(matrix, k=2):
+    user_factors, item_factors = svd_factors(matrix, k)
+    return np.dot(user_factors, item_factors)
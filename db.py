@@ -1,8 +1,10 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from config import DATABASE_URL
+from config import DATABASE_URL, SQL_ECHO
+from metrics import instrument_engine
+from sql_functions import register_sql_functions
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+engine = register_sql_functions(instrument_engine(create_async_engine(DATABASE_URL, echo=SQL_ECHO)))
 SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import json
+import sys
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from compute import compute_executor
+from config import EXPORT_BLOCK_SIZE, SOCIAL_RECOMMENDATION_WEIGHT
+from db import SessionLocal
+from recommendation import get_game_model, rank_batch
+from social import get_social_plays
+
+class ChunkSink:
+    # Write-only file object that collects bytes until drained, so pyarrow
+    # writers can be fed one block at a time
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+class NdjsonEncoder:
+    # One line per user: {"user_id": .., "recommendations": [{"item_id", "priority_score"}, ..]}
+
+    def encode(self, user_ids, item_ids, scores):
+        lines = []
+        for user_id, user_items, user_scores in zip(user_ids.tolist(), item_ids, scores):
+            finite = np.isfinite(user_scores)
+            recommendations = [{"item_id": item_id, "priority_score": score} for item_id, score in zip(user_items[finite].tolist(), user_scores[finite].tolist())]
+            lines.append(json.dumps({"user_id": user_id, "recommendations": recommendations}))
+        return ("\n".join(lines) + "\n").encode() if lines else b""
+
+    def close(self):
+        return b""
+
+class ArrowEncoder:
+    # Flat (user_id, rank, item_id, priority_score) record batches, one per
+    # block, as an Arrow IPC stream or Parquet row groups
+
+    def __init__(self, format="arrow"):
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise RuntimeError(f"{format} export requires the pyarrow package") from e
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([
+            ("user_id", pyarrow.int64()),
+            ("rank", pyarrow.int16()),
+            ("item_id", pyarrow.int64()),
+            ("priority_score", pyarrow.float32()),
+        ])
+        self.sink = ChunkSink()
+        self.parquet = format == "parquet"
+        if self.parquet:
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def encode(self, user_ids, item_ids, scores):
+        ranks = np.broadcast_to(np.arange(item_ids.shape[1], dtype=np.int16), item_ids.shape)
+        keep = np.isfinite(scores)
+        batch = self.pa.record_batch([
+            np.repeat(user_ids, item_ids.shape[1]).reshape(item_ids.shape)[keep],
+            ranks[keep],
+            item_ids[keep].astype(np.int64),
+            scores[keep].astype(np.float32),
+        ], schema=self.schema)
+        if batch.num_rows:
+            if self.parquet:
+                self.writer.write_table(self.pa.Table.from_batches([batch]))
+            else:
+                self.writer.write_batch(batch)
+        return self.sink.drain()
+
+    def close(self):
+        self.writer.close()
+        return self.sink.drain()
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", NdjsonEncoder),
+    "arrow": ("application/vnd.apache.arrow.stream", lambda: ArrowEncoder("arrow")),
+    "parquet": ("application/vnd.apache.parquet", lambda: ArrowEncoder("parquet")),
+}
+
+class RecommendationExport:
+    # Top-k games of every user in the game model, ranked and encoded one block
+    # of users at a time. Everything it needs is loaded up front, so chunks are
+    # produced without touching the database; a block is only computed when
+    # the consumer asks for the next chunk, so a slow reader holds back the
+    # export instead of letting results pile up in memory.
+
+    def __init__(self, model, k=10, exclude_seen=False, graph=None, plays=None, block_size=EXPORT_BLOCK_SIZE):
+        self.model = model
+        self.k = k
+        self.exclude_seen = exclude_seen
+        self.graph = graph
+        self.plays = plays
+        self.block_size = block_size
+        # Users without interactions in the model get no recommendations
+        self.user_indices = np.flatnonzero(model.observed_users)
+
+    @property
+    def users(self):
+        return len(self.user_indices)
+
+    def block(self, start):
+        user_indices = self.user_indices[start:start + self.block_size]
+        user_ids = self.model.user_ids[user_indices]
+        boost = None
+        if self.graph is not None and SOCIAL_RECOMMENDATION_WEIGHT:
+            boost = SOCIAL_RECOMMENDATION_WEIGHT * self.graph.follow_play_shares(user_ids, self.model.item_ids, self.plays)
+        items, scores = rank_batch(self.model, user_indices, self.k, boost, self.exclude_seen, self.block_size)
+        return user_ids, self.model.item_ids[items], scores
+
+    async def chunks(self, encoder):
+        for start in range(0, self.users, self.block_size):
+            chunk = await compute_executor.run_in_thread(lambda start=start: encoder.encode(*self.block(start)))
+            if chunk:
+                yield chunk
+        chunk = encoder.close()
+        if chunk:
+            yield chunk
+
+async def prepare_export(db: AsyncSession, k=10, exclude_seen=False, block_size=EXPORT_BLOCK_SIZE):
+    # Same scores as POST /recommendations/batch, for every user the model knows
+    model = await get_game_model(db)
+    graph, plays = await get_social_plays(db) if SOCIAL_RECOMMENDATION_WEIGHT else (None, None)
+    return RecommendationExport(model, k, exclude_seen, graph, plays, block_size)
+
+async def export_recommendations(output, format="ndjson", k=10, exclude_seen=False, block_size=EXPORT_BLOCK_SIZE):
+    async with SessionLocal() as db:
+        export = await prepare_export(db, k, exclude_seen, block_size)
+    written = 0
+    _, encoder_class = EXPORT_FORMATS[format]
+    async for chunk in export.chunks(encoder_class()):
+        output.write(chunk)
+        written += len(chunk)
+    output.flush()
+    return written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export every user's top-k game recommendations")
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--exclude-seen', action='store_true')
+    parser.add_argument('--block-size', type=int, default=EXPORT_BLOCK_SIZE, help="users ranked per chunk")
+    parser.add_argument('--output', default='-', help="file path, - for stdout")
+    args = parser.parse_args()
+
+    async def main():
+        try:
+            if args.output == '-':
+                return await export_recommendations(sys.stdout.buffer, args.format, args.k, args.exclude_seen, args.block_size)
+            with open(args.output, 'wb') as output:
+                return await export_recommendations(output, args.format, args.k, args.exclude_seen, args.block_size)
+        finally:
+            compute_executor.shutdown()
+
+    written = asyncio.run(main())
+    print(f"Wrote {written} bytes", file=sys.stderr)
@@ -0,0 +1,507 @@
+import asyncio
+import time
+from contextlib import nullcontext
+import numpy as np
+from scipy.sparse import csr_matrix
+from artifacts import artifact_store
+from compute import compute_executor
+from config import FOLD_IN_MAX_AGE_SECONDS, FOLD_IN_MAX_DRIFT
+from data_processing import normalize, svd_factors
+from matrices import MAP_LOCK, IndexMap, align_matrices
+from metrics import observe_matrix
+from ranking import DEFAULT_BLOCK_SIZE, top_k
+
+class FactorModel:
+    # Truncated SVD factors for one or more interaction signals over a shared
+    # user x item index space. Scores are computed on demand as dot products of
+    # user factor rows against the item factors; the dense reconstruction is
+    # never materialized.
+
+    def __init__(self, row_map, col_map, version=None):
+        self.row_map = row_map
+        self.col_map = col_map
+        self.version = version
+        # Set when the model was loaded from a published artifact
+        self.artifact_version = None
+        self.signals = {}
+        # Normalization strategy per signal, reapplied to rows folded in later
+        self.strategies = {}
+        # Boolean CSR of every observed (user, item) pair, used to exclude seen items
+        self.interactions = None
+        self._blended = None
+        self._observed = None
+        self._observed_users = None
+        self.fitted_at = time.time()
+        # Wall time of the interaction data the factors were computed from
+        self.data_time = self.fitted_at
+        self.fitted_shape = None
+        # Rows and columns folded in since the fit, see fold_in()
+        self.folded_users = set()
+        self.folded_items = 0
+        self.fold_in_residual = None
+
+    @property
+    def shape(self):
+        # The shared id maps may keep growing after the fit; the model only
+        # covers the ids that existed when its factors were computed
+        if self.signals:
+            user_factors, item_factors, _ = next(iter(self.signals.values()))
+            return user_factors.shape[0], item_factors.shape[1]
+        return len(self.row_map), len(self.col_map)
+
+    @property
+    def user_ids(self):
+        return self.row_map.ids[:self.shape[0]]
+
+    @property
+    def item_ids(self):
+        return self.col_map.ids[:self.shape[1]]
+
+    def user_index(self, user_id):
+        index = self.user_indices([user_id])[0]
+        return None if index < 0 else int(index)
+
+    def user_indices(self, user_ids):
+        # Model rows of user_ids, -1 for users the model has no interactions
+        # of: ids outside it and ids other models added to the shared map
+        indices = self.row_map.to_index(user_ids)
+        inside = (indices >= 0) & (indices < self.shape[0])
+        inside[inside] = self.observed_users[indices[inside]]
+        return np.where(inside, indices, -1)
+
+    def add_signal(self, name, user_factors, item_factors, weight, strategy="row_max"):
+        self.signals[name] = (user_factors, item_factors, weight)
+        self.strategies[name] = strategy
+        self._blended = None
+        self._observed = None
+        self._observed_users = None
+        if self.fitted_shape is None:
+            self.fitted_shape = user_factors.shape[0], item_factors.shape[1]
+        return self
+
+    def fit_signal(self, name, matrix, weight, k=2, strategy="row_max"):
+        user_factors, item_factors = svd_factors(normalize(matrix, strategy), k)
+        return self.add_signal(name, user_factors, item_factors, weight, strategy)
+
+    @property
+    def drift(self):
+        # Share of rows and columns that were folded in rather than fitted
+        if self.fitted_shape is None:
+            return 0.0
+        return (len(self.folded_users) + self.folded_items) / max(1, sum(self.fitted_shape))
+
+    def needs_refit(self, changed_users=(), max_drift=FOLD_IN_MAX_DRIFT, max_age=FOLD_IN_MAX_AGE_SECONDS):
+        if max_age is not None and time.time() - self.fitted_at > max_age:
+            return True
+        if self.fitted_shape is None:
+            return True
+        folded = len(self.folded_users | set(np.asarray(changed_users).tolist()))
+        return (folded + self.folded_items) / max(1, sum(self.fitted_shape)) > max_drift
+
+    def copy(self):
+        # Shallow copy whose signal, strategy and folded-user containers can be
+        # replaced without affecting this model; factor arrays are shared
+        model = FactorModel(self.row_map, self.col_map, version=self.version)
+        model.artifact_version = self.artifact_version
+        model.signals = dict(self.signals)
+        model.strategies = dict(self.strategies)
+        model.interactions = self.interactions
+        model._blended = self._blended
+        model._observed = self._observed
+        model._observed_users = self._observed_users
+        model.fitted_at = self.fitted_at
+        model.data_time = self.data_time
+        model.fitted_shape = self.fitted_shape
+        model.folded_users = set(self.folded_users)
+        model.folded_items = self.folded_items
+        model.fold_in_residual = self.fold_in_residual
+        return model
+
+    def fold_in(self, matrices, user_ids):
+        # Online update that keeps the fitted factors of everything else fixed.
+        # matrices maps signal name -> InteractionMatrix holding the current
+        # interactions of user_ids (built from those users' rows only).
+        #   users:     u = r · Vtᵀ, the least-squares projection onto the item factors
+        #   new items: v = (U·Σ)ᵀ c / σ², projected from the folded users' rows
+        # Users are projected once more after new items are placed, so the new
+        # items count towards their factors. Factor arrays are written as new
+        # copies, never in place: readers of a shared model may be using them,
+        # so fold into copy() and swap the model (see FactorModelCache.fold_in).
+        # Matrices are built on the shared id maps; a model loaded from an
+        # artifact has maps of its own, so their entries are moved onto those.
+        matrices = {name: matrix.reindex(self.row_map, self.col_map) for name, matrix in matrices.items()}
+        with MAP_LOCK:
+            rows = self.row_map.to_index(user_ids)
+            shape = (len(self.row_map), len(self.col_map))
+        rows = np.unique(rows[rows >= 0])
+        if not len(rows):
+            return self
+
+        for matrix in matrices.values():
+            matrix.resize(shape)
+        model_rows, model_cols = self.shape
+        n_rows = max(model_rows, int(rows.max()) + 1)
+        # Only items the folded users interacted with extend the model; ids
+        # other models added to the shared map stay outside it
+        seen = None
+        for matrix in matrices.values():
+            signal_seen = matrix.matrix[rows].astype(bool)
+            seen = signal_seen if seen is None else seen + signal_seen
+        seen_cols = np.unique(seen.indices)
+        n_cols = max(model_cols, int(seen_cols.max()) + 1 if len(seen_cols) else 0)
+
+        seen = None
+        residuals = []
+        for name, matrix in matrices.items():
+            user_factors, item_factors, weight = self.signals[name]
+            values = normalize(matrix.matrix, self.strategies.get(name, "row_max"))[rows][:, :n_cols]
+            user_factors = grow(user_factors, n_rows, axis=0, copy=True)
+            item_factors = grow(item_factors, n_cols, axis=1, copy=True)
+
+            user_factors[rows] = values[:, :model_cols] @ item_factors[:, :model_cols].T
+            if n_cols > model_cols:
+                sigma_sq = np.square(user_factors[:model_rows]).sum(axis=0)
+                projected = (values[:, model_cols:].T @ user_factors[rows]).T
+                item_factors[:, model_cols:] = np.divide(projected, sigma_sq[:, None], out=np.zeros_like(projected), where=sigma_sq[:, None] > 0)
+                user_factors[rows] = values @ item_factors.T
+
+            # ||r - u·Vt||² = ||r||² - 2 u·(r·Vtᵀ) + u (Vt Vtᵀ) uᵀ, without densifying r
+            folded = user_factors[rows]
+            row_norms = np.asarray(values.multiply(values).sum(axis=1)).ravel()
+            error = row_norms - 2 * np.einsum("ij,ij->i", folded, values @ item_factors.T) + np.einsum("ij,jk,ik->i", folded, item_factors @ item_factors.T, folded)
+            residuals.append(np.sqrt(np.maximum(error, 0)[row_norms > 0] / row_norms[row_norms > 0]))
+
+            self.signals[name] = (user_factors, item_factors, weight)
+            signal_seen = matrix.matrix[:n_rows, :n_cols].astype(bool)
+            seen = signal_seen if seen is None else seen + signal_seen
+
+        # Replace the folded users' rows of the seen-pairs matrix
+        interactions = self.interactions if self.interactions is not None else csr_matrix((n_rows, n_cols), dtype=bool)
+        interactions = interactions.tocsr().astype(bool)
+        interactions.resize((n_rows, n_cols))
+        interactions.data[np.isin(np.repeat(np.arange(n_rows), np.diff(interactions.indptr)), rows)] = False
+        interactions.eliminate_zeros()
+        self.interactions = interactions + seen
+
+        self._blended = None
+        self._observed = None
+        self._observed_users = None
+        # User ids, like the changed_users that needs_refit() adds to them
+        self.folded_users.update(self.row_map.to_id(rows).tolist())
+        self.folded_items += n_cols - model_cols
+        residuals = np.concatenate(residuals)
+        if len(residuals):
+            self.fold_in_residual = float(residuals.mean())
+        return self
+
+    def blended_factors(self):
+        # Weighted per-signal factors stacked along k, so one dot product scores
+        # every signal at once: sum_s w_s * (U·Σ)_s[u] @ Vt_s
+        if self._blended is None:
+            if not self.signals:
+                rows, columns = self.shape
+                self._blended = np.zeros((rows, 1), dtype=np.float32), np.zeros((1, columns), dtype=np.float32)
+            else:
+                user_factors = np.hstack([weight * factors for factors, _, weight in self.signals.values()])
+                item_factors = np.vstack([factors for _, factors, _ in self.signals.values()])
+                self._blended = user_factors.astype(np.float32), item_factors.astype(np.float32)
+        return self._blended
+
+    @property
+    def user_factors(self):
+        return self.blended_factors()[0]
+
+    @property
+    def item_factors(self):
+        return self.blended_factors()[1]
+
+    def score_index(self, user_index):
+        user_factors, item_factors = self.blended_factors()
+        return user_factors[user_index] @ item_factors
+
+    def score_user(self, user_id):
+        user_index = self.user_index(user_id)
+        if user_index is None:
+            return None
+        return self.score_index(user_index)
+
+    def score_indices(self, user_indices):
+        user_factors, item_factors = self.blended_factors()
+        return user_factors[np.asarray(user_indices)] @ item_factors
+
+    @property
+    def observed_items(self):
+        # Item columns with at least one interaction. The shared id maps also
+        # hold ids added by other models; their columns have all-zero factors
+        # and must not be recommended.
+        if self._observed is None:
+            observed = np.ones(self.shape[1], dtype=bool)
+            if self.interactions is not None:
+                counts = np.bincount(self.interactions.tocsr().indices, minlength=self.shape[1])[:self.shape[1]]
+                observed = counts > 0
+            self._observed = observed
+        return self._observed
+
+    @property
+    def observed_users(self):
+        # User rows with at least one interaction; as with items, rows of ids
+        # other models added to the shared map hold all-zero factors
+        if self._observed_users is None:
+            observed = np.ones(self.shape[0], dtype=bool)
+            if self.interactions is not None:
+                interactions = self.interactions.tocsr()
+                counts = np.zeros(self.shape[0], dtype=np.int64)
+                rows = min(self.shape[0], interactions.shape[0])
+                counts[:rows] = np.diff(interactions.indptr)[:rows]
+                observed = counts > 0
+            self._observed_users = observed
+        return self._observed_users
+
+    def top_k(self, k, user_indices=None, exclude_seen=False, block_size=DEFAULT_BLOCK_SIZE):
+        # Ranks user_indices, or every observed user; unobserved rows are skipped
+        user_factors, item_factors = self.blended_factors()
+        exclude = self.interactions if exclude_seen else None
+        if user_indices is None:
+            user_indices = np.flatnonzero(self.observed_users)
+        else:
+            user_indices = np.asarray(user_indices, dtype=np.int64)
+            user_indices = user_indices[self.observed_users[user_indices]]
+        return top_k(user_factors, item_factors, k, user_indices=user_indices, exclude=exclude, item_mask=self.observed_items, block_size=block_size)
+
+def grow(array, size, axis, copy=False):
+    # Writable array padded with zero rows/columns up to size along axis.
+    # Memory-mapped or otherwise read-only factors are copied first, and any
+    # array is with copy=True.
+    if array.shape[axis] >= size and array.flags.writeable and not copy:
+        return array
+    shape = list(array.shape)
+    shape[axis] = max(size, array.shape[axis])
+    grown = np.zeros(shape, dtype=array.dtype)
+    grown[tuple(slice(0, length) for length in array.shape)] = array
+    return grown
+
+def signal_specs(signals):
+    # signals: list of (name, InteractionMatrix, weight) or
+    # (name, InteractionMatrix, weight, normalization strategy) sharing the same id maps
+    matrices = align_matrices(*[signal[1] for signal in signals])
+    specs = [(signal[0], signal[2], signal[3] if len(signal) > 3 else "row_max") for signal in signals]
+    return specs, matrices
+
+def factorize_signals(matrices, strategies, k=2):
+    # Pure numeric stage: takes plain CSR matrices and returns (U·Σ, Vt) per
+    # signal, so it can run in a process worker
+    return [svd_factors(normalize(matrix, strategy), k) for matrix, strategy in zip(matrices, strategies)]
+
+def assemble_model(specs, matrices, factors, version=None):
+    model = FactorModel(matrices[0].row_map, matrices[0].col_map, version=version)
+    for (name, weight, strategy), matrix, (user_factors, item_factors) in zip(specs, matrices, factors):
+        model.add_signal(name, user_factors, item_factors, weight, strategy)
+        observe_matrix(name, matrix.matrix)
+        seen = matrix.matrix.astype(bool)
+        model.interactions = seen if model.interactions is None else model.interactions + seen
+    return model
+
+def fit_factor_model(signals, k=2, version=None):
+    specs, matrices = signal_specs(signals)
+    factors = factorize_signals([matrix.matrix for matrix in matrices], [strategy for _, _, strategy in specs], k)
+    return assemble_model(specs, matrices, factors, version)
+
+async def fit_factor_model_async(build_signals, k=2, version=None, stage=nullcontext):
+    # Matrix building touches the process-wide id maps, so it runs on a thread;
+    # the factorization goes to the configured compute executor
+    data_time = time.time()
+    with stage("build_matrices"):
+        specs, matrices = await compute_executor.run_in_thread(lambda: signal_specs(build_signals()))
+    with stage("factorize"):
+        factors = await compute_executor.run(factorize_signals, [matrix.matrix for matrix in matrices], [strategy for _, _, strategy in specs], k)
+    model = assemble_model(specs, matrices, factors, version)
+    model.data_time = data_time
+    return model
+
+def model_to_artifact(model):
+    user_factors, item_factors = model.blended_factors()
+    arrays = {
+        "row_ids": model.user_ids,
+        "col_ids": model.item_ids,
+        "user_factors": user_factors,
+        "item_factors": item_factors,
+    }
+    signals = []
+    for name, (signal_user_factors, signal_item_factors, weight) in model.signals.items():
+        arrays[f"signal-{name}-user_factors"] = signal_user_factors
+        arrays[f"signal-{name}-item_factors"] = signal_item_factors
+        signals.append({"name": name, "weight": weight, "strategy": model.strategies.get(name, "row_max")})
+
+    manifest = {"signals": signals, "shape": list(model.shape), "data_time": model.data_time}
+    if model.interactions is not None:
+        interactions = model.interactions.tocsr()
+        arrays["interactions_data"] = interactions.data
+        arrays["interactions_indices"] = interactions.indices
+        arrays["interactions_indptr"] = interactions.indptr
+        manifest["interactions_shape"] = list(interactions.shape)
+    return arrays, manifest
+
+def model_from_artifact(artifact_version, manifest, arrays, version=None):
+    # Arrays stay memory-mapped; nothing is copied into the worker's heap
+    # except the id -> index lookups. version is the local data version the
+    # artifact covers, None when unknown.
+    model = FactorModel(IndexMap(arrays["row_ids"]), IndexMap(arrays["col_ids"]), version=version)
+    for signal in manifest["signals"]:
+        name = signal["name"]
+        model.add_signal(name, arrays[f"signal-{name}-user_factors"], arrays[f"signal-{name}-item_factors"], signal["weight"], signal.get("strategy", "row_max"))
+    model._blended = arrays["user_factors"], arrays["item_factors"]
+    if "interactions_shape" in manifest:
+        model.interactions = csr_matrix(
+            (arrays["interactions_data"], arrays["interactions_indices"], arrays["interactions_indptr"]),
+            shape=tuple(manifest["interactions_shape"]),
+        )
+    model.artifact_version = artifact_version
+    model.fitted_at = manifest.get("created_at", model.fitted_at)
+    model.data_time = manifest.get("data_time", model.fitted_at)
+    return model
+
+class FactorModelCache:
+    # Keeps the most recent model per name and refits only when the version of
+    # the underlying data changes
+
+    def __init__(self):
+        self.models = {}
+        self.locks = {}
+        # Called with (name, model) whenever the model served under a name is
+        # replaced or folded to a new version
+        self.listeners = []
+
+    def changed(self, name, model):
+        for listener in self.listeners:
+            listener(name, model)
+
+    def get(self, name, version):
+        model = self.models.get(name)
+        if model is not None and model.version == version:
+            return model
+        return None
+
+    async def get_or_fit(self, name, version, build_signals, k=2, stage=nullcontext, changed_users=None, version_at=None):
+        # Concurrent misses for the same model wait for a single fit.
+        # changed_users(since_version) returns the ids of users whose data
+        # changed since a version (None if unknown). When given, an outdated
+        # model folds those users in instead of refitting, until it crosses the
+        # drift or age threshold; build_signals must then accept user_ids.
+        # version_at(timestamp) maps a published artifact's data time to the
+        # local version it covers (see get_or_fit_shared).
+        async with self.locks.setdefault(name, asyncio.Lock()):
+            if artifact_store.enabled:
+                return await self.get_or_fit_shared(name, version, build_signals, k, stage, changed_users, version_at)
+            model = self.get(name, version)
+            if model is not None:
+                return model
+            model = self.models.get(name)
+            if model is not None and changed_users is not None and model.version is not None:
+                folded = await self.fold_in(model, version, build_signals, changed_users(model.version), stage)
+                if folded is not None:
+                    self.models[name] = folded
+                    self.changed(name, folded)
+                    return folded
+            model = await fit_factor_model_async(build_signals, k=k, version=version, stage=stage)
+            self.models[name] = model
+            self.changed(name, model)
+            return model
+
+    async def fit(self, name, build_signals, k=2, version=None, stage=nullcontext):
+        # Unconditional refit, e.g. from streamed matrices that carry no data version
+        async with self.locks.setdefault(name, asyncio.Lock()):
+            model = await fit_factor_model_async(build_signals, k=k, version=version, stage=stage)
+            if artifact_store.enabled:
+                with stage("publish"):
+                    await compute_executor.run_in_thread(self.publish, name, model)
+            self.models[name] = model
+            self.changed(name, model)
+            return model
+
+    def latest(self, name):
+        return self.models.get(name)
+
+    async def fold_in(self, model, version, build_signals, user_ids, stage=nullcontext):
+        # The folded model, a copy that replaces `model` once complete, or None
+        # when the users cannot be folded in and a refit is needed
+        if user_ids is None or model.needs_refit(user_ids):
+            return None
+        folded = model.copy()
+        if len(user_ids):
+            with stage("fold_in"):
+                def update():
+                    specs, matrices = signal_specs(build_signals(user_ids=user_ids))
+                    folded.fold_in({name: matrix for (name, _, _), matrix in zip(specs, matrices)}, user_ids)
+                await compute_executor.run_in_thread(update)
+        folded.version = version
+        return folded
+
+    async def get_or_fit_shared(self, name, version, build_signals, k=2, stage=nullcontext, changed_users=None, version_at=None):
+        # Serve the published artifact, hot-swapping when a newer one appears.
+        # Data that changed after the artifact was fitted is folded into a
+        # local copy, as get_or_fit does in-process. When it cannot be folded
+        # in, when there is no artifact yet, or when it is older than the
+        # configured max age, one worker refits and publishes while the rest
+        # keep serving.
+        model = self.load_shared(name, version_at)
+        if model is not None:
+            if model.version != version:
+                since = model.version
+                user_ids = changed_users(since) if changed_users is not None and since is not None else None
+                folded = await self.fold_in(model, version, build_signals, user_ids, stage)
+                if folded is not None:
+                    self.models[name] = model = folded
+                    self.changed(name, folded)
+            manifest = artifact_store.loaded[name][1]
+            outdated = model.version != version or artifact_store.is_stale(manifest)
+            if not outdated or not artifact_store.try_claim_refit(name):
+                return model
+        elif not artifact_store.try_claim_refit(name):
+            # Another worker is publishing the first artifact; serve a local fit meanwhile
+            model = self.get(name, version)
+            if model is None:
+                model = await fit_factor_model_async(build_signals, k=k, version=version, stage=stage)
+                self.models[name] = model
+                self.changed(name, model)
+            return model
+
+        try:
+            model = await fit_factor_model_async(build_signals, k=k, version=version, stage=stage)
+            with stage("publish"):
+                published = await compute_executor.run_in_thread(self.publish, name, model)
+        finally:
+            artifact_store.release_refit(name)
+        model = self.load_shared(name, version_at)
+        if model.artifact_version == published:
+            # Fitted here, so it covers exactly the current local version
+            model.version = version
+        return model
+
+    def load_shared(self, name, version_at=None):
+        # The model served for the live artifact: the one already adopted
+        # (possibly with users folded in), or a fresh one when CURRENT moved
+        loaded = artifact_store.get(name)
+        if loaded is None:
+            return None
+        artifact_version, manifest, arrays = loaded
+        model = self.models.get(name)
+        if model is None or model.artifact_version != artifact_version:
+            data_time = manifest.get("data_time")
+            version = version_at(data_time) if version_at is not None and data_time is not None else None
+            model = model_from_artifact(artifact_version, manifest, arrays, version)
+            self.models[name] = model
+            self.changed(name, model)
+        return model
+
+    def publish(self, name, model):
+        arrays, manifest = model_to_artifact(model)
+        version = artifact_store.save(name, arrays, manifest)
+        artifact_store.prune(name)
+        # Force the next get() to pick the new version up immediately
+        artifact_store.checked_at.pop(name, None)
+        return version
+
+    def clear(self):
+        self.models.clear()
+
+factor_models = FactorModelCache()
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from sqlalchemy import case, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from feed_store import feed_store, generation_of
+from models import DynamicItem, DynamicItemPriority
+from persistence import replace_user_feed
+
+# Items taken per user and type, best priority first
+FEED_LIMITS = {"activity": 6, "recommendation": 2, "ad": 1}
+
+# Feed layout: groups of 3 activities, each followed by 1 recommendation, with
+# 1 ad after every second group (the first group gets the first ad)
+ACTIVITIES_PER_GROUP = 3
+GROUPS_PER_AD = 2
+
+def ranked_items_query(limits=FEED_LIMITS, user_ids=None):
+    rank = func.row_number().over(
+        partition_by=(DynamicItemPriority.user_id, DynamicItem.item_type),
+        order_by=(DynamicItemPriority.priority_score.desc(), DynamicItemPriority.item_id),
+    ).label("rank")
+    ranked = (
+        select(DynamicItemPriority.user_id, DynamicItemPriority.item_id, DynamicItem.item_type, rank)
+        .join(DynamicItem, DynamicItem.item_id == DynamicItemPriority.item_id)
+        .where(DynamicItem.item_type.in_(list(limits)))
+    )
+    if user_ids is not None:
+        ranked = ranked.where(DynamicItemPriority.user_id.in_([int(user_id) for user_id in user_ids]))
+    ranked = ranked.subquery()
+    limit = case(*[(ranked.c.item_type == item_type, count) for item_type, count in limits.items()], else_=0)
+    return select(ranked.c.user_id, ranked.c.item_id, ranked.c.item_type, ranked.c.rank).where(ranked.c.rank <= limit)
+
+def interleave(frame):
+    # Assigns each ranked item a (group, slot) place in the layout and drops the
+    # ones that do not fit, for every user at once. Returns the frame ordered
+    # by user and feed position.
+    if frame.empty:
+        return frame.assign(position=pd.Series(dtype=np.int64))
+
+    rank = frame["rank"].to_numpy(dtype=np.int64) - 1
+    is_activity = (frame["item_type"] == "activity").to_numpy()
+    is_recommendation = (frame["item_type"] == "recommendation").to_numpy()
+    is_ad = (frame["item_type"] == "ad").to_numpy()
+
+    group = np.select([is_activity, is_recommendation, is_ad], [rank // ACTIVITIES_PER_GROUP, rank, rank * GROUPS_PER_AD], default=-1)
+    slot = np.select([is_activity, is_recommendation, is_ad], [rank % ACTIVITIES_PER_GROUP, ACTIVITIES_PER_GROUP, ACTIVITIES_PER_GROUP + 1], default=-1)
+    frame = frame.assign(group=group, slot=slot)
+
+    # Recommendations and ads only go into groups that have activities
+    activity_counts = frame[is_activity].groupby("user_id").size()
+    groups = -(-frame["user_id"].map(activity_counts).fillna(0).to_numpy(dtype=np.int64) // ACTIVITIES_PER_GROUP)
+    frame = frame[(frame["group"].to_numpy() >= 0) & (frame["group"].to_numpy() < groups)]
+
+    frame = frame.sort_values(["user_id", "group", "slot"], kind="stable")
+    frame["position"] = frame.groupby("user_id").cumcount()
+    return frame.drop(columns=["group", "slot"])
+
+async def build_user_feeds(db: AsyncSession, limits=FEED_LIMITS, user_ids=None):
+    result = await db.execute(ranked_items_query(limits, user_ids))
+    frame = pd.DataFrame(result.all(), columns=["user_id", "item_id", "item_type", "rank"])
+    feed = interleave(frame)
+
+    # Users left without items lose their previous feed too
+    now = datetime.utcnow()
+    await replace_user_feed(db, user_ids, feed["user_id"].to_numpy(), feed["item_id"].to_numpy(), feed["position"].to_numpy(), now)
+    # GET /feed reads the same layout from the feed store
+    await feed_store.publish(db, feed, generation_of(now), user_ids)
+    return feed
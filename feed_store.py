@@ -0,0 +1,220 @@
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from config import FEED_PAGE_SIZE, FEED_STORE_BACKEND, FEED_STORE_MAX_ITEMS, FEED_STORE_MAX_USERS, FEED_STORE_REDIS_URL, FEED_STORE_TTL_SECONDS
+from metrics import REGISTRY, Counter
+from models import DynamicItem, DynamicUserFeed
+from response_cache import MemoryBackend
+
+FEED_STORE_REQUESTS = REGISTRY.register(Counter('pe_feed_store_requests_total', 'Feed page reads by result (hit, miss)', ['result']))
+
+# Item ids per IN (...) when loading item documents
+ITEM_BATCH_SIZE = 1000
+
+EPOCH = datetime(1970, 1, 1)
+
+class InvalidCursor(ValueError):
+    pass
+
+def generation_of(timestamp):
+    # Every feed of one build shares a generation: the build time in ms
+    return (timestamp - EPOCH) // timedelta(milliseconds=1)
+
+def encode_cursor(generation, offset):
+    return base64.urlsafe_b64encode(f"{generation}:{offset}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        generation, offset = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        generation, offset = int(generation), int(offset)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor("Invalid feed cursor") from e
+    if offset < 0:
+        raise InvalidCursor("Invalid feed cursor")
+    return generation, offset
+
+def item_document(item_id, item_type, content, created_at):
+    return {"item_id": item_id, "item_type": item_type, "content": content, "created_at": created_at.isoformat() if created_at is not None else None}
+
+class MemoryFeedBackend:
+    # Item ids as int64 arrays per user and item documents, each an LRU with
+    # the feed store TTL
+
+    def __init__(self, max_users=FEED_STORE_MAX_USERS, max_items=FEED_STORE_MAX_ITEMS, ttl=FEED_STORE_TTL_SECONDS):
+        self.feeds = MemoryBackend(max_users, ttl)
+        self.items = MemoryBackend(max_items, ttl)
+
+    async def get_page(self, user_id, offset, limit):
+        entry = await self.feeds.get(user_id)
+        if entry is None:
+            return None
+        generation, item_ids = entry
+        return generation, item_ids[offset:offset + limit].tolist(), len(item_ids)
+
+    async def set_feeds(self, feeds):
+        for user_id, (generation, item_ids) in feeds.items():
+            await self.feeds.set(user_id, (generation, np.asarray(item_ids, dtype=np.int64)))
+
+    async def get_items(self, item_ids):
+        items = {}
+        for item_id in item_ids:
+            item = await self.items.get(item_id)
+            if item is not None:
+                items[item_id] = item
+        return items
+
+    async def set_items(self, items):
+        for item_id, item in items.items():
+            await self.items.set(item_id, item)
+
+    async def clear(self):
+        await self.feeds.clear()
+        await self.items.clear()
+
+class RedisFeedBackend:
+    # feed:{user_id} is the generation followed by the item ids, all packed
+    # little-endian int64, so a page is one GETRANGE whatever the feed length.
+    # Item documents are JSON fields of one hash.
+
+    def __init__(self, url=FEED_STORE_REDIS_URL, namespace="pe_feed:"):
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("FEED_STORE_BACKEND=redis requires the redis package") from e
+        self.client = redis.from_url(url)
+        self.namespace = namespace
+
+    def feed_key(self, user_id):
+        return f"{self.namespace}feed:{user_id}"
+
+    async def get_page(self, user_id, offset, limit):
+        key = self.feed_key(user_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.getrange(key, 0, 7)
+            pipe.getrange(key, 8 * (offset + 1), 8 * (offset + limit + 1) - 1)
+            pipe.strlen(key)
+            header, page, length = await pipe.execute()
+        if not length:
+            return None
+        generation = int(np.frombuffer(header, dtype='<i8')[0])
+        return generation, np.frombuffer(page, dtype='<i8').tolist(), length // 8 - 1
+
+    async def set_feeds(self, feeds):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for user_id, (generation, item_ids) in feeds.items():
+                pipe.set(self.feed_key(user_id), np.append(generation, item_ids).astype('<i8').tobytes())
+            await pipe.execute()
+
+    async def get_items(self, item_ids):
+        if not item_ids:
+            return {}
+        values = await self.client.hmget(f"{self.namespace}items", item_ids)
+        return {item_id: json.loads(value) for item_id, value in zip(item_ids, values) if value is not None}
+
+    async def set_items(self, items):
+        if items:
+            await self.client.hset(f"{self.namespace}items", mapping={item_id: json.dumps(item) for item_id, item in items.items()})
+
+    async def clear(self):
+        keys = [key async for key in self.client.scan_iter(match=self.namespace + "*")]
+        if keys:
+            await self.client.delete(*keys)
+
+BACKENDS = {"memory": MemoryFeedBackend, "redis": RedisFeedBackend}
+
+class FeedStore:
+    # Precomputed feeds (ordered item ids per user) plus a shared cache of item
+    # documents. build_user_feeds publishes every feed it builds; a user missing
+    # from the store is read once from dynamic_user_feed and cached. Cursors
+    # carry the feed generation and offset; a cursor from an older build
+    # restarts at the top of the current feed.
+
+    def __init__(self, backend=FEED_STORE_BACKEND):
+        self.backend_name = backend
+        self.backend = None
+
+    def get_backend(self):
+        if self.backend is None:
+            if self.backend_name not in BACKENDS:
+                raise ValueError(f"Unknown feed store backend: {self.backend_name}")
+            self.backend = BACKENDS[self.backend_name]()
+        return self.backend
+
+    async def publish(self, db: AsyncSession, feed, generation, user_ids=None):
+        # feed is ordered by user and position (feed.interleave); users in
+        # user_ids without any row get an empty feed
+        users = feed["user_id"].to_numpy(dtype=np.int64)
+        item_ids = feed["item_id"].to_numpy(dtype=np.int64)
+        users, starts = np.unique(users, return_index=True)
+        feeds = {user_id: (generation, ids) for user_id, ids in zip(users.tolist(), np.split(item_ids, starts[1:]))}
+        for user_id in user_ids if user_ids is not None else ():
+            feeds.setdefault(int(user_id), (generation, np.empty(0, dtype=np.int64)))
+        await self.get_backend().set_feeds(feeds)
+        # Item documents may have changed since they were cached
+        await self.get_backend().set_items(await load_items(db, np.unique(item_ids).tolist()))
+        return len(feeds)
+
+    async def page(self, db: AsyncSession, user_id, cursor=None, limit=FEED_PAGE_SIZE):
+        generation, offset = decode_cursor(cursor) if cursor else (None, 0)
+        backend = self.get_backend()
+        page = await backend.get_page(user_id, offset, limit)
+        if page is None:
+            FEED_STORE_REQUESTS.inc(result="miss")
+            current, item_ids = await load_feed(db, user_id)
+            await backend.set_feeds({user_id: (current, item_ids)})
+            page = current, item_ids[offset:offset + limit].tolist(), len(item_ids)
+        else:
+            FEED_STORE_REQUESTS.inc(result="hit")
+
+        current, page_item_ids, total = page
+        restarted = generation is not None and generation != current
+        if restarted:
+            offset = 0
+            current, page_item_ids, total = await backend.get_page(user_id, offset, limit)
+
+        items = await backend.get_items(page_item_ids)
+        missing = [item_id for item_id in page_item_ids if item_id not in items]
+        if missing:
+            loaded = await load_items(db, missing)
+            await backend.set_items(loaded)
+            items.update(loaded)
+
+        end = offset + len(page_item_ids)
+        return {
+            "items": [items[item_id] for item_id in page_item_ids if item_id in items],
+            "next_cursor": encode_cursor(current, end) if end < total else None,
+            "restarted": restarted,
+        }
+
+    async def clear(self):
+        await self.get_backend().clear()
+
+async def load_items(db: AsyncSession, item_ids):
+    items = {}
+    for start in range(0, len(item_ids), ITEM_BATCH_SIZE):
+        result = await db.execute(
+            select(DynamicItem.item_id, DynamicItem.item_type, DynamicItem.content, DynamicItem.created_at)
+            .where(DynamicItem.item_id.in_(item_ids[start:start + ITEM_BATCH_SIZE]))
+        )
+        items.update({row.item_id: item_document(*row) for row in result.all()})
+    return items
+
+async def load_feed(db: AsyncSession, user_id):
+    # (generation, item ids) of the user's latest build in dynamic_user_feed;
+    # a build replaces all of the user's rows, so they share one feed_timestamp
+    result = await db.execute(
+        select(DynamicUserFeed.item_id, DynamicUserFeed.feed_timestamp)
+        .where(DynamicUserFeed.user_id == user_id)
+        .order_by(DynamicUserFeed.position, DynamicUserFeed.item_id)
+    )
+    rows = result.all()
+    if not rows:
+        return 0, np.empty(0, dtype=np.int64)
+    newest = max(row.feed_timestamp for row in rows)
+    return generation_of(newest), np.array([row.item_id for row in rows], dtype=np.int64)
+
+feed_store = FeedStore()
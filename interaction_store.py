@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from aggregation import AGGREGATES, fetch_aggregate
+from config import INTERACTION_STORE_CHANGE_LOG_SIZE, INTERACTION_STORE_COMPACT_ROWS, INTERACTION_STORE_REFRESH_SECONDS
+from data_processing import FETCH_COLUMNS, build_frame, fetch_data
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# Primary key and change-tracking timestamp columns for each table in FETCH_COLUMNS
+# and each aggregate in AGGREGATES
+WATERMARK_COLUMNS = {
+    "activity": ("id", ["timestamp"]),
+    "comment": ("id", ["created_at", "updated_at"]),
+    "favorite": ("id", ["timestamp"]),
+    "follow": ("follow_id", ["timestamp"]),
+    "game_session": ("game_session_id", ["created_at", "updated_at"]),
+    "playlist_session": ("session_id", ["created_at", "updated_at"]),
+    "playlist_user_activity": ("playlist_user_activity_id", ["created_at", "updated_at"]),
+    # No timestamp columns, so reviews are re-read in full on every refresh
+    "review": ("id", []),
+    # GROUP BY aggregates from aggregation.AGGREGATES, keyed by their group columns
+    "game_session_totals": (("user_id", "game_id"), ["created_at", "updated_at"]),
+    "activity_counts": (("user_id", "target_id"), ["timestamp"]),
+}
+
+def key_index(frame, key):
+    # Index over a primary key column, or over several group columns
+    if isinstance(key, str):
+        return pd.Index(frame[key])
+    return pd.MultiIndex.from_frame(frame[list(key)])
+
+def changed_user_ids(frame):
+    if 'user_id' not in frame.columns:
+        return None
+    return pd.unique(frame['user_id'].dropna().to_numpy(dtype=np.int64))
+
+def user_rows(data, user_ids=None):
+    # Restricts each frame to the rows of user_ids; None keeps everything
+    if user_ids is None:
+        return data
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    return {
+        table: frame[frame['user_id'].isin(user_ids)] if 'user_id' in frame.columns else frame.iloc[:0]
+        for table, frame in data.items()
+    }
+
+def row_digest(frame):
+    # Order-independent digest of a frame's rows: the sum of per-row hashes
+    # mod 2^64, so it can be updated by adding and subtracting changed rows
+    if frame.empty:
+        return 0
+    return int(pd.util.hash_pandas_object(frame, index=False).to_numpy(dtype=np.uint64).sum(dtype=np.uint64))
+
+def latest_timestamp(frame, timestamp_columns):
+    latest = None
+    for column in timestamp_columns:
+        if column not in frame.columns:
+            continue
+        value = frame[column].max()
+        if pd.notna(value) and (latest is None or value > latest):
+            latest = value
+    return latest.to_pydatetime() if latest is not None else None
+
+class InteractionStore:
+    # Process-resident copy of the interaction tables. Tables are loaded in full
+    # once, then only rows stamped at or past the stored watermark are re-read
+    # and upserted by primary key. Deleted rows are not tracked; call reset()
+    # to force a full reload.
+
+    def __init__(self, refresh_interval=INTERACTION_STORE_REFRESH_SECONDS, change_log_size=INTERACTION_STORE_CHANGE_LOG_SIZE, compact_rows=INTERACTION_STORE_COMPACT_ROWS):
+        self.refresh_interval = refresh_interval
+        self.change_log_size = change_log_size
+        self.compact_rows = compact_rows
+        self.frames = {}
+        # Upserted rows not merged into frames yet, one row per key, and a key
+        # index over each frame; an upsert costs the size of the change, and
+        # the full frame is rebuilt only when it is read or pending grows large
+        self.pending = {}
+        self.indexes = {}
+        self.watermarks = {}
+        self.refreshed_at = {}
+        # Bumped whenever a table's frame changes; lets derived models be cached
+        self.versions = {}
+        # table -> {version: user ids whose rows changed in that version}, so
+        # models can fold in the changed users instead of refitting
+        self.changes = {}
+        # table -> {version: wall time of the bump}, to line local versions up
+        # with model artifacts fitted in other processes
+        self.bumped_at = {}
+        # table -> {version: row digest}. Versions are counters local to this
+        # process; the digest names the same data in every process that read it.
+        self.digests = {}
+        self.lock = asyncio.Lock()
+
+    def reset(self):
+        self.frames.clear()
+        self.pending.clear()
+        self.indexes.clear()
+        self.watermarks.clear()
+        self.refreshed_at.clear()
+        self.changes.clear()
+        self.bumped_at.clear()
+        self.digests.clear()
+
+    def version(self, tables):
+        return tuple(self.versions.get(table, 0) for table in tables)
+
+    def data_key(self, tables, version=None):
+        # Identifies the data of tables at `version` (default: the current one)
+        # across processes, or None once that version left the change log
+        if version is None:
+            version = self.version(tables)
+        digests = []
+        for table, table_version in zip(tables, version):
+            digest = self.digests.get(table, {}).get(table_version)
+            if digest is None:
+                return None
+            digests.append(f"{digest:016x}")
+        return ".".join(digests)
+
+    def version_at(self, tables, timestamp):
+        # Version of tables that data read up to wall time `timestamp` in
+        # another process is sure to include: that process may have served
+        # frames up to refresh_interval old, so only bumps before that count.
+        # Bumps trimmed from the change log count as 0, which changed_users
+        # reports as unknown.
+        cutoff = timestamp - self.refresh_interval
+        return tuple(max((version for version, at in self.bumped_at.get(table, {}).items() if at <= cutoff), default=0) for table in tables)
+
+    def changed_users(self, tables, since):
+        # User ids whose rows in tables changed after the version tuple `since`,
+        # or None when the change log does not cover the whole span (a full
+        # load happened, the log was trimmed, or the table has no user_id)
+        changed = []
+        for table, since_version in zip(tables, since):
+            log = self.changes.get(table, {})
+            for version in range(since_version + 1, self.versions.get(table, 0) + 1):
+                if log.get(version) is None:
+                    return None
+                changed.append(log[version])
+        if not changed:
+            return np.empty(0, dtype=np.int64)
+        return pd.unique(np.concatenate(changed))
+
+    def bump(self, table, changed, digest):
+        version = self.versions.get(table, 0) + 1
+        self.versions[table] = version
+        log = self.changes.setdefault(table, {})
+        log[version] = changed_user_ids(changed) if changed is not None else None
+        bumped_at = self.bumped_at.setdefault(table, {})
+        bumped_at[version] = time.time()
+        digests = self.digests.setdefault(table, {})
+        digests[version] = digest
+        for old in [old for old in log if old <= version - self.change_log_size]:
+            del log[old]
+            bumped_at.pop(old, None)
+            digests.pop(old, None)
+
+    def digest(self, table):
+        return self.digests.get(table, {}).get(self.versions.get(table, 0), 0)
+
+    def upsert(self, table, changed):
+        key, _ = WATERMARK_COLUMNS[table]
+        changed_keys = key_index(changed, key)
+        pending = self.pending.get(table)
+        if pending is None:
+            pending = changed.iloc[:0]
+        pending_keys = key_index(pending, key)
+        # Rows re-read at the watermark usually match the stored copy; those are
+        # not a change and must not publish a new version
+        in_pending = changed_keys.isin(pending_keys)
+        stored = [pending[pending_keys.isin(changed_keys)]]
+        positions = self.key_index(table).get_indexer_for(changed_keys[~in_pending])
+        stored.append(self.frames[table].iloc[positions[positions >= 0]])
+        stored = pd.concat(stored, ignore_index=True)
+        if len(stored):
+            changed = pd.concat([changed, stored, stored], ignore_index=True).drop_duplicates(keep=False)
+            if changed.empty:
+                return
+            changed_keys = key_index(changed, key)
+            stored = stored[key_index(stored, key).isin(changed_keys)]
+        self.pending[table] = pd.concat([pending[~pending_keys.isin(changed_keys)], changed], ignore_index=True)
+        self.bump(table, changed, (self.digest(table) + row_digest(changed) - row_digest(stored)) % 2 ** 64)
+        if len(self.pending[table]) >= self.compact_rows:
+            self.compact(table)
+
+    def key_index(self, table):
+        if table not in self.indexes:
+            key, _ = WATERMARK_COLUMNS[table]
+            self.indexes[table] = key_index(self.frames[table], key)
+        return self.indexes[table]
+
+    def compact(self, table):
+        # Merges pending rows into the table's frame, replacing the rows they update
+        pending = self.pending.pop(table, None)
+        if pending is None:
+            return
+        key, _ = WATERMARK_COLUMNS[table]
+        existing = self.frames[table]
+        existing = existing[~self.key_index(table).isin(key_index(pending, key))]
+        self.frames[table] = pd.concat([existing, pending], ignore_index=True)
+        self.indexes.pop(table, None)
+
+    def frame(self, table):
+        self.compact(table)
+        return self.frames[table]
+
+    def apply(self, table, rows):
+        # Applies rows the service itself just wrote (e.g. a rating) without
+        # waiting for the next refresh; rows are tuples in FETCH_COLUMNS order.
+        # Tables that are not loaded yet pick the rows up when bootstrapped.
+        if table not in self.frames:
+            return
+        model, names = FETCH_COLUMNS[table]
+        self.upsert(table, build_frame(rows, model, names))
+
+    async def get_data(self, db: AsyncSession, tables=None):
+        # tables may name raw tables (FETCH_COLUMNS) and aggregates (AGGREGATES)
+        tables = list(FETCH_COLUMNS if tables is None else tables)
+        await self.refresh(db, tables)
+        return {table: self.frame(table) for table in tables}
+
+    async def refresh(self, db: AsyncSession, tables=None, force=False):
+        tables = list(FETCH_COLUMNS if tables is None else tables)
+        async with self.lock:
+            missing = [table for table in tables if table not in self.frames]
+            if missing:
+                await self._bootstrap(db, missing)
+
+            now = time.monotonic()
+            for table in tables:
+                if table in missing:
+                    continue
+                if not force and now - self.refreshed_at.get(table, 0) < self.refresh_interval:
+                    continue
+                await self._refresh_table(db, table)
+
+    async def _bootstrap(self, db: AsyncSession, tables):
+        raw_tables = [table for table in tables if table in FETCH_COLUMNS]
+        data = await fetch_data(db, tables=raw_tables, concurrent=True) if raw_tables else {}
+        for table in tables:
+            if table in AGGREGATES:
+                data[table] = await fetch_aggregate(db, table)
+        now = time.monotonic()
+        for table, frame in data.items():
+            _, timestamp_columns = WATERMARK_COLUMNS[table]
+            self.frames[table] = frame
+            self.pending.pop(table, None)
+            self.indexes.pop(table, None)
+            # A full load is not logged as a change; models built before it refit
+            self.bump(table, None, row_digest(frame))
+            self.watermarks[table] = latest_timestamp(frame, timestamp_columns)
+            self.refreshed_at[table] = now
+            logger.info("Interaction store loaded %s rows of %s", len(frame), table)
+
+    async def _refresh_table(self, db: AsyncSession, table):
+        _, timestamp_columns = WATERMARK_COLUMNS[table]
+        watermark = self.watermarks.get(table)
+        if table in AGGREGATES:
+            # Groups with rows at or past the watermark come back re-aggregated in full
+            changed = await fetch_aggregate(db, table, since=watermark)
+            self.refreshed_at[table] = time.monotonic()
+            if not changed.empty:
+                self.upsert(table, changed)
+                self.advance_watermark(table, changed, watermark)
+            return
+
+        model, names = FETCH_COLUMNS[table]
+        query = select(*[getattr(model, name) for name in names])
+        if watermark is not None:
+            # >= rather than > so rows sharing the watermark timestamp but
+            # committed after the last refresh are not missed; the upsert below
+            # makes re-reading them harmless
+            query = query.where(or_(*[getattr(model, column) >= watermark for column in timestamp_columns]))
+
+        with span("fetch"):
+            result = await db.execute(query)
+            changed = build_frame(result.all(), model, names)
+        self.refreshed_at[table] = time.monotonic()
+        if changed.empty:
+            return
+        if not timestamp_columns:
+            # Untracked tables are re-read in full; only publish a new version on change
+            previous = self.frame(table)
+            if not changed.equals(previous):
+                # Rows present in only one of the two reads are the changed ones
+                difference = pd.concat([previous, changed]).drop_duplicates(keep=False)
+                self.frames[table] = changed
+                self.indexes.pop(table, None)
+                self.bump(table, difference, row_digest(changed))
+            return
+
+        self.upsert(table, changed)
+        self.advance_watermark(table, changed, watermark)
+
+    def advance_watermark(self, table, changed, watermark):
+        _, timestamp_columns = WATERMARK_COLUMNS[table]
+        latest = latest_timestamp(changed, timestamp_columns)
+        if latest is not None and (watermark is None or latest > watermark):
+            self.watermarks[table] = latest
+
+interaction_store = InteractionStore()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from config import JOB_HISTORY_SIZE, JOB_SCHEDULE_SECONDS
+from db import SessionLocal
+from metrics import JOB_STAGE_SECONDS
+from pipelines import PIPELINES
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+
+class Job:
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.key = job_key(kind, params)
+        self.status = "queued"
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self.stages = []
+        self.result = None
+        self.error = None
+        self.task = None
+
+    @contextmanager
+    def stage(self, name):
+        # Records wall time per pipeline stage; a stage that raises is marked failed
+        entry = {"name": name, "status": "running", "started_at": datetime.utcnow().isoformat(), "seconds": None}
+        self.stages.append(entry)
+        start = time.perf_counter()
+        try:
+            yield entry
+            entry["status"] = "succeeded"
+        except BaseException:
+            entry["status"] = "failed"
+            raise
+        finally:
+            entry["seconds"] = round(time.perf_counter() - start, 6)
+            JOB_STAGE_SECONDS.observe(entry["seconds"], kind=self.kind, stage=name, status=entry["status"])
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "seconds": (self.finished_at - self.started_at).total_seconds() if self.started_at and self.finished_at else None,
+            "stages": self.stages,
+            "result": self.result,
+            "error": self.error,
+        }
+
+def job_key(kind, params):
+    return (kind,) + tuple(sorted(params.items()))
+
+class JobRunner:
+    # Runs pipeline jobs as asyncio tasks in this process. A job submitted while
+    # an identical one (same kind and params) is queued or running is not
+    # started again; the caller gets the existing job. Finished jobs are kept
+    # for status lookups up to history_size.
+
+    def __init__(self, pipelines=PIPELINES, session_factory=SessionLocal, history_size=JOB_HISTORY_SIZE):
+        self.pipelines = pipelines
+        self.session_factory = session_factory
+        self.history_size = history_size
+        self.jobs = OrderedDict()
+        self.active = {}
+        self.tasks = set()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def submit(self, kind, **params):
+        # Returns (job, created)
+        if kind not in self.pipelines:
+            raise ValueError(f"Unknown job kind: {kind}")
+        key = job_key(kind, params)
+        job = self.active.get(key)
+        if job is not None:
+            return job, False
+
+        job = Job(kind, params)
+        self.jobs[job.id] = job
+        self.active[key] = job
+        self.prune()
+        job.task = asyncio.get_running_loop().create_task(self.run(job))
+        self.tasks.add(job.task)
+        job.task.add_done_callback(self.tasks.discard)
+        return job, True
+
+    async def run(self, job):
+        job.status = "running"
+        job.started_at = datetime.utcnow()
+        try:
+            async with self.session_factory() as db:
+                job.result = await self.pipelines[job.kind](db, stage=job.stage, **job.params)
+            job.status = "succeeded"
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job.id, job.kind)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.utcnow()
+            self.active.pop(job.key, None)
+        return job
+
+    async def run_now(self, kind, **params):
+        # Runs a job inline, e.g. from a Celery task; still de-duplicated
+        job, _ = self.submit(kind, **params)
+        return await asyncio.shield(job.task)
+
+    def prune(self):
+        while len(self.jobs) > self.history_size:
+            job_id, job = next(iter(self.jobs.items()))
+            if job.status in ACTIVE_STATUSES:
+                break
+            del self.jobs[job_id]
+
+    async def schedule(self, kind, interval, **params):
+        while True:
+            await asyncio.sleep(interval)
+            job, created = self.submit(kind, **params)
+            if not created:
+                logger.info("Scheduled %s skipped, job %s still %s", kind, job.id, job.status)
+
+    def start_scheduler(self, kind="recompute", interval=JOB_SCHEDULE_SECONDS, **params):
+        if not interval or interval <= 0:
+            return None
+        task = asyncio.get_running_loop().create_task(self.schedule(kind, interval, **params))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def shutdown(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+job_runner = JobRunner()
@@ -1,15 +1,35 @@
 import logging
+import time
 import pandas as pd
 import numpy as np
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select 
-from db import get_db
-from models import User, UserPersona, DynamicItem, DynamicItemPriority, DynamicUserFeed, Activity, PlaylistSession
+from db import engine, get_db
+from models import User, UserPersona, DynamicItem, DynamicItemPriority, DynamicUserFeed, Activity, PlaylistSession, Review
 from pydantic import BaseModel
-from celery_config import make_celery
-from recommendation import fetch_recommendations
-from data_processing import fetch_data, normalize, svd_reconstruct
+from config import AGGREGATION_ROLLUP_REFRESH_SECONDS, AGGREGATION_ROLLUPS, FEED_PAGE_MAX_SIZE, FEED_PAGE_SIZE, RECOMMENDATION_BATCH_MAX_K, RECOMMENDATION_BATCH_MAX_USERS
+from recommendation import fetch_recommendations, fetch_recommendations_batch, get_game_model
+from data_processing import FETCH_COLUMNS, fetch_data, normalize, svd_reconstruct
+from functools import partial
+from interaction_store import interaction_store, user_rows
+from compute import ComputeTimeoutError, compute_executor
+from factor_model import factor_models
+from matrices import build_interaction_matrix
+from persistence import dialect_insert
+from priority import populate_priorities
+from feed import build_user_feeds
+from export import EXPORT_FORMATS, prepare_export
+from feed_store import InvalidCursor, feed_store
+from jobs import job_runner
+from migrations import migrate
+from metrics import REGISTRY, observe_request, request_metrics, sampled
+from personas import build_personas, get_persona
+from response_cache import response_cache
+from pipelines import get_playlist_model, update_playlist_recommendations
+from similarity import similarity_indexes
+from social import games_from_follows, get_social_graph
 from fastapi.encoders import jsonable_encoder
 from recommendation import fetch_recommendations_for_all_users
 
@@ -22,32 +42,189 @@ def convert_numpy_types(obj):
 
 logger = logging.getLogger(__name__)
 app = FastAPI()
-# celery = make_celery(app)
 
-# celery.conf.beat_schedule = {
-#     'update-recommendations-every-night': {
-#         'task': 'celery_config.update_recommendations',
-#         'schedule': crontab(hour=0, minute=0),
-#     },
-# }
+@app.exception_handler(ComputeTimeoutError)
+async def compute_timeout_handler(request: Request, exc: ComputeTimeoutError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Latency plus SQL count/time per route template, not per raw path
+    with request_metrics() as stats:
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = request.scope.get("route")
+            observe_request(request.method, route.path if route is not None else "unmatched", status, time.perf_counter() - start, stats)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.on_event("startup")
+async def migrate_schema():
+    await migrate(engine)
+
+@app.on_event("startup")
+async def start_job_scheduler():
+    job_runner.start_scheduler()
+    if AGGREGATION_ROLLUPS:
+        # Rollups are read as of the last run; the first one fills rebuilt tables
+        job_runner.submit("rollups")
+        job_runner.start_scheduler("rollups", AGGREGATION_ROLLUP_REFRESH_SECONDS)
+
+@app.on_event("shutdown")
+async def shutdown_compute_executor():
+    job_runner.shutdown()
+    compute_executor.shutdown()
 
 class RateGameRequest(BaseModel):
     user_id: int
     game_id: int
     rating: int
 
+@app.post("/rate_game")
+async def rate_game(request: RateGameRequest, db: AsyncSession = Depends(get_db)):
+    if not 0 <= request.rating <= 5:
+        raise HTTPException(status_code=422, detail="rating must be between 0 and 5")
+    await update_rating(request.user_id, request.game_id, request.rating, db)
+    # Folds the user's updated row into the cached game model (item factors
+    # stay fixed); a full refit only runs once the fold-in thresholds are crossed
+    model = await get_game_model(db)
+    return {"message": "Rating received", "model_drift": model.drift}
+
+async def cached_response(endpoint, user_id, model, compute, if_none_match=None, tables=()):
+    # Serves the body computed from this exact model version and the current
+    # data of any other tables the handler reads, computing it at most once per
+    # version; a matching If-None-Match gets a 304
+    version = response_cache.version(endpoint, model, tables)
+    etag = response_cache.not_modified(endpoint, user_id, version, if_none_match)
+    if etag is not None:
+        return Response(status_code=304, headers={"ETag": etag})
+    body, etag, hit = await response_cache.get_or_compute(endpoint, user_id, version, compute)
+    return JSONResponse(content=body, headers={"ETag": etag, "X-Cache": "hit" if hit else "miss"})
+
+# Per (user, game) session totals and per (user, target) activity counts are
+# GROUP BY queries (see aggregation.py); only one row per pair is loaded
+ENGAGEMENT_SIGNAL_TABLES = ['game_session_totals', 'activity_counts']
+PLAY_TIME_SIGNAL_TABLES = ['game_session_totals']
+
+response_cache.depends_on("playlist_recommendations", "game_play_time", PLAY_TIME_SIGNAL_TABLES)
+response_cache.depends_on("recommendations", "game_engagement", ENGAGEMENT_SIGNAL_TABLES)
+
+# Everything fetch_playlist_recommendations reads besides the play time model
+PLAYLIST_RECOMMENDATION_TABLES = ['game_session_totals', 'favorite', 'comment', 'playlist_session']
+
+# /recommendations/{user_id} returns every user's top 10, so one copy serves all of them
+ALL_USERS = "all"
+
 @app.post("/fetch_playlist_recommendations/{user_id}")
-async def fetch_playlist_recommendations_endpoint(user_id: int, db: AsyncSession = Depends(get_db)):
-    try:
+async def fetch_playlist_recommendations_endpoint(user_id: int, db: AsyncSession = Depends(get_db), if_none_match: str = Header(None)):
+    async def compute():
         game_recommendations, playlist_recommendations = await fetch_playlist_recommendations(user_id, db)
-        return {"game_recommendations": game_recommendations, "playlist_recommendations": playlist_recommendations}
+        return jsonable_encoder({"game_recommendations": game_recommendations, "playlist_recommendations": playlist_recommendations})
+
+    try:
+        model = await get_play_time_model(db)
+        await interaction_store.refresh(db, PLAYLIST_RECOMMENDATION_TABLES)
+        return await cached_response("playlist_recommendations", user_id, model, compute, if_none_match, tables=PLAYLIST_RECOMMENDATION_TABLES)
+    except ComputeTimeoutError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/recommendations/{user_id}")
-async def get_recommendations(user_id: int, db: AsyncSession = Depends(get_db)):
-    recommendations = await fetch_recommendations(user_id, db)
-    return {"recommendations": recommendations}
+async def get_recommendations(user_id: int, db: AsyncSession = Depends(get_db), if_none_match: str = Header(None)):
+    async def compute():
+        return jsonable_encoder({"recommendations": await fetch_recommendations(user_id, db)})
+
+    return await cached_response("recommendations", ALL_USERS, await get_engagement_model(db), compute, if_none_match)
+
+class BatchRecommendationsRequest(BaseModel):
+    user_ids: list[int]
+    k: int = 10
+    exclude_seen: bool = False
+
+@app.post("/recommendations/batch")
+async def batch_recommendations_endpoint(request: BatchRecommendationsRequest, db: AsyncSession = Depends(get_db)):
+    # Top-k games for every user in one scoring pass over the game model;
+    # users it does not know are listed in unknown_user_ids
+    if not request.user_ids:
+        raise HTTPException(status_code=422, detail="user_ids must not be empty")
+    if len(request.user_ids) > RECOMMENDATION_BATCH_MAX_USERS:
+        raise HTTPException(status_code=422, detail=f"at most {RECOMMENDATION_BATCH_MAX_USERS} user_ids per batch")
+    if not 1 <= request.k <= RECOMMENDATION_BATCH_MAX_K:
+        raise HTTPException(status_code=422, detail=f"k must be between 1 and {RECOMMENDATION_BATCH_MAX_K}")
+    recommendations, unknown = await fetch_recommendations_batch(db, request.user_ids, request.k, request.exclude_seen)
+    return {
+        "k": request.k,
+        "recommendations": [{"user_id": user_id, "recommendations": items} for user_id, items in recommendations.items()],
+        "unknown_user_ids": unknown,
+    }
+
+@app.get("/export/recommendations")
+async def export_recommendations_endpoint(format: str = "ndjson", k: int = 10, exclude_seen: bool = False, db: AsyncSession = Depends(get_db)):
+    # Every user's top-k, streamed block by block as NDJSON, an Arrow IPC
+    # stream or Parquet; see export.py for the CLI
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=422, detail=f"format must be one of {', '.join(sorted(EXPORT_FORMATS))}")
+    if not 1 <= k <= RECOMMENDATION_BATCH_MAX_K:
+        raise HTTPException(status_code=422, detail=f"k must be between 1 and {RECOMMENDATION_BATCH_MAX_K}")
+    media_type, encoder_class = EXPORT_FORMATS[format]
+    try:
+        encoder = encoder_class()
+    except RuntimeError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    export = await prepare_export(db, k, exclude_seen)
+    return StreamingResponse(export.chunks(encoder), media_type=media_type)
+
+@app.get("/similar/{game_id}")
+async def similar_games_endpoint(game_id: int, k: int = 10, db: AsyncSession = Depends(get_db)):
+    model = await get_game_model(db)
+    index = await compute_executor.run_in_thread(similarity_indexes.get, 'game', model)
+    similar = await compute_executor.run_in_thread(index.similar, game_id, k)
+    if similar is None:
+        raise HTTPException(status_code=404, detail="Game not found in the recommendation model")
+    return {"game_id": game_id, "similar": [{"game_id": item_id, "score": score} for item_id, score in similar]}
+
+@app.get("/similar_playlists/{playlist_id}")
+async def similar_playlists_endpoint(playlist_id: int, k: int = 10, db: AsyncSession = Depends(get_db)):
+    model = await get_playlist_model(db)
+    index = await compute_executor.run_in_thread(similarity_indexes.get, 'playlist', model)
+    similar = await compute_executor.run_in_thread(index.similar, playlist_id, k)
+    if similar is None:
+        raise HTTPException(status_code=404, detail="Playlist not found in the recommendation model")
+    return {"playlist_id": playlist_id, "similar": [{"playlist_id": item_id, "score": score} for item_id, score in similar]}
+
+@app.get("/social/{user_id}")
+async def social_endpoint(user_id: int, k: int = 10, db: AsyncSession = Depends(get_db)):
+    graph, _ = await get_social_graph(db)
+    friends_of_friends = await compute_executor.run_in_thread(graph.friends_of_friends, user_id, k)
+    influence = await compute_executor.run_in_thread(graph.influence, [user_id])
+    games = await games_from_follows(db, user_id, k)
+    return {
+        "user_id": user_id,
+        "influence": float(influence[0]),
+        "friends_of_friends": [{"user_id": candidate, "mutual": mutual} for candidate, mutual in friends_of_friends],
+        "games_from_follows": [{"game_id": game_id, "share": share} for game_id, share in games],
+    }
+
+@app.get("/persona/{user_id}")
+async def get_persona_endpoint(user_id: int, db: AsyncSession = Depends(get_db)):
+    persona = await get_persona(db, user_id)
+    if persona is None:
+        raise HTTPException(status_code=404, detail="Persona not found")
+    return {"user_id": user_id, "persona": persona.persona, "last_updated": persona.last_updated}
+
+@app.post("/build_personas")
+async def build_personas_endpoint(full: bool = False, db: AsyncSession = Depends(get_db)):
+    # Only users with new events since their persona was built, unless full
+    written = await build_personas(db, full=full)
+    return {"message": "User personas built", "personas": written}
 
 @app.post("/populate_dynamic_items")
 async def populate_items_endpoint(db: AsyncSession = Depends(get_db)):
@@ -55,9 +232,20 @@ async def populate_items_endpoint(db: AsyncSession = Depends(get_db)):
     return {"message": "Dynamic items populated"}
 
 @app.post("/populate_dynamic_item_priority")
-async def populate_priority_endpoint(db: AsyncSession = Depends(get_db)):
-    await populate_dynamic_item_priority(db)
-    return {"message": "Dynamic item priorities populated"}
+async def populate_priority_endpoint(top_n: int = None, db: AsyncSession = Depends(get_db)):
+    written = await populate_dynamic_item_priority(db, top_n=top_n)
+    return {"message": "Dynamic item priorities populated", "priorities": written}
+
+@app.get("/feed/{user_id}")
+async def feed_endpoint(user_id: int, cursor: str = None, limit: int = FEED_PAGE_SIZE, db: AsyncSession = Depends(get_db)):
+    # Pages of the user's precomputed feed; next_cursor is null on the last page
+    if not 1 <= limit <= FEED_PAGE_MAX_SIZE:
+        raise HTTPException(status_code=422, detail=f"limit must be between 1 and {FEED_PAGE_MAX_SIZE}")
+    try:
+        page = await feed_store.page(db, user_id, cursor, limit)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"user_id": user_id, **page})
 
 @app.post("/generate_user_feed")
 async def generate_feed_endpoint(db: AsyncSession = Depends(get_db)):
@@ -69,81 +257,83 @@ async def update_playlist_recommendations_endpoint(db: AsyncSession = Depends(ge
     try:
         await update_playlist_recommendations(db)
         return {"message": "Playlist recommendations updated successfully."}
+    except ComputeTimeoutError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def fetch_recommendations(user_id: int, db: AsyncSession):
-    data = await fetch_data(db)
-    
-    # Log the structure of each DataFrame
-    logger.info("Data fetched: %s", data.keys())
-    logger.info("Game session columns: %s", data['game_session'].columns)
-    logger.info("Activity columns: %s", data['activity'].columns)
-
-    # Check if 'user_id' and 'game_id' columns exist in each DataFrame
-    if 'user_id' not in data['game_session'].columns or 'game_id' not in data['game_session'].columns:
-        logger.error("'user_id' or 'game_id' column missing in game_session DataFrame")
-        return []
-
-    if data['activity'].empty or 'user_id' not in data['activity'].columns or 'target_id' not in data['activity'].columns:
-        logger.warning("'user_id' or 'target_id' column missing in activity DataFrame or the DataFrame is empty")
-        activity_df = pd.DataFrame(columns=['user_id', 'target_id', 'engagement'])
-    else:
-        activity_df = data['activity'].groupby(['user_id', 'target_id']).agg({
-            'timestamp': 'count'
-        }).reset_index().rename(columns={'timestamp': 'engagement'})
-
-    # Aggregate data to ensure unique index and column combinations
-    game_session_df = data['game_session'].groupby(['user_id', 'game_id']).agg({
-        'session_total_time': 'sum',
-        'session_total_score': 'mean'
-    }).reset_index()
-
-    logger.info("Aggregated game session data: %s", game_session_df.head())
-    logger.info("Aggregated activity data: %s", activity_df.head())
-
-    # Convert Timedelta to seconds
-    if 'session_total_time' in game_session_df.columns:
-        game_session_df['session_total_time'] = game_session_df['session_total_time'].dt.total_seconds()
-
-    # Ensure all matrices have the same shape
-    user_ids = list(set(game_session_df['user_id']).union(activity_df['user_id']))
-    game_ids = list(set(game_session_df['game_id']).union(activity_df['target_id']))
-
-    play_count_matrix = game_session_df.pivot(index='user_id', columns='game_id', values='session_total_time').reindex(index=user_ids, columns=game_ids, fill_value=0).values
-    engagement_matrix = activity_df.pivot(index='user_id', columns='target_id', values='engagement').reindex(index=user_ids, columns=game_ids, fill_value=0).values
-
-    normalized_play_count = normalize(play_count_matrix)
-    normalized_engagement = normalize(engagement_matrix)
-
-    reconstructed_play_count = svd_reconstruct(normalized_play_count)
-    reconstructed_engagement = svd_reconstruct(normalized_engagement)
-
-    if reconstructed_play_count.size == 0:
-        reconstructed_play_count = np.zeros_like(reconstructed_engagement)
-    if reconstructed_engagement.size == 0:
-        reconstructed_engagement = np.zeros_like(reconstructed_play_count)
+@app.post("/jobs/recompute", status_code=202)
+async def recompute_job_endpoint():
+    job, created = job_runner.submit("recompute")
+    return {"job_id": job.id, "status": job.status, "created": created}
+
+@app.post("/jobs/recompute/{user_id}", status_code=202)
+async def recompute_user_job_endpoint(user_id: int):
+    job, created = job_runner.submit("recompute_user", user_id=user_id)
+    return {"job_id": job.id, "status": job.status, "created": created}
+
+@app.post("/jobs/personas", status_code=202)
+async def personas_job_endpoint(full: bool = False):
+    job, created = job_runner.submit("personas", full=full)
+    return {"job_id": job.id, "status": job.status, "created": created}
+
+@app.get("/jobs/{job_id}")
+async def job_status_endpoint(job_id: str):
+    job = job_runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+def build_engagement_signals(data, user_ids=None):
+    data = user_rows(data, user_ids)
+    if sampled():
+        logger.info("Aggregated game session data: %s", data['game_session_totals'].head())
+        logger.info("Aggregated activity data: %s", data['activity_counts'].head())
 
     weights = [0.5, 0.5]  # Adjust weights accordingly
-    combined_matrix = (weights[0] * reconstructed_play_count + weights[1] * reconstructed_engagement)
+    return [
+        # Session seconds are heavy-tailed, so they are log-scaled before the row max
+        ('play_time', build_interaction_matrix(data['game_session_totals'], 'user_id', 'game_id', value='play_seconds'), weights[0], 'log'),
+        ('engagement', build_interaction_matrix(data['activity_counts'], 'user_id', 'target_id', value='engagement'), weights[1]),
+    ]
+
+async def get_engagement_model(db: AsyncSession):
+    data = await interaction_store.get_data(db, tables=ENGAGEMENT_SIGNAL_TABLES)
+    return await factor_models.get_or_fit(
+        'game_engagement', interaction_store.version(ENGAGEMENT_SIGNAL_TABLES), partial(build_engagement_signals, data),
+        changed_users=partial(interaction_store.changed_users, ENGAGEMENT_SIGNAL_TABLES),
+        version_at=partial(interaction_store.version_at, ENGAGEMENT_SIGNAL_TABLES),
+    )
+
+async def fetch_recommendations(user_id: int, db: AsyncSession):
+    data = await interaction_store.get_data(db, tables=ENGAGEMENT_SIGNAL_TABLES)
 
-    recommendations = []
-    for i, user in enumerate(user_ids):
-        user_recommendations = combined_matrix[i]
-        top_games = user_recommendations.argsort()[::-1][:10]  # Get top 10 recommendations
-        for game_id in top_games:
-            recommendations.append({"user_id": user, "game_id": game_ids[game_id]})
+    if sampled():
+        logger.info("Aggregated rows: %s", {table: len(frame) for table, frame in data.items()})
 
-    return recommendations
+    model = await get_engagement_model(db)
+    user_ids = model.user_ids
+    game_ids = model.item_ids
+
+    # Get top 10 recommendations for every user, scored in blocks
+    user_indices, game_indices, _ = await compute_executor.run_in_thread(model.top_k, 10)
+    return [{"user_id": int(user), "game_id": int(game)} for user, game in zip(user_ids[user_indices].tolist(), game_ids[game_indices].tolist())]
 
 async def update_rating(user_id: int, game_id: int, rating: int, db: AsyncSession):
-    await db.execute(
-        "INSERT INTO reviews (user_id, game_id, rating) VALUES (:user_id, :game_id, :rating) "
-        "ON CONFLICT (user_id, game_id) DO UPDATE SET rating = :rating",
-        {'user_id': user_id, 'game_id': game_id, 'rating': rating}
-    )
+    statement = dialect_insert(db, Review).values(user_id=user_id, game_id=game_id, rating=rating)
+    if hasattr(statement, 'on_conflict_do_update'):
+        statement = statement.on_conflict_do_update(
+            index_elements=[Review.user_id, Review.game_id],
+            set_={"rating": statement.excluded.rating},
+        )
+    _, names = FETCH_COLUMNS['review']
+    result = await db.execute(statement.returning(*[getattr(Review, name) for name in names]))
+    rows = result.all()
     await db.commit()
 
+    # Make the rating visible to the models now rather than after the next store refresh
+    interaction_store.apply('review', rows)
+
 async def populate_dynamic_items(db: AsyncSession):
     # Fetch activities
     activities = await db.execute(select(Activity))
@@ -162,122 +352,50 @@ async def populate_dynamic_items(db: AsyncSession):
         db.add(new_item)
     await db.commit()
 
-async def populate_dynamic_item_priority(db: AsyncSession):
-    items = await db.execute(select(DynamicItem))
-    items = items.scalars().all()
-    users = await db.execute(select(User))
-    users = users.scalars().all()
-    
-    for item in items:
-        for user in users:
-            # Calculate priority score (example calculation)
-            priority_score = calculate_priority(item, user)
-            new_priority = DynamicItemPriority(item_id=item.item_id, user_id=user.id, priority_score=priority_score)
-            db.add(new_priority)
+async def populate_dynamic_item_priority(db: AsyncSession, top_n: int = None):
+    # Scores every (item, user) pair as array operations in user chunks and
+    # bulk-upserts the results; top_n keeps only each user's best items
+    written = await populate_priorities(db, top_n=top_n)
     await db.commit()
-
-def calculate_priority(item, user):
-    # Example priority calculation logic
-    if item.item_type == "activity":
-        return 10
-    elif item.item_type == "recommendation":
-        return 5
-    elif item.item_type == "ad":
-        return 1
-    return 0
+    return written
 
 async def generate_user_feed(db: AsyncSession):
-    users = await db.execute(select(User))
-    users = users.scalars().all()
-    
-    for user in users:
-        feed_items = await generate_feed_for_user(user.id, db)
-        for item in feed_items:
-            new_feed = DynamicUserFeed(user_id=user.id, item_id=item.item_id, feed_timestamp=datetime.utcnow())
-            db.add(new_feed)
+    # Ranks every user's items per type in one windowed query, interleaves
+    # 3 activities / 1 recommendation / 1 ad for all users at once and
+    # replaces dynamic_user_feed
+    feed = await build_user_feeds(db)
     await db.commit()
-
-async def generate_feed_for_user(user_id, db):
-    activities = await db.execute(
-        select(DynamicItem).where(DynamicItem.item_type == "activity").order_by(desc(DynamicItemPriority.priority_score)).limit(6)
-    )
-    activities = activities.scalars().all()
-    
-    recommendations = await db.execute(
-        select(DynamicItem).where(DynamicItem.item_type == "recommendation").order_by(desc(DynamicItemPriority.priority_score)).limit(2)
-    )
-    recommendations = recommendations.scalars().all()
-    
-    ads = await db.execute(
-        select(DynamicItem).where(DynamicItem.item_type == "ad").order_by(desc(DynamicItemPriority.priority_score)).limit(1)
+    return feed
+
+def build_play_time_signals(data, user_ids=None):
+    data = user_rows(data, user_ids)
+    return [
+        ('play_time', build_interaction_matrix(data['game_session_totals'], 'user_id', 'game_id', value='play_seconds'), 1.0, 'log'),
+    ]
+
+async def get_play_time_model(db: AsyncSession):
+    data = await interaction_store.get_data(db, tables=PLAY_TIME_SIGNAL_TABLES)
+    return await factor_models.get_or_fit(
+        'game_play_time', interaction_store.version(PLAY_TIME_SIGNAL_TABLES), partial(build_play_time_signals, data),
+        changed_users=partial(interaction_store.changed_users, PLAY_TIME_SIGNAL_TABLES),
+        version_at=partial(interaction_store.version_at, PLAY_TIME_SIGNAL_TABLES),
     )
-    ads = ads.scalars().all()
-    
-    # Example combining logic: 3 activities, 1 recommendation, 1 ad
-    feed_items = []
-    for i in range(0, len(activities), 3):
-        feed_items.extend(activities[i:i+3])
-        if recommendations:
-            feed_items.append(recommendations.pop(0))
-        if ads and i % 6 == 0:  # Add an ad every 6 activities
-            feed_items.append(ads.pop(0))
-    
-    return feed_items
-
-async def update_playlist_recommendations(db: AsyncSession):
-    data = await fetch_data(db)
-
-    playlist_play_count_matrix = data['playlist_session'].pivot(index='user_id', columns='playlist_id', values='completed').fillna(0).values
-
-    # Normalize and apply SVD to the matrix
-    normalized_play_count = normalize(playlist_play_count_matrix)
-    reconstructed_play_count = svd_reconstruct(normalized_play_count)
-
-    # Generate recommendations based on reconstructed play counts
-    recommendations = []
-    user_ids = data['playlist_session']['user_id'].unique()
-    playlist_ids = data['playlist_session']['playlist_id'].unique()
-
-    for user_index, user_id in enumerate(user_ids):
-        user_recommendations = []
-        for playlist_index, playlist_id in enumerate(playlist_ids):
-            score = reconstructed_play_count[user_index, playlist_index]
-            user_recommendations.append((user_id, playlist_id, score))
-        user_recommendations.sort(key=lambda x: x[2], reverse=True)
-        recommendations.extend(user_recommendations[:5])  # Get top 5 recommendations for each user
-
-    # Insert recommendations into dynamic_item and dynamic_item_priority tables
-    for rec in recommendations:
-        user_id, playlist_id, score = rec
-        dynamic_item = DynamicItem(item_type='playlist_recommendation', content={"playlist_id": playlist_id})
-        db.add(dynamic_item)
-        await db.flush()  # Flush to get the primary key of the dynamic_item
-
-        dynamic_item_priority = DynamicItemPriority(item_id=dynamic_item.item_id, user_id=user_id, priority_score=score)
-        db.add(dynamic_item_priority)
-
-    await db.commit()
 
 async def fetch_playlist_recommendations(user_id, db: AsyncSession):
-    data = await fetch_data(db)
-
-    # Debug print statements
-    print("Fetched data from the database")
-    print("Data keys:", data.keys())
+    data = await interaction_store.get_data(db, tables=PLAYLIST_RECOMMENDATION_TABLES)
 
     try:
-        # Check if 'user_id' and 'game_id' columns exist
-        for key in data:
-            print(f"Columns in {key}:", data[key].columns)
+        if sampled():
+            logger.info("Playlist recommendation inputs for user %s: %s", user_id, {key: len(frame) for key, frame in data.items()})
 
-        if 'user_id' not in data['game_session'].columns or 'game_id' not in data['game_session'].columns:
-            raise ValueError("'user_id' or 'game_id' column missing in game_session DataFrame")
+        if 'user_id' not in data['game_session_totals'].columns or 'game_id' not in data['game_session_totals'].columns:
+            raise ValueError("'user_id' or 'game_id' column missing in game_session_totals DataFrame")
         if 'user_id' not in data['favorite'].columns or 'game_id' not in data['favorite'].columns:
             raise ValueError("'user_id' or 'game_id' column missing in favorite DataFrame")
         if 'user_id' not in data['comment'].columns or 'game_id' not in data['comment'].columns:
             raise ValueError("'user_id' or 'game_id' column missing in comment DataFrame")
 
-        user_game_sessions = data['game_session'][data['game_session']['user_id'] == user_id]
+        user_game_sessions = data['game_session_totals'][data['game_session_totals']['user_id'] == user_id]
         user_favorites = data['favorite'][data['favorite']['user_id'] == user_id]
         user_comments = data['comment'][data['comment']['user_id'] == user_id]
 
@@ -285,69 +403,32 @@ async def fetch_playlist_recommendations(user_id, db: AsyncSession):
         if 'user_id' in data['playlist_session'].columns and 'playlist_id' in data['playlist_session'].columns:
             user_playlist_sessions = data['playlist_session'][(data['playlist_session']['user_id'] == user_id) & (data['playlist_session']['completed'] == True)]
 
-        # Debug print statements
-        print("User game sessions:", user_game_sessions)
-        print("User favorites:", user_favorites)
-        print("User comments:", user_comments)
-        print("User playlist sessions:", user_playlist_sessions)
-
         relevant_playlists = []
         if not user_playlist_sessions.empty:
             relevant_playlists = user_playlist_sessions['playlist_id'].unique()
 
         relevant_games = pd.concat([user_game_sessions['game_id'], user_favorites['game_id'], user_comments['game_id']]).unique()
 
-        # Debugging relevant games and playlists
-        print("Relevant games:", relevant_games)
-        print("Relevant playlists:", relevant_playlists)
-
-        # Aggregate game_session data to ensure uniqueness
-        game_session_agg = data['game_session'].groupby(['user_id', 'game_id']).agg({'session_total_time': 'sum'}).reset_index()
-
-        # Convert Timedelta to total seconds
-        game_session_agg['session_total_time'] = game_session_agg['session_total_time'].dt.total_seconds()
-
-        # Debugging aggregated data
-        print("Aggregated game session data:", game_session_agg)
-
-        # Pivot the aggregated data
-        game_matrix = game_session_agg.pivot(index='user_id', columns='game_id', values='session_total_time').fillna(0).values
-
-        # Debugging matrix shapes after pivot
-        print("Game session matrix shape after pivot:", game_matrix.shape)
+        if sampled():
+            logger.info("Relevant games: %s, relevant playlists: %s", list(relevant_games), list(relevant_playlists))
 
-        normalized_game_matrix = normalize(game_matrix)
+        model = await get_play_time_model(db)
 
-        # Debugging normalized matrix shapes
-        print("Normalized game matrix shape:", normalized_game_matrix.shape)
-
-        reconstructed_game_matrix = svd_reconstruct(normalized_game_matrix)
-
-        # Debugging reconstructed matrix shapes
-        print("Reconstructed game matrix shape:", reconstructed_game_matrix.shape)
-
-        game_recommendations = []
         playlist_recommendations = []
-        user_indices = game_session_agg['user_id'].unique()
-        game_ids = game_session_agg['game_id'].unique()
-        playlist_ids = data['playlist_session']['playlist_id'].unique() if 'playlist_id' in data['playlist_session'].columns else []
+        user_index = model.user_index(user_id)
 
-        if user_id in user_indices:
-            user_index = np.where(user_indices == user_id)[0][0]
-
-            for game_index, game_id in enumerate(game_ids):
-                score = reconstructed_game_matrix[user_index, game_index]
-                game_recommendations.append((user_id, game_id, score))
+        if user_index is not None:
+            _, game_indices, scores = model.top_k(5, user_indices=[user_index])
+            game_recommendations = list(zip([user_id] * len(game_indices), model.item_ids[game_indices], scores))
 
             # Ensure relevant playlists are handled properly
             if len(relevant_playlists) > 0:
                 for playlist_id in relevant_playlists:
                     playlist_recommendations.append((user_id, playlist_id, 1))  # Arbitrary score since we're just identifying relevance
 
-            game_recommendations.sort(key=lambda x: x[2], reverse=True)
             playlist_recommendations.sort(key=lambda x: x[2], reverse=True)
 
-            top_game_recommendations = game_recommendations[:5]
+            top_game_recommendations = game_recommendations
             top_playlist_recommendations = playlist_recommendations[:5]
 
             # Convert numpy types to Python types
@@ -358,60 +439,5 @@ async def fetch_playlist_recommendations(user_id, db: AsyncSession):
         else:
             return [], []
     except Exception as e:
-        print(f"Error during recommendation computation: {e}")
+        logger.exception("Error during recommendation computation: %s", e)
         raise
-
-
-# @app.post("/rate_game")
-# async def rate_game(request: RateGameRequest, db: AsyncSession = Depends(get_db)):
-#     await update_rating(request.user_id, request.game_id, request.rating, db)
-#     update_recommendations_for_user.delay(request.user_id)
-#     return {"message": "Rating received"}
-
-# @celery.task
-# def update_recommendations_for_user(user_id: int):
-#     from db import SessionLocal
-#     from recommendation import fetch_recommendations
-
-#     async def update_user_recommendations():
-#         async with SessionLocal() as session:
-#             recommendations = await fetch_recommendations(user_id, session)
-#             await session.execute(
-#                 "DELETE FROM dynamic_user_feed WHERE user_id = :user_id",
-#                 {'user_id': user_id}
-#             )
-#             for item in recommendations:
-#                 await session.execute(
-#                     "INSERT INTO dynamic_user_feed (user_id, item_id, feed_timestamp) VALUES (:user_id, :item_id, NOW())",
-#                     {'user_id': user_id, 'item_id': item['item_id']}
-#                 )
-#             await session.commit()
-
-#     import asyncio
-#     asyncio.run(update_user_recommendations())
-
-# @celery.task
-# def update_recommendations():
-#     from db import SessionLocal
-#     from models import User
-#     from recommendation import fetch_recommendations
-
-#     async def update_all_user_recommendations():
-#         async with SessionLocal() as session:
-#             result = await session.execute("SELECT id FROM users")
-#             user_ids = result.scalars().all()
-#             for user_id in user_ids:
-#                 recommendations = await fetch_recommendations(user_id, session)
-#                 await session.execute(
-#                     "DELETE FROM dynamic_user_feed WHERE user_id = :user_id",
-#                     {'user_id': user_id}
-#                 )
-#                 for item in recommendations:
-#                     await session.execute(
-#                         "INSERT INTO dynamic_user_feed (user_id, item_id, feed_timestamp) VALUES (:user_id, :item_id, NOW())",
-#                         {'user_id': user_id, 'item_id': item['item_id']}
-#                     )
-#             await session.commit()
-
-#     import asyncio
-#     asyncio.run(update_all_user_recommendations())
\ No newline at end of file
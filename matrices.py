@@ -0,0 +1,245 @@
+import threading
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+from metrics import span, timed
+
+class IndexMap:
+    # Bidirectional id <-> matrix index map. Indices are assigned in first-seen
+    # order and never reassigned, so an id keeps its row/column across rebuilds.
+
+    def __init__(self, ids=None):
+        self.ids = np.empty(0, dtype=np.int64)
+        self._index = pd.Index(self.ids)
+        if ids is not None:
+            self.add(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self._index
+
+    def add(self, ids):
+        ids = pd.unique(np.asarray(ids, dtype=np.int64).ravel())
+        new_ids = ids[self._index.get_indexer(ids) == -1]
+        if len(new_ids):
+            self.ids = np.concatenate([self.ids, new_ids])
+            self._index = pd.Index(self.ids)
+        return self
+
+    def to_index(self, ids):
+        # -1 for ids that are not in the map
+        return self._index.get_indexer(np.asarray(ids, dtype=np.int64).ravel())
+
+    def index_of(self, id):
+        index = self.to_index([id])[0]
+        return None if index == -1 else int(index)
+
+    def to_id(self, indices):
+        return self.ids[np.asarray(indices)]
+
+# Guards the shared maps when matrices are built from executor threads
+MAP_LOCK = threading.Lock()
+
+# Process-wide maps shared by every matrix so that row/column indices agree
+# across signals and across requests
+ID_MAPS = {
+    "user": IndexMap(),
+    "game": IndexMap(),
+    "playlist": IndexMap(),
+}
+
+def id_map(name):
+    return ID_MAPS[name]
+
+class InteractionMatrix:
+    # CSR matrix whose rows and columns are addressed through IndexMaps
+
+    def __init__(self, matrix, row_map, col_map):
+        self.matrix = matrix
+        self.row_map = row_map
+        self.col_map = col_map
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def with_matrix(self, matrix):
+        return InteractionMatrix(matrix, self.row_map, self.col_map)
+
+    def resize(self, shape=None):
+        # Grow to cover ids added to the maps after this matrix was built
+        if shape is None:
+            with MAP_LOCK:
+                shape = (len(self.row_map), len(self.col_map))
+        if self.matrix.shape != shape:
+            self.matrix.resize(shape)
+        return self
+
+    def reindex(self, row_map, col_map):
+        # The same entries addressed through other maps, e.g. the private maps
+        # of a model loaded from an artifact; ids missing from them are added
+        if row_map is self.row_map and col_map is self.col_map:
+            return self
+        entries = self.matrix.tocoo()
+        row_ids, col_ids = self.row_map.to_id(entries.row), self.col_map.to_id(entries.col)
+        with MAP_LOCK:
+            row_map.add(row_ids)
+            col_map.add(col_ids)
+            rows, cols = row_map.to_index(row_ids), col_map.to_index(col_ids)
+            shape = (len(row_map), len(col_map))
+        return InteractionMatrix(csr_matrix((entries.data, (rows, cols)), shape=shape), row_map, col_map)
+
+    def row(self, row_id):
+        index = self.row_map.index_of(row_id)
+        if index is None:
+            return None
+        return self.matrix[index].toarray().ravel()
+
+def interaction_values(frame, value):
+    if value is None:
+        return np.ones(len(frame), dtype=np.float32)
+    values = frame[value]
+    if pd.api.types.is_timedelta64_dtype(values):
+        values = values.dt.total_seconds()
+    return pd.to_numeric(values, errors='coerce').fillna(0).to_numpy(dtype=np.float32)
+
+@timed("pivot")
+def build_interaction_matrix(frame, row, col, value=None, row_map="user", col_map="game", agg="sum", dtype=np.float32):
+    # value=None counts rows per (row, col) pair. Duplicate pairs are summed by
+    # the COO -> CSR conversion; any other agg is applied with a groupby first.
+    row_map = id_map(row_map) if isinstance(row_map, str) else row_map
+    col_map = id_map(col_map) if isinstance(col_map, str) else col_map
+
+    if frame.empty or row not in frame.columns or col not in frame.columns:
+        frame = pd.DataFrame({row: pd.Series(dtype=np.int64), col: pd.Series(dtype=np.int64)})
+    frame = frame.dropna(subset=[row, col])
+
+    values = interaction_values(frame, value)
+    if agg != "sum":
+        with span("aggregate"):
+            grouped = pd.DataFrame({row: frame[row].to_numpy(), col: frame[col].to_numpy(), "value": values})
+            grouped = grouped.groupby([row, col], sort=False)["value"].agg(agg).reset_index()
+            frame, values = grouped, grouped["value"].to_numpy(dtype=np.float32)
+
+    with MAP_LOCK:
+        row_map.add(frame[row].to_numpy())
+        col_map.add(frame[col].to_numpy())
+        rows = row_map.to_index(frame[row].to_numpy())
+        cols = col_map.to_index(frame[col].to_numpy())
+        shape = (len(row_map), len(col_map))
+
+    matrix = coo_matrix((values.astype(dtype), (rows, cols)), shape=shape).tocsr()
+    matrix.sum_duplicates()
+    return InteractionMatrix(matrix, row_map, col_map)
+
+# Pending (row, col, value) entries merged into the accumulated CSR at a time
+ACCUMULATOR_COMPACT_SIZE = 1_000_000
+
+def reduce_max(rows, cols, values, shape, dtype=np.float32):
+    # CSR keeping the largest value of each duplicated (row, col) pair
+    keys = rows.astype(np.int64) * shape[1] + cols
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    unique_keys, starts = np.unique(keys, return_index=True)
+    maxima = np.maximum.reduceat(values, starts) if len(starts) else values[:0]
+    return csr_matrix((maxima.astype(dtype), (unique_keys // shape[1], unique_keys % shape[1])), shape=shape)
+
+class MatrixAccumulator:
+    # Incremental build_interaction_matrix over chunks of rows (see
+    # data_processing.stream_matrices). Each chunk is reduced to index arrays
+    # and the chunk itself is not kept; pending entries are merged into the
+    # CSR every ACCUMULATOR_COMPACT_SIZE entries, so memory follows the number
+    # of distinct pairs, not the number of rows. agg is "sum" or "max".
+
+    def __init__(self, row, col, value=None, row_map="user", col_map="game", agg="sum", where=None, compact_size=ACCUMULATOR_COMPACT_SIZE, dtype=np.float32):
+        if agg not in ("sum", "max"):
+            raise ValueError(f"Unsupported accumulator aggregation: {agg}")
+        self.row = row
+        self.col = col
+        self.value = value
+        self.row_map = id_map(row_map) if isinstance(row_map, str) else row_map
+        self.col_map = id_map(col_map) if isinstance(col_map, str) else col_map
+        self.agg = agg
+        # Optional frame -> boolean mask applied to each chunk
+        self.where = where
+        self.compact_size = compact_size
+        self.dtype = dtype
+        self.matrix = None
+        self.pending = []
+        self.pending_size = 0
+        self.rows_seen = 0
+
+    def add(self, frame):
+        if self.where is not None:
+            frame = frame[self.where(frame)]
+        frame = frame.dropna(subset=[self.row, self.col])
+        if frame.empty:
+            return self
+        values = interaction_values(frame, self.value)
+        with MAP_LOCK:
+            self.row_map.add(frame[self.row].to_numpy())
+            self.col_map.add(frame[self.col].to_numpy())
+            rows = self.row_map.to_index(frame[self.row].to_numpy())
+            cols = self.col_map.to_index(frame[self.col].to_numpy())
+        # int32 indices and dtype values: pending entries are the bulk of the memory
+        self.pending.append((rows.astype(np.int32), cols.astype(np.int32), np.asarray(values, dtype=self.dtype)))
+        self.pending_size += len(rows)
+        self.rows_seen += len(rows)
+        if self.pending_size >= self.compact_size:
+            self.compact()
+        return self
+
+    def compact(self):
+        with MAP_LOCK:
+            shape = (len(self.row_map), len(self.col_map))
+        parts = self.pending
+        if self.matrix is not None:
+            self.matrix.resize(shape)
+            existing = self.matrix.tocoo()
+            parts = [(existing.row, existing.col, existing.data)] + parts
+        if parts:
+            rows, cols, values = (np.concatenate(arrays) for arrays in zip(*parts))
+            if self.agg == "max":
+                self.matrix = reduce_max(rows, cols, values, shape, self.dtype)
+            else:
+                self.matrix = coo_matrix((values.astype(self.dtype), (rows, cols)), shape=shape).tocsr()
+                self.matrix.sum_duplicates()
+        self.pending = []
+        self.pending_size = 0
+        return self
+
+    def result(self):
+        self.compact()
+        if self.matrix is None:
+            with MAP_LOCK:
+                self.matrix = csr_matrix((len(self.row_map), len(self.col_map)), dtype=self.dtype)
+        return InteractionMatrix(self.matrix, self.row_map, self.col_map)
+
+class CountAccumulator:
+    # frame.groupby(columns).size() over streamed chunks, for per-user volumes
+    # that are not (row, col) matrices; memory follows the number of distinct keys
+    def __init__(self, columns, where=None):
+        self.columns = list(columns)
+        self.where = where
+        self.counts = None
+
+    def add(self, frame):
+        if self.where is not None:
+            frame = frame[self.where(frame)]
+        counts = frame.groupby(self.columns, observed=True).size()
+        self.counts = counts if self.counts is None else self.counts.add(counts, fill_value=0)
+        return self
+
+    def result(self):
+        if self.counts is None:
+            return pd.Series(dtype=np.int64)
+        return self.counts.astype(np.int64)
+
+def align_matrices(*matrices):
+    # Matrices built one after another can lag behind ids added by the later
+    # ones; pad them all to the current map sizes
+    with MAP_LOCK:
+        shapes = [(len(matrix.row_map), len(matrix.col_map)) for matrix in matrices]
+    return [matrix.resize(shape) for matrix, shape in zip(matrices, shapes)]
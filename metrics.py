@@ -0,0 +1,225 @@
+import contextvars
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+from config import METRICS_SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets in seconds, shared by stage, query and request timings
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    # Minimal Prometheus metric: one value (or bucket set) per label tuple,
+    # updated under a lock since stages also run on executor threads
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        # One sample per label tuple; metrics with several series per tuple
+        # (Histogram) override this
+        return [(self.name, self.label_text(key), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            self.values[key] = counts, total + value
+
+    def samples(self):
+        samples = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self.label_text(key, [("le", format_value(bound))]), cumulative))
+            samples.append((f"{self.name}_sum", self.label_text(key), total))
+            samples.append((f"{self.name}_count", self.label_text(key), cumulative))
+        return samples
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram('pe_stage_seconds', 'Wall time of recommendation stages (fetch, aggregate, pivot, normalize, svd, rank, persist)', ['stage']))
+JOB_STAGE_SECONDS = REGISTRY.register(Histogram('pe_job_stage_seconds', 'Wall time of background job stages', ['kind', 'stage', 'status']))
+DB_QUERY_SECONDS = REGISTRY.register(Histogram('pe_db_query_seconds', 'SQL statement execution time', ['operation']))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram('pe_http_request_seconds', 'HTTP request latency', ['method', 'route', 'status']))
+HTTP_REQUEST_QUERIES = REGISTRY.register(Histogram('pe_http_request_db_queries', 'SQL statements executed per HTTP request', ['route'], buckets=QUERY_COUNT_BUCKETS))
+HTTP_REQUEST_QUERY_SECONDS = REGISTRY.register(Histogram('pe_http_request_db_seconds', 'SQL time spent per HTTP request', ['route']))
+MATRIX_ROWS = REGISTRY.register(Gauge('pe_matrix_rows', 'Rows of the last built interaction matrix per signal', ['signal']))
+MATRIX_COLUMNS = REGISTRY.register(Gauge('pe_matrix_columns', 'Columns of the last built interaction matrix per signal', ['signal']))
+MATRIX_NNZ = REGISTRY.register(Gauge('pe_matrix_nnz', 'Stored entries of the last built interaction matrix per signal', ['signal']))
+MATRIX_DENSITY = REGISTRY.register(Gauge('pe_matrix_density', 'nnz / (rows x columns) of the last built interaction matrix per signal', ['signal']))
+
+class RequestStats:
+
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.queries = 0
+        self.query_seconds = 0.0
+
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+def sampled():
+    # Verbose logging is on for a METRICS_SAMPLE_RATE share of requests (and of
+    # calls outside a request); the decision is made once per request
+    stats = _request_stats.get()
+    if stats is not None:
+        return stats.sampled
+    return METRICS_SAMPLE_RATE > 0 and random.random() < METRICS_SAMPLE_RATE
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        if sampled():
+            logger.info("Stage %s took %.6fs", stage, elapsed)
+
+def timed(stage):
+    # Decorator form of span for plain and async functions
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(stage):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def observe_matrix(signal, matrix):
+    rows, columns = matrix.shape
+    MATRIX_ROWS.set(rows, signal=signal)
+    MATRIX_COLUMNS.set(columns, signal=signal)
+    MATRIX_NNZ.set(int(matrix.nnz), signal=signal)
+    MATRIX_DENSITY.set(matrix.nnz / (rows * columns) if rows and columns else 0.0, signal=signal)
+
+@contextmanager
+def request_metrics():
+    stats = RequestStats(METRICS_SAMPLE_RATE > 0 and random.random() < METRICS_SAMPLE_RATE)
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+def observe_request(method, route, status, seconds, stats):
+    HTTP_REQUEST_SECONDS.observe(seconds, method=method, route=route, status=status)
+    HTTP_REQUEST_QUERIES.observe(stats.queries, route=route)
+    HTTP_REQUEST_QUERY_SECONDS.observe(stats.query_seconds, route=route)
+    if stats.sampled:
+        logger.info("%s %s -> %s in %.6fs, %s queries in %.6fs", method, route, status, seconds, stats.queries, stats.query_seconds)
+
+def instrument_engine(engine):
+    # Times every statement on the engine and attributes it to the current request
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info.get('query_started')
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+        DB_QUERY_SECONDS.observe(elapsed, operation=operation)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += elapsed
+        if sampled():
+            logger.info("SQL %.6fs: %s", elapsed, statement)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_started'):
+            connection.info['query_started'].pop()
+
+    return engine
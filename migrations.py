@@ -0,0 +1,77 @@
+import logging
+from datetime import timedelta
+import pandas as pd
+from sqlalchemy import bindparam, delete, inspect, select, text, update
+from sqlalchemy.exc import DBAPIError
+from aggregation import sync_rollup_tables
+from config import AGGREGATION_ROLLUPS
+from models import DynamicUserFeed
+
+logger = logging.getLogger(__name__)
+
+def table_columns(sync_connection, table):
+    inspector = inspect(sync_connection)
+    if not inspector.has_table(table):
+        return None
+    return {column["name"] for column in inspector.get_columns(table)}
+
+async def add_feed_positions(connection):
+    # dynamic_user_feed used to carry feed order in feed_timestamp: position i
+    # of a build was stamped build time - i ms, and rows of earlier builds
+    # were left behind. Adds the position column and backfills it from that
+    # encoding, dropping the leftover rows the old reader skipped.
+    feed = DynamicUserFeed.__table__
+    if connection.dialect.name == "postgresql":
+        # Workers starting together queue here; the later ones find the column
+        await connection.execute(text(f"LOCK TABLE {feed.name} IN ACCESS EXCLUSIVE MODE"))
+    columns = await connection.run_sync(table_columns, feed.name)
+    if columns is None or "position" in columns:
+        return False
+
+    await connection.execute(text(f"ALTER TABLE {feed.name} ADD COLUMN position INTEGER NOT NULL DEFAULT 0"))
+    result = await connection.execute(select(feed.c.user_id, feed.c.item_id, feed.c.feed_timestamp))
+    rows = pd.DataFrame(result.all(), columns=["user_id", "item_id", "feed_timestamp"])
+    if rows.empty:
+        return True
+
+    rows["feed_timestamp"] = pd.to_datetime(rows["feed_timestamp"])
+    rows = rows.sort_values(["user_id", "feed_timestamp", "item_id"], ascending=[True, False, True])
+    rows["position"] = rows.groupby("user_id").cumcount()
+    newest = rows.groupby("user_id")["feed_timestamp"].transform("max")
+    spaced = newest - rows["feed_timestamp"] == rows["position"] * pd.Timedelta(timedelta(milliseconds=1))
+    # The latest build is the prefix of each user's rows spaced exactly 1 ms apart
+    current = spaced.groupby(rows["user_id"]).cummin()
+
+    leftovers = rows[~current]
+    if len(leftovers):
+        await connection.execute(
+            delete(feed).where(feed.c.user_id == bindparam("b_user_id"), feed.c.item_id == bindparam("b_item_id")),
+            [{"b_user_id": user_id, "b_item_id": item_id} for user_id, item_id in zip(leftovers["user_id"].tolist(), leftovers["item_id"].tolist())],
+        )
+    placed = rows[current & (rows["position"] > 0)]
+    if len(placed):
+        await connection.execute(
+            update(feed).where(feed.c.user_id == bindparam("b_user_id"), feed.c.item_id == bindparam("b_item_id")).values(position=bindparam("b_position")),
+            [
+                {"b_user_id": user_id, "b_item_id": item_id, "b_position": position}
+                for user_id, item_id, position in zip(placed["user_id"].tolist(), placed["item_id"].tolist(), placed["position"].tolist())
+            ],
+        )
+    logger.info("Added dynamic_user_feed.position to %s rows, dropped %s leftover rows", int(current.sum()), len(leftovers))
+    return True
+
+# Applied in order at startup; each step checks the live schema itself and is
+# a no-op once applied
+MIGRATIONS = [add_feed_positions]
+
+async def migrate(engine, rollups=AGGREGATION_ROLLUPS):
+    steps = MIGRATIONS + ([sync_rollup_tables] if rollups else [])
+    for migration in steps:
+        try:
+            async with engine.begin() as connection:
+                await migration(connection)
+        except DBAPIError:
+            # Another worker applied it first (SQLite has no ADD COLUMN IF NOT
+            # EXISTS to wait on); running it again finds it done
+            async with engine.begin() as connection:
+                await migration(connection)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, Text, ForeignKey, TIMESTAMP, JSON, CheckConstraint, UniqueConstraint, Index
+from sqlalchemy import Column, Integer, String, Boolean, Text, Float, ForeignKey, TIMESTAMP, JSON, CheckConstraint, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -178,7 +178,11 @@ class DynamicUserFeed(Base):
     __tablename__ = 'dynamic_user_feed'
     user_id = Column(Integer, primary_key=True)
     item_id = Column(Integer, ForeignKey('dynamic_item.item_id'), primary_key=True)
+    # Build time, shared by every row of one build
     feed_timestamp = Column(TIMESTAMP, nullable=False)
+    # Place in the feed layout, 0 first; added to existing tables by
+    # migrations.add_feed_positions
+    position = Column(Integer, nullable=False, default=0)
     
     dynamic_item = relationship("DynamicItem", back_populates="feeds")
 
@@ -205,3 +209,27 @@ class PlaylistUserActivity(Base):
     created_at = Column(TIMESTAMP, server_default='now()')
     updated_at = Column(TIMESTAMP, server_default='now()')
 
+# Optional rollups maintained by aggregation.refresh_rollup: one row per
+# (user, item) with the GROUP BY totals of the raw table and its latest timestamps.
+# rollup_definition records what each was built by, see aggregation.sync_rollup_tables.
+class RollupDefinition(Base):
+    __tablename__ = 'rollup_definition'
+    name = Column(String(100), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+
+class GameSessionRollup(Base):
+    __tablename__ = 'game_session_rollup'
+    user_id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, primary_key=True)
+    play_seconds = Column(Float, nullable=False)
+    sessions = Column(Integer, nullable=False)
+    score_sum = Column(Float, nullable=False)
+    created_at = Column(TIMESTAMP)
+    updated_at = Column(TIMESTAMP)
+
+class ActivityRollup(Base):
+    __tablename__ = 'activity_rollup'
+    user_id = Column(Integer, primary_key=True)
+    target_id = Column(Integer, primary_key=True)
+    engagement = Column(Integer, nullable=False)
+    timestamp = Column(TIMESTAMP)
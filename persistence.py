@@ -0,0 +1,137 @@
+import json
+from datetime import datetime
+import numpy as np
+from sqlalchemy import delete, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from metrics import timed
+from models import DynamicItem, DynamicItemPriority, DynamicUserFeed, UserPersona
+
+BATCH_SIZE = 1000
+
+# priority_score is an Integer column; float scores are stored scaled by this
+PRIORITY_SCALE = 1000
+
+def dialect_insert(db: AsyncSession, model):
+    # Dialect-specific insert so ON CONFLICT is available where supported
+    dialect = db.bind.dialect.name if db.bind is not None else None
+    if dialect == 'postgresql':
+        return postgresql.insert(model)
+    if dialect == 'sqlite':
+        return sqlite.insert(model)
+    return insert(model)
+
+def content_key(content):
+    return json.dumps(content, sort_keys=True, default=str)
+
+def batches(sequence, size=BATCH_SIZE):
+    for start in range(0, len(sequence), size):
+        yield sequence[start:start + size]
+
+def to_priority_scores(scores):
+    return np.rint(np.asarray(scores, dtype=np.float64) * PRIORITY_SCALE).astype(np.int64)
+
+@timed("persist")
+async def get_or_create_dynamic_items(db: AsyncSession, item_type, contents, batch_size=BATCH_SIZE):
+    # Returns one item_id per entry of contents. Identical contents share one
+    # dynamic_item row, including rows created by earlier runs.
+    keys = [content_key(content) for content in contents]
+
+    existing = await db.execute(select(DynamicItem.item_id, DynamicItem.content).where(DynamicItem.item_type == item_type))
+    item_ids = {content_key(content): item_id for item_id, content in existing.all()}
+
+    missing = {}
+    for key, content in zip(keys, contents):
+        if key not in item_ids and key not in missing:
+            missing[key] = content
+
+    created_at = datetime.utcnow()
+    for batch in batches(list(missing.values()), batch_size):
+        result = await db.execute(
+            insert(DynamicItem).returning(DynamicItem.item_id, DynamicItem.content),
+            [{"item_type": item_type, "content": content, "created_at": created_at} for content in batch],
+        )
+        for item_id, content in result.all():
+            item_ids[content_key(content)] = item_id
+
+    return [item_ids[key] for key in keys]
+
+@timed("persist")
+async def delete_item_priorities(db: AsyncSession, item_type, user_ids, batch_size=BATCH_SIZE):
+    # item_type may be a single type or a list of types
+    item_types = [item_type] if isinstance(item_type, str) else list(item_type)
+    item_ids = select(DynamicItem.item_id).where(DynamicItem.item_type.in_(item_types))
+    for batch in batches(sorted(set(int(user_id) for user_id in user_ids)), batch_size):
+        await db.execute(
+            delete(DynamicItemPriority)
+            .where(DynamicItemPriority.item_id.in_(item_ids))
+            .where(DynamicItemPriority.user_id.in_(batch))
+        )
+
+@timed("persist")
+async def insert_item_priorities(db: AsyncSession, item_ids, user_ids, scores, upsert=True, scaled=True, batch_size=BATCH_SIZE):
+    # Multi-row inserts of (item_id, user_id, priority_score). Duplicate pairs
+    # within the call keep the last score; with upsert, existing rows are updated.
+    priority_scores = to_priority_scores(scores) if scaled else np.asarray(scores, dtype=np.int64)
+    rows = {}
+    for item_id, user_id, score in zip(np.asarray(item_ids).tolist(), np.asarray(user_ids).tolist(), priority_scores.tolist()):
+        rows[(item_id, user_id)] = {"item_id": item_id, "user_id": user_id, "priority_score": score}
+    rows = list(rows.values())
+
+    for batch in batches(rows, batch_size):
+        statement = dialect_insert(db, DynamicItemPriority).values(batch)
+        if upsert and hasattr(statement, 'on_conflict_do_update'):
+            statement = statement.on_conflict_do_update(
+                index_elements=[DynamicItemPriority.item_id, DynamicItemPriority.user_id],
+                set_={"priority_score": statement.excluded.priority_score},
+            )
+        await db.execute(statement)
+    return len(rows)
+
+async def replace_item_priorities(db: AsyncSession, item_type, item_ids, user_ids, scores, batch_size=BATCH_SIZE):
+    # Swap a user's priorities for one item type in a single transaction so
+    # stale recommendations from the previous run do not linger
+    await delete_item_priorities(db, item_type, user_ids, batch_size)
+    return await insert_item_priorities(db, item_ids, user_ids, scores, upsert=False, batch_size=batch_size)
+
+@timed("persist")
+async def delete_user_feed(db: AsyncSession, user_ids=None, batch_size=BATCH_SIZE):
+    # Every user's rows when user_ids is None
+    if user_ids is None:
+        await db.execute(delete(DynamicUserFeed))
+        return
+    for batch in batches(sorted(set(int(user_id) for user_id in user_ids)), batch_size):
+        await db.execute(delete(DynamicUserFeed).where(DynamicUserFeed.user_id.in_(batch)))
+
+@timed("persist")
+async def insert_user_feed(db: AsyncSession, user_ids, item_ids, positions, feed_timestamp, batch_size=BATCH_SIZE):
+    rows = [
+        {"user_id": user_id, "item_id": item_id, "position": position, "feed_timestamp": feed_timestamp}
+        for user_id, item_id, position in zip(np.asarray(user_ids).tolist(), np.asarray(item_ids).tolist(), np.asarray(positions).tolist())
+    ]
+    for batch in batches(rows, batch_size):
+        await db.execute(dialect_insert(db, DynamicUserFeed).values(batch))
+    return len(rows)
+
+async def replace_user_feed(db: AsyncSession, rebuilt_user_ids, user_ids, item_ids, positions, feed_timestamp, batch_size=BATCH_SIZE):
+    # Swap the feeds of rebuilt_user_ids (None: every user) in a single
+    # transaction, so items dropped from a shrinking feed are not served again
+    await delete_user_feed(db, rebuilt_user_ids, batch_size)
+    return await insert_user_feed(db, user_ids, item_ids, positions, feed_timestamp, batch_size)
+
+@timed("persist")
+async def upsert_user_personas(db: AsyncSession, user_ids, personas, last_updated, batch_size=BATCH_SIZE):
+    rows = [
+        {"user_id": user_id, "persona": persona, "last_updated": last_updated}
+        for user_id, persona in zip(np.asarray(user_ids).tolist(), personas)
+    ]
+    for batch in batches(rows, batch_size):
+        statement = dialect_insert(db, UserPersona).values(batch)
+        if hasattr(statement, 'on_conflict_do_update'):
+            statement = statement.on_conflict_do_update(
+                index_elements=[UserPersona.user_id],
+                set_={"persona": statement.excluded.persona, "last_updated": statement.excluded.last_updated},
+            )
+        await db.execute(statement)
+    return len(rows)
@@ -0,0 +1,285 @@
+import numpy as np
+import pandas as pd
+from contextlib import nullcontext
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from compute import compute_executor
+from config import STREAMING_INGESTION
+from data_processing import stream_matrices
+from interaction_store import interaction_store
+from matrices import CountAccumulator, IndexMap, MatrixAccumulator
+from models import GameTag, User, UserPersona
+from persistence import upsert_user_personas
+from recommendation import get_game_model
+from social import get_social_graph
+
+PERSONA_TABLES = ['activity', 'game_session', 'follow']
+# Read in chunks instead of from the interaction store with STREAMING_INGESTION
+PERSONA_STREAMED_COLUMNS = {
+    'activity': ['user_id', 'activity_type', 'timestamp'],
+    'game_session': ['user_id', 'game_id', 'session_total_time', 'created_at', 'updated_at'],
+}
+
+# Width ratio of the session length buckets that streamed p50/p90 are read from
+SESSION_BUCKET_GROWTH = 1.05
+
+# Tags kept per persona, by share of the user's sessions
+PERSONA_TOP_TAGS = 5
+
+# Digits kept for floats stored in the persona JSON
+PERSONA_PRECISION = 4
+
+# (table, user columns, timestamp columns) whose rows make a persona outdated
+PERSONA_EVENTS = [
+    ('activity', ['user_id'], ['timestamp']),
+    ('game_session', ['user_id'], ['created_at', 'updated_at']),
+    ('follow', ['follower_id', 'following_id'], ['timestamp']),
+]
+
+def users_with_events_since(frame, user_columns, timestamp_columns, last_updated):
+    # Users named in rows stamped after that user's persona was last built;
+    # users without a persona count as outdated
+    if frame.empty:
+        return np.empty(0, dtype=np.int64)
+    stamps = frame[timestamp_columns[0]]
+    for column in timestamp_columns[1:]:
+        stamps = stamps.mask(stamps.isna() | (frame[column] > stamps), frame[column])
+    changed = []
+    for column in user_columns:
+        since = pd.Series(last_updated.reindex(frame[column].to_numpy()).to_numpy(), index=frame.index)
+        outdated = since.isna() | (stamps > since)
+        changed.append(frame.loc[outdated, column].dropna().to_numpy(dtype=np.int64))
+    return pd.unique(np.concatenate(changed))
+
+class EventAccumulator:
+    # users_with_events_since over streamed chunks
+    def __init__(self, user_columns, timestamp_columns, last_updated):
+        self.user_columns = user_columns
+        self.timestamp_columns = timestamp_columns
+        self.last_updated = last_updated
+        self.user_ids = np.empty(0, dtype=np.int64)
+
+    def add(self, frame):
+        changed = users_with_events_since(frame, self.user_columns, self.timestamp_columns, self.last_updated)
+        self.user_ids = pd.unique(np.concatenate([self.user_ids, changed]))
+        return self
+
+    def result(self):
+        return self.user_ids
+
+def session_plays(sessions):
+    # (user_id, game_id, plays) rows
+    return sessions.groupby(['user_id', 'game_id']).size().rename('plays').reset_index()
+
+def matrix_plays(plays):
+    # session_plays from a users x games play count InteractionMatrix
+    matrix = plays.matrix.tocoo()
+    return pd.DataFrame({
+        'user_id': plays.row_map.to_id(matrix.row),
+        'game_id': plays.col_map.to_id(matrix.col),
+        'plays': matrix.data.astype(np.int64),
+    })
+
+def tag_features(plays, game_tags, top_tags=PERSONA_TOP_TAGS):
+    # Share of each user's sessions per tag, top tags only
+    if plays.empty or game_tags.empty:
+        return pd.Series(dtype=object)
+    tagged = plays.merge(game_tags, on='game_id')
+    if tagged.empty:
+        return pd.Series(dtype=object)
+    per_tag = tagged.groupby(['user_id', 'tag_id'])['plays'].sum().reset_index()
+    per_tag['share'] = per_tag['plays'] / per_tag.groupby('user_id')['plays'].transform('sum')
+    per_tag = per_tag.sort_values(['user_id', 'share', 'tag_id'], ascending=[True, False, True]).groupby('user_id').head(top_tags)
+    pairs = list(zip(per_tag['tag_id'].astype(int).tolist(), per_tag['share'].round(PERSONA_PRECISION).tolist()))
+    return pd.Series(pairs, index=per_tag['user_id'].to_numpy()).groupby(level=0).agg(list)
+
+def activity_type_counts(activity):
+    # Rows per (user_id, activity_type)
+    return activity.groupby(['user_id', 'activity_type'], observed=True).size()
+
+def activity_features(counts):
+    if counts.empty:
+        return pd.DataFrame(columns=['activity_count', 'active_share'])
+    counts = counts.unstack(fill_value=0)
+    total = counts.sum(axis=1)
+    active = counts['active'] if 'active' in counts.columns else 0
+    return pd.DataFrame({'activity_count': total, 'active_share': active / total})
+
+def session_seconds(sessions):
+    seconds = sessions['session_total_time']
+    if pd.api.types.is_timedelta64_dtype(seconds):
+        seconds = seconds.dt.total_seconds()
+    return pd.DataFrame({'user_id': sessions['user_id'].to_numpy(), 'seconds': pd.to_numeric(seconds, errors='coerce').to_numpy()})
+
+def session_features(sessions):
+    if sessions.empty:
+        return pd.DataFrame(columns=['session_count', 'session_seconds', 'session_p50', 'session_p90'])
+    grouped = session_seconds(sessions).groupby('user_id')['seconds']
+    return pd.DataFrame({
+        'session_count': grouped.size(),
+        'session_seconds': grouped.sum(),
+        'session_p50': grouped.median(),
+        'session_p90': grouped.quantile(0.9),
+    })
+
+def bucket_quantiles(buckets, quantiles):
+    # Per-user quantiles from a users x bucket count InteractionMatrix: each
+    # session is taken as the middle of its bucket and neighbouring ranks are
+    # interpolated linearly, like Series.quantile
+    matrix = buckets.matrix.tocsr()
+    users = np.flatnonzero(np.diff(matrix.indptr))
+    values = np.empty((len(users), len(quantiles)), dtype=np.float64)
+    for position, row in enumerate(users.tolist()):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        ids = buckets.col_map.to_id(matrix.indices[start:end])
+        order = np.argsort(ids)
+        cumulative = np.cumsum(matrix.data[start:end][order])
+        ranks = np.asarray(quantiles) * (cumulative[-1] - 1)
+        middles = SESSION_BUCKET_GROWTH ** (ids[order] + 0.5) - 1
+        lower = middles[np.searchsorted(cumulative, np.floor(ranks), side='right')]
+        upper = middles[np.searchsorted(cumulative, np.ceil(ranks), side='right')]
+        values[position] = lower + (ranks - np.floor(ranks)) * (upper - lower)
+    return pd.DataFrame(values, index=pd.Index(buckets.row_map.to_id(users), name='user_id'))
+
+class SessionAccumulator:
+    # session_features over streamed chunks. Counts and sums are added per
+    # chunk; p50/p90 come from per-user log-spaced length buckets, so they are
+    # estimates within SESSION_BUCKET_GROWTH of the exact quantiles.
+    def __init__(self):
+        self.totals = None
+        self.buckets = MatrixAccumulator('user_id', 'bucket', col_map=IndexMap())
+
+    def add(self, frame):
+        seconds = session_seconds(frame)
+        grouped = seconds.groupby('user_id')['seconds']
+        totals = pd.DataFrame({'session_count': grouped.size(), 'session_seconds': grouped.sum()})
+        self.totals = totals if self.totals is None else self.totals.add(totals, fill_value=0)
+        seconds = seconds.dropna()
+        buckets = np.floor(np.log1p(seconds['seconds'].clip(lower=0)) / np.log(SESSION_BUCKET_GROWTH))
+        self.buckets.add(pd.DataFrame({'user_id': seconds['user_id'].to_numpy(), 'bucket': buckets.to_numpy(dtype=np.int64)}))
+        return self
+
+    def result(self):
+        if self.totals is None:
+            return session_features(pd.DataFrame())
+        quantiles = bucket_quantiles(self.buckets.result(), [0.5, 0.9])
+        quantiles.columns = ['session_p50', 'session_p90']
+        return self.totals.join(quantiles)
+
+def social_features(follows):
+    if follows.empty:
+        return pd.DataFrame(columns=['followers', 'following'])
+    return pd.DataFrame({
+        'followers': follows['following_id'].value_counts(),
+        'following': follows['follower_id'].value_counts(),
+    })
+
+def latent_factors(model, user_ids):
+    # Blended user factor rows as lists; users outside the model get None
+    factors = [None] * len(user_ids)
+    if model is None:
+        return factors
+    indices = model.user_indices(user_ids)
+    inside = np.flatnonzero(indices >= 0)
+    rows = np.round(np.asarray(model.user_factors[indices[inside]], dtype=np.float64), PERSONA_PRECISION)
+    for position, row in zip(inside.tolist(), rows.tolist()):
+        factors[position] = row
+    return factors
+
+def persona_inputs(data, user_ids):
+    # (activity type counts, session features, session plays) over the rows
+    # of user_ids only
+    activity = data['activity'][data['activity']['user_id'].isin(user_ids)]
+    sessions = data['game_session'][data['game_session']['user_id'].isin(user_ids)]
+    return activity_type_counts(activity), session_features(sessions), session_plays(sessions)
+
+async def stream_persona_inputs(db: AsyncSession, last_updated):
+    # persona_inputs for every user plus the outdated users of each streamed
+    # table, in one chunked pass per table; memory follows the number of users
+    # and (user, game) pairs, not rows
+    events = {table: EventAccumulator(user_columns, timestamps, last_updated) for table, user_columns, timestamps in PERSONA_EVENTS if table in PERSONA_STREAMED_COLUMNS}
+    activity_counts, activity_events = await stream_matrices(db, 'activity', [CountAccumulator(['user_id', 'activity_type']), events['activity']], columns=PERSONA_STREAMED_COLUMNS['activity'])
+    sessions, plays, session_events = await stream_matrices(db, 'game_session', [SessionAccumulator(), MatrixAccumulator('user_id', 'game_id'), events['game_session']], columns=PERSONA_STREAMED_COLUMNS['game_session'])
+    return (activity_counts, sessions, matrix_plays(plays)), {'activity': activity_events, 'game_session': session_events}
+
+def build_persona_frame(user_ids, inputs, follows, game_tags, model, graph=None):
+    # One row per user with every feature, computed with grouped operations;
+    # inputs may cover more users than user_ids
+    user_index = pd.Index(user_ids, name='user_id')
+    activity_counts, sessions, plays = inputs
+    plays = plays[plays['user_id'].isin(user_ids)]
+    follows = follows[follows['follower_id'].isin(user_ids) | follows['following_id'].isin(user_ids)]
+
+    frame = pd.DataFrame(index=user_index)
+    frame = frame.join(activity_features(activity_counts)).join(sessions).join(social_features(follows))
+    counts = ['activity_count', 'session_count', 'followers', 'following']
+    frame[counts] = frame[counts].fillna(0).astype(np.int64)
+    frame = frame.fillna(0.0)
+    frame['influence'] = graph.influence(user_ids) if graph is not None else 0.0
+    frame['tags'] = tag_features(plays, game_tags).reindex(user_index)
+    frame['factor'] = pd.Series(latent_factors(model, user_ids), index=user_index, dtype=object)
+    return frame
+
+def persona_documents(frame, model_version=None):
+    # Compact JSON per user: rounded floats, only top tags
+    floats = ['active_share', 'session_seconds', 'session_p50', 'session_p90', 'influence']
+    frame = frame.copy()
+    frame[floats] = frame[floats].astype(np.float64).round(PERSONA_PRECISION)
+    documents = []
+    for row in frame.itertuples():
+        documents.append({
+            "tags": row.tags if isinstance(row.tags, list) else [],
+            "activity": {"count": row.activity_count, "active_share": row.active_share},
+            "sessions": {"count": row.session_count, "seconds": row.session_seconds, "p50": row.session_p50, "p90": row.session_p90},
+            "social": {"followers": row.followers, "following": row.following, "influence": row.influence},
+            "factor": row.factor,
+            "model_version": model_version,
+        })
+    return documents
+
+async def build_personas(db: AsyncSession, full=False, stage=nullcontext):
+    # Rebuilds the personas of users with new activity, sessions or follows
+    # since their last_updated, or of every user with full=True. Latent factors
+    # of untouched users are only refreshed by a full build.
+    now = datetime.utcnow()
+    with stage("fetch"):
+        users = await db.execute(select(User.id))
+        all_user_ids = np.array(users.scalars().all(), dtype=np.int64)
+        result = await db.execute(select(UserPersona.user_id, UserPersona.last_updated))
+        last_updated = pd.Series(dict(result.all()), dtype='datetime64[ns]')
+        tags = await db.execute(select(GameTag.game_id, GameTag.tag_id))
+        game_tags = pd.DataFrame(tags.all(), columns=['game_id', 'tag_id'])
+        inputs, streamed_events = None, {}
+        if STREAMING_INGESTION:
+            data = await interaction_store.get_data(db, tables=[table for table in PERSONA_TABLES if table not in PERSONA_STREAMED_COLUMNS])
+            inputs, streamed_events = await stream_persona_inputs(db, last_updated)
+        else:
+            data = await interaction_store.get_data(db, tables=PERSONA_TABLES)
+
+    if full:
+        user_ids = all_user_ids
+    else:
+        outdated = [streamed_events[table] if table in streamed_events else users_with_events_since(data[table], user_columns, timestamps, last_updated) for table, user_columns, timestamps in PERSONA_EVENTS]
+        missing = all_user_ids[~np.isin(all_user_ids, last_updated.index.to_numpy())]
+        user_ids = pd.unique(np.concatenate(outdated + [missing]))
+        user_ids = user_ids[np.isin(user_ids, all_user_ids)]
+    if not len(user_ids):
+        return 0
+
+    model = await get_game_model(db)
+    graph, _ = await get_social_graph(db)
+    with stage("features"):
+        if inputs is None:
+            inputs = await compute_executor.run_in_thread(persona_inputs, data, user_ids)
+        frame = await compute_executor.run_in_thread(build_persona_frame, user_ids, inputs, data['follow'], game_tags, model, graph)
+        documents = persona_documents(frame, model_version=str(model.version) if model is not None else None)
+
+    with stage("persist"):
+        written = await upsert_user_personas(db, frame.index.to_numpy(), documents, now)
+        await db.commit()
+    return written
+
+async def get_persona(db: AsyncSession, user_id: int):
+    result = await db.execute(select(UserPersona.persona, UserPersona.last_updated).where(UserPersona.user_id == user_id))
+    return result.first()
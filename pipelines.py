@@ -0,0 +1,112 @@
+from contextlib import nullcontext
+from functools import partial
+from sqlalchemy.ext.asyncio import AsyncSession
+from aggregation import AGGREGATES, refresh_rollup
+from compute import compute_executor
+from config import AGGREGATION_ROLLUPS, STREAMING_INGESTION
+from factor_model import factor_models
+from feed import build_user_feeds
+from interaction_store import interaction_store, user_rows
+from matrices import build_interaction_matrix
+from persistence import delete_item_priorities, get_or_create_dynamic_items, replace_item_priorities
+from personas import build_personas
+from priority import populate_priorities
+from recommendation import refit_game_model
+
+# Pipeline steps take a `stage` context manager factory; jobs pass one that
+# records timings, direct callers get nullcontext
+
+PLAYLIST_SIGNAL_TABLES = ['playlist_session']
+PLAYLIST_RECOMMENDATIONS = 5
+
+def build_playlist_signals(data, user_ids=None):
+    data = user_rows(data, user_ids)
+    return [
+        ('playlist_completion', build_interaction_matrix(data['playlist_session'], 'user_id', 'playlist_id', value='completed', col_map='playlist'), 1.0),
+    ]
+
+async def get_playlist_model(db: AsyncSession, stage=nullcontext):
+    # Changed users are folded into the cached model; it is refit only past
+    # the fold-in drift/age thresholds
+    with stage("fetch"):
+        data = await interaction_store.get_data(db, tables=PLAYLIST_SIGNAL_TABLES)
+
+    version = interaction_store.version(PLAYLIST_SIGNAL_TABLES)
+    return await factor_models.get_or_fit(
+        'playlist', version, partial(build_playlist_signals, data), stage=stage,
+        changed_users=partial(interaction_store.changed_users, PLAYLIST_SIGNAL_TABLES),
+        version_at=partial(interaction_store.version_at, PLAYLIST_SIGNAL_TABLES),
+    )
+
+async def update_playlist_recommendations(db: AsyncSession, user_ids=None, stage=nullcontext):
+    # fetch -> build matrices -> factorize -> top-K -> persist, for every user
+    # or only for user_ids
+    model = await get_playlist_model(db, stage)
+
+    with stage("top_k"):
+        user_indices = None
+        if user_ids is not None:
+            user_indices = [index for index in (model.user_index(user_id) for user_id in user_ids) if index is not None]
+        user_indices, playlist_indices, scores = await compute_executor.run_in_thread(model.top_k, PLAYLIST_RECOMMENDATIONS, user_indices=user_indices)
+
+    with stage("persist"):
+        # One dynamic_item per playlist is shared by every user it is recommended to
+        playlist_ids = model.item_ids[playlist_indices]
+        item_ids = await get_or_create_dynamic_items(db, 'playlist_recommendation', [{"playlist_id": playlist_id} for playlist_id in playlist_ids.tolist()])
+        if user_ids is not None:
+            # Users without playlist sessions lose their previous recommendations
+            await delete_item_priorities(db, 'playlist_recommendation', user_ids)
+        written = await replace_item_priorities(db, 'playlist_recommendation', item_ids, model.user_ids[user_indices], scores)
+        await db.commit()
+    return written
+
+async def refresh_rollups(db: AsyncSession, stage=nullcontext):
+    # Brings every rollup up to its raw table; fetch_aggregate only reads them
+    written = {}
+    for name, aggregate in AGGREGATES.items():
+        if aggregate.rollup is None:
+            continue
+        with stage(f"rollup_{name}"):
+            written[name] = await refresh_rollup(db, name)
+    return written
+
+async def recompute_recommendations(db: AsyncSession, stage=nullcontext):
+    if AGGREGATION_ROLLUPS:
+        await refresh_rollups(db, stage)
+
+    if STREAMING_INGESTION:
+        # The game model is not kept current by the interaction store in this mode
+        await refit_game_model(db, stage)
+
+    playlist_priorities = await update_playlist_recommendations(db, stage=stage)
+
+    with stage("priorities"):
+        priorities = await populate_priorities(db)
+        await db.commit()
+
+    with stage("feed"):
+        feed = await build_user_feeds(db)
+        await db.commit()
+
+    return {"playlist_priorities": playlist_priorities, "priorities": priorities, "feed_items": len(feed)}
+
+async def recompute_user_recommendations(db: AsyncSession, user_id: int, stage=nullcontext):
+    # Incremental run for one user against the cached models
+    playlist_priorities = await update_playlist_recommendations(db, user_ids=[user_id], stage=stage)
+
+    with stage("priorities"):
+        priorities = await populate_priorities(db, user_ids=[user_id])
+        await db.commit()
+
+    with stage("feed"):
+        feed = await build_user_feeds(db, user_ids=[user_id])
+        await db.commit()
+
+    return {"user_id": user_id, "playlist_priorities": playlist_priorities, "priorities": priorities, "feed_items": len(feed)}
+
+PIPELINES = {
+    "recompute": recompute_recommendations,
+    "recompute_user": recompute_user_recommendations,
+    "personas": build_personas,
+    "rollups": refresh_rollups,
+}
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from config import STREAMING_INGESTION
+from data_processing import stream_matrices
+from interaction_store import interaction_store
+from matrices import CountAccumulator
+from models import DynamicItem, User
+from persistence import replace_item_priorities
+from ranking import top_k_block
+
+# Base priority per item type
+ITEM_TYPE_PRIORITY = {
+    "activity": 10,
+    "recommendation": 5,
+    "playlist_recommendation": 5,
+    "ad": 1,
+}
+
+# Item types whose priorities are written per user by their own pipeline
+# (e.g. update_playlist_recommendations) and must not be overwritten here
+PERSONALIZED_ITEM_TYPES = {"playlist_recommendation"}
+
+# Interaction table whose per-user volume scales each item type
+ITEM_TYPE_SIGNAL = {
+    "activity": "activity",
+    "recommendation": "game_session",
+}
+
+# Items lose half their freshness boost every FRESHNESS_HALF_LIFE_DAYS
+FRESHNESS_HALF_LIFE_DAYS = 7.0
+
+# Upper bound on users x items cells scored at once
+MAX_CHUNK_CELLS = 4_000_000
+
+def item_arrays(rows, now):
+    item_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    item_types = np.array([row[1] for row in rows], dtype=object)
+    created_at = pd.to_datetime(pd.Series([row[2] for row in rows], dtype=object))
+    age_days = ((now - created_at).dt.total_seconds() / 86400).fillna(0).clip(lower=0).to_numpy()
+
+    base = np.array([ITEM_TYPE_PRIORITY.get(item_type, 0) for item_type in item_types], dtype=np.float32)
+    freshness = (1 + np.exp2(-age_days / FRESHNESS_HALF_LIFE_DAYS)).astype(np.float32)
+    return item_ids, item_types, base * freshness
+
+async def signal_counts(db: AsyncSession):
+    # Rows per user in each ITEM_TYPE_SIGNAL table
+    tables = sorted(set(ITEM_TYPE_SIGNAL.values()))
+    if STREAMING_INGESTION:
+        counts = {}
+        for table in tables:
+            counts[table], = await stream_matrices(db, table, [CountAccumulator(['user_id'])], columns=['user_id'])
+        return counts
+    data = await interaction_store.get_data(db, tables=tables)
+    return {table: data[table]['user_id'].value_counts() for table in tables}
+
+def user_affinity(user_ids, signal_counts, item_types):
+    # users x distinct-type matrix of multipliers in [1, 2]: log-scaled
+    # interaction volume relative to the most active user
+    type_names = sorted(set(item_types.tolist()))
+    affinity = np.ones((len(user_ids), len(type_names)), dtype=np.float32)
+    user_index = pd.Index(user_ids)
+
+    for column, item_type in enumerate(type_names):
+        table = ITEM_TYPE_SIGNAL.get(item_type)
+        if table is None or table not in signal_counts or signal_counts[table].empty:
+            continue
+        counts = signal_counts[table]
+        positions = user_index.get_indexer(counts.index.to_numpy(dtype=np.int64))
+        volume = np.zeros(len(user_ids), dtype=np.float32)
+        volume[positions[positions >= 0]] = np.log1p(counts.to_numpy()[positions >= 0])
+        if volume.max() > 0:
+            affinity[:, column] = 1 + volume / volume.max()
+
+    type_columns = pd.Index(type_names).get_indexer(item_types)
+    return affinity, type_columns
+
+def score_chunk(affinity, type_columns, item_scores):
+    # (users x types)[:, type of each item] * per-item score
+    return affinity[:, type_columns] * item_scores
+
+async def populate_priorities(db: AsyncSession, top_n=None, chunk_size=1000, user_ids=None):
+    # user_ids limits the rows written; affinity is still scaled against all users
+    now = datetime.utcnow()
+    items = await db.execute(
+        select(DynamicItem.item_id, DynamicItem.item_type, DynamicItem.created_at)
+        .where(DynamicItem.item_type.notin_(PERSONALIZED_ITEM_TYPES))
+    )
+    items = items.all()
+    users = await db.execute(select(User.id))
+    all_user_ids = np.array(users.scalars().all(), dtype=np.int64)
+    if not items or not len(all_user_ids):
+        return 0
+
+    item_ids, item_types, item_scores = item_arrays(items, now)
+    affinity, type_columns = user_affinity(all_user_ids, await signal_counts(db), item_types)
+
+    if user_ids is None:
+        user_ids = all_user_ids
+    else:
+        positions = pd.Index(all_user_ids).get_indexer(np.asarray(user_ids, dtype=np.int64))
+        positions = positions[positions >= 0]
+        user_ids, affinity = all_user_ids[positions], affinity[positions]
+
+    distinct_types = sorted(set(item_types.tolist()))
+    chunk_size = max(1, min(chunk_size, MAX_CHUNK_CELLS // len(item_ids)))
+    written = 0
+    for start in range(0, len(user_ids), chunk_size):
+        chunk_users = user_ids[start:start + chunk_size]
+        scores = score_chunk(affinity[start:start + chunk_size], type_columns, item_scores)
+
+        if top_n is not None:
+            columns = top_k_block(scores, top_n)
+            scores = np.take_along_axis(scores, columns, axis=1)
+        else:
+            columns = np.broadcast_to(np.arange(len(item_ids)), scores.shape)
+
+        # Replace the chunk's previous priorities so a top_n run does not
+        # leave stale rows from an earlier full run behind
+        written += await replace_item_priorities(
+            db,
+            distinct_types,
+            item_ids[columns].ravel(),
+            np.repeat(chunk_users, columns.shape[1]),
+            scores.ravel(),
+        )
+    return written
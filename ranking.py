@@ -0,0 +1,58 @@
+import numpy as np
+from metrics import timed
+
+DEFAULT_BLOCK_SIZE = 1024
+
+def top_k_block(scores, k):
+    # Top-k columns per row of a dense score block, best first
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+@timed("rank")
+def top_k(user_factors, item_factors, k, user_indices=None, exclude=None, item_mask=None, block_size=DEFAULT_BLOCK_SIZE):
+    # Scores users against all items in blocks of block_size rows, so peak
+    # memory is block_size x items regardless of the number of users.
+    # exclude is an optional CSR matrix indexed like user_factors whose stored
+    # entries mark items to leave out (e.g. ones the user already played);
+    # item_mask optionally marks the items that may be returned at all.
+    # Returns flat (user_idx, item_idx, score) arrays, best first per user.
+    if user_indices is None:
+        user_indices = np.arange(user_factors.shape[0])
+    user_indices = np.asarray(user_indices, dtype=np.int64)
+    n_items = item_factors.shape[1]
+
+    user_parts, item_parts, score_parts = [], [], []
+    for start in range(0, len(user_indices), block_size):
+        block_users = user_indices[start:start + block_size]
+        scores = np.asarray(user_factors[block_users] @ item_factors, dtype=np.float32)
+
+        if exclude is not None:
+            excluded = exclude[block_users].tocoo()
+            in_range = excluded.col < n_items
+            scores[excluded.row[in_range], excluded.col[in_range]] = -np.inf
+        if item_mask is not None:
+            scores[:, ~item_mask] = -np.inf
+
+        items = top_k_block(scores, k)
+        block_scores = np.take_along_axis(scores, items, axis=1)
+        users = np.repeat(block_users, items.shape[1])
+        items, block_scores = items.ravel(), block_scores.ravel()
+
+        keep = np.isfinite(block_scores)
+        user_parts.append(users[keep])
+        item_parts.append(items[keep])
+        score_parts.append(block_scores[keep])
+
+    if not user_parts:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+    return (np.concatenate(user_parts).astype(np.int32),
+            np.concatenate(item_parts).astype(np.int32),
+            np.concatenate(score_parts).astype(np.float32))
@@ -1,63 +1,142 @@
-from data_processing import fetch_data, normalize, svd_reconstruct
+from contextlib import nullcontext
+from functools import partial
 from sqlalchemy.ext.asyncio import AsyncSession
+from interaction_store import interaction_store, user_rows
+from config import SOCIAL_RECOMMENDATION_WEIGHT, STREAMING_INGESTION
+from compute import compute_executor
+from data_processing import stream_matrices
+from factor_model import factor_models
+from matrices import MatrixAccumulator, build_interaction_matrix
+from models import Activity
+from ranking import DEFAULT_BLOCK_SIZE, top_k_block
+from social import follow_play_shares, follow_play_shares_batch, social_graph
+import numpy as np
 import pandas as pd
 
+GAME_SIGNAL_TABLES = ['game_session', 'review', 'activity']
+GAME_SIGNAL_WEIGHTS = {'play_count': 0.4, 'rating': 0.3, 'engagement': 0.3}
+
+def build_game_signals(data, user_ids=None):
+    data = user_rows(data, user_ids)
+    activity_df = data['activity']
+    if 'target_type' in activity_df.columns:
+        activity_df = activity_df[activity_df['target_type'] == 'game']
+
+    return [
+        ('play_count', build_interaction_matrix(data['game_session'], 'user_id', 'game_id'), GAME_SIGNAL_WEIGHTS['play_count']),
+        ('rating', build_interaction_matrix(data['review'], 'user_id', 'game_id', value='rating', agg='max'), GAME_SIGNAL_WEIGHTS['rating']),
+        ('engagement', build_interaction_matrix(activity_df, 'user_id', 'target_id'), GAME_SIGNAL_WEIGHTS['engagement']),
+    ]
+
+async def stream_game_signals(db: AsyncSession):
+    # build_game_signals over streamed chunks: only the needed columns are
+    # read, the target_type filter runs in SQL and no raw rows are kept
+    play_count, = await stream_matrices(db, 'game_session', [MatrixAccumulator('user_id', 'game_id')], columns=['user_id', 'game_id'])
+    rating, = await stream_matrices(db, 'review', [MatrixAccumulator('user_id', 'game_id', value='rating', agg='max')], columns=['user_id', 'game_id', 'rating'])
+    engagement, = await stream_matrices(db, 'activity', [MatrixAccumulator('user_id', 'target_id')], columns=['user_id', 'target_id'], where=Activity.target_type == 'game')
+    return [
+        ('play_count', play_count, GAME_SIGNAL_WEIGHTS['play_count']),
+        ('rating', rating, GAME_SIGNAL_WEIGHTS['rating']),
+        ('engagement', engagement, GAME_SIGNAL_WEIGHTS['engagement']),
+    ]
+
+async def refit_game_model(db: AsyncSession, stage=nullcontext):
+    with stage("stream"):
+        signals = await stream_game_signals(db)
+    model = await factor_models.fit('game', lambda: signals, stage=stage)
+    # The social plays matrix is the binarized play counts, so it is not streamed twice
+    social_graph.set_plays(signals[0][1].matrix, model.version)
+    return model
+
+async def get_game_model(db: AsyncSession):
+    if STREAMING_INGESTION:
+        # Requests serve the latest streamed fit; the recompute job refits it
+        return factor_models.latest('game') or await refit_game_model(db)
+    data = await interaction_store.get_data(db, tables=GAME_SIGNAL_TABLES)
+    version = interaction_store.version(GAME_SIGNAL_TABLES)
+    return await factor_models.get_or_fit('game', version, partial(build_game_signals, data), changed_users=partial(interaction_store.changed_users, GAME_SIGNAL_TABLES), version_at=partial(interaction_store.version_at, GAME_SIGNAL_TABLES))
+
 async def fetch_recommendations(user_id: int, db: AsyncSession):
-    df = await fetch_data(db)
-    play_count_matrix = df.pivot(index='user_id', columns='game_id', values='play_count').fillna(0).values
-    rating_matrix = df.pivot(index='user_id', columns='game_id', values='rating').fillna(0).values
-    engagement_matrix = df.pivot(index='user_id', columns='game_id', values='engagement').fillna(0).values
+    model = await get_game_model(db)
 
-    normalized_play_count = normalize(play_count_matrix)
-    normalized_ratings = normalize(rating_matrix)
-    normalized_engagement = normalize(engagement_matrix)
+    user_recommendations = model.score_user(user_id)
+    if user_recommendations is None:
+        return []
 
-    reconstructed_play_count = svd_reconstruct(normalized_play_count)
-    reconstructed_ratings = svd_reconstruct(normalized_ratings)
-    reconstructed_engagement = svd_reconstruct(normalized_engagement)
+    # Games the user's follows played get a boost proportional to how many did
+    if SOCIAL_RECOMMENDATION_WEIGHT:
+        user_recommendations = user_recommendations + SOCIAL_RECOMMENDATION_WEIGHT * await follow_play_shares(db, user_id, model.item_ids)
 
-    weights = [0.4, 0.3, 0.3]
-    combined_matrix = (weights[0] * reconstructed_play_count +
-                       weights[1] * reconstructed_ratings +
-                       weights[2] * reconstructed_engagement)
+    observed = model.observed_items
+    return [{'item_id': item_id, 'priority_score': score} for item_id, score in zip(model.item_ids[observed].tolist(), user_recommendations[observed].tolist())]
 
-    user_recommendations = combined_matrix[user_id].tolist()
-    return [{'item_id': idx, 'priority_score': score} for idx, score in enumerate(user_recommendations)]
+def rank_batch(model, user_indices, k, boost=None, exclude_seen=False, block_size=DEFAULT_BLOCK_SIZE):
+    # Top-k item indices and scores per requested user: user factor rows are
+    # scored against the item factors block_size rows at a time, plus an
+    # optional sparse boost with one row per requested user
+    user_factors, item_factors = model.blended_factors()
+    items, scores = [], []
+    for start in range(0, len(user_indices), block_size):
+        block = user_indices[start:start + block_size]
+        block_scores = np.asarray(user_factors[block] @ item_factors, dtype=np.float32)
+        if boost is not None:
+            block_scores += boost[start:start + block_size].toarray()
+        if exclude_seen and model.interactions is not None:
+            seen = model.interactions[block].tocoo()
+            in_range = seen.col < block_scores.shape[1]
+            block_scores[seen.row[in_range], seen.col[in_range]] = -np.inf
+        block_scores[:, ~model.observed_items] = -np.inf
+        block_items = top_k_block(block_scores, k)
+        items.append(block_items)
+        scores.append(np.take_along_axis(block_scores, block_items, axis=1))
+    if not items:
+        return np.empty((0, 0), dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    return np.vstack(items), np.vstack(scores)
+
+async def fetch_recommendations_batch(db: AsyncSession, user_ids, k=10, exclude_seen=False):
+    # Top-k games for many users from one model and one social product.
+    # Users outside the model are returned separately instead of failing the batch.
+    model = await get_game_model(db)
+    user_ids = pd.unique(np.asarray(user_ids, dtype=np.int64))
+    user_indices = model.user_indices(user_ids)
+    known = user_indices >= 0
+
+    boost = None
+    if SOCIAL_RECOMMENDATION_WEIGHT and known.any():
+        boost = SOCIAL_RECOMMENDATION_WEIGHT * await follow_play_shares_batch(db, user_ids[known], model.item_ids)
+
+    items, scores = await compute_executor.run_in_thread(rank_batch, model, user_indices[known], k, boost, exclude_seen)
+    item_ids = model.item_ids
+    recommendations = {}
+    for user_id, user_items, user_scores in zip(user_ids[known].tolist(), items, scores):
+        finite = np.isfinite(user_scores)
+        recommendations[user_id] = [{'item_id': item_id, 'priority_score': score} for item_id, score in zip(item_ids[user_items[finite]].tolist(), user_scores[finite].tolist())]
+    return recommendations, user_ids[~known].tolist()
 
 async def fetch_recommendations_for_all_users(db: AsyncSession):
-    data = await fetch_data(db)
-
-    # Ensure data contains DataFrames
-    if not all(isinstance(df, pd.DataFrame) for df in data.values()):
-        raise ValueError("All values in the data dictionary must be pandas DataFrames")
-    
-    game_sessions_df = data['game_session']
-    
-    if game_sessions_df.empty:
-        return {}
-
-    play_count_matrix = game_sessions_df.pivot(index='user_id', columns='game_id', values='play_count').fillna(0).values
-    rating_matrix = game_sessions_df.pivot(index='user_id', columns='game_id', values='rating').fillna(0).values
-    engagement_matrix = game_sessions_df.pivot(index='user_id', columns='game_id', values='engagement').fillna(0).values
-
-    normalized_play_count = normalize(play_count_matrix)
-    normalized_ratings = normalize(rating_matrix)
-    normalized_engagement = normalize(engagement_matrix)
-
-    reconstructed_play_count = svd_reconstruct(normalized_play_count)
-    reconstructed_ratings = svd_reconstruct(normalized_ratings)
-    reconstructed_engagement = svd_reconstruct(normalized_engagement)
-
-    weights = [0.4, 0.3, 0.3]
-    combined_matrix = (weights[0] * reconstructed_play_count +
-                       weights[1] * reconstructed_ratings +
-                       weights[2] * reconstructed_engagement)
+    if STREAMING_INGESTION:
+        # Raw frames are not loaded in this mode; the streamed fit knows which games were played
+        model = await get_game_model(db)
+        if not model.observed_items.any():
+            return {}
+    else:
+        data = await interaction_store.get_data(db, tables=GAME_SIGNAL_TABLES)
+
+        # Ensure data contains DataFrames
+        if not all(isinstance(df, pd.DataFrame) for df in data.values()):
+            raise ValueError("All values in the data dictionary must be pandas DataFrames")
+
+        if data['game_session'].empty:
+            return {}
+
+        model = await get_game_model(db)
 
     all_user_recommendations = {}
-    user_ids = game_sessions_df['user_id'].unique()
-    
-    for idx, user_id in enumerate(user_ids):
-        user_recommendations = combined_matrix[idx].tolist()
-        all_user_recommendations[user_id] = [{'item_id': item_id, 'priority_score': score} for item_id, score in enumerate(user_recommendations)]
+    observed = model.observed_items
+    game_ids = model.item_ids[observed].tolist()
+    for idx in np.flatnonzero(model.observed_users).tolist():
+        user_id = int(model.user_ids[idx])
+        user_recommendations = model.score_index(idx)[observed].tolist()
+        all_user_recommendations[user_id] = [{'item_id': item_id, 'priority_score': score} for item_id, score in zip(game_ids, user_recommendations)]
 
-    return all_user_recommendations
\ No newline at end of file
+    return all_user_recommendations
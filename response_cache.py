@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from collections import OrderedDict
+from config import RESPONSE_CACHE_BACKEND, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_REDIS_URL, RESPONSE_CACHE_TTL_SECONDS
+from factor_model import factor_models
+from interaction_store import interaction_store
+from metrics import REGISTRY, Counter
+
+RESPONSE_CACHE_REQUESTS = REGISTRY.register(Counter('pe_response_cache_requests_total', 'Response cache lookups by result (hit, miss, not_modified)', ['endpoint', 'result']))
+
+# Scopes keys that only hold in this process: interaction-store versions are
+# per-process counters, and a model fitted here differs from other workers' fits
+PROCESS_ID = uuid.uuid4().hex[:12]
+
+def local_version(version):
+    return ".".join(str(part) for part in version) if isinstance(version, tuple) else str(version)
+
+def model_version(model, tables=None):
+    # Identifies the exact factors a response was computed from. A published
+    # artifact plus the shared key of the data the model covers (tables at
+    # model.version, see InteractionStore.data_key) is the same in every worker;
+    # anything else is scoped to this process.
+    if model is None:
+        return "none"
+    data_key = interaction_store.data_key(tables, model.version) if tables and isinstance(model.version, tuple) else None
+    if model.artifact_version is not None and data_key is not None:
+        return f"{data_key}@{model.artifact_version}"
+    return f"{PROCESS_ID}.{local_version(model.version)}@{model.fitted_at}"
+
+def tables_version(tables):
+    # Current data of tables a handler reads besides its model
+    data_key = interaction_store.data_key(tables)
+    if data_key is not None:
+        return data_key
+    return f"{PROCESS_ID}.{local_version(interaction_store.version(tables))}"
+
+def cache_key(endpoint, user_id, version):
+    return f"{endpoint}:{user_id}:{version}"
+
+def etag_for(key):
+    # Responses are a pure function of the key, so the ETag is too and a
+    # conditional request is answered without looking the body up
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+class MemoryBackend:
+    # LRU over insertion/access order with a per-entry deadline
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl if self.ttl else None, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def delete_prefix(self, prefix, keep_suffix=None):
+        for key in [key for key in self.entries if key.startswith(prefix) and not (keep_suffix and key.endswith(keep_suffix))]:
+            del self.entries[key]
+
+    async def clear(self):
+        self.entries.clear()
+
+class RedisBackend:
+    # Shared across workers; eviction is left to the server's TTLs and
+    # maxmemory policy. Values are stored as JSON.
+
+    def __init__(self, url=RESPONSE_CACHE_REDIS_URL, ttl=RESPONSE_CACHE_TTL_SECONDS, namespace="pe_response_cache:"):
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND=redis requires the redis package") from e
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.namespace = namespace
+
+    async def get(self, key):
+        value = await self.client.get(self.namespace + key)
+        return None if value is None else json.loads(value)
+
+    async def set(self, key, value):
+        await self.client.set(self.namespace + key, json.dumps(value), ex=int(self.ttl) if self.ttl else None)
+
+    async def delete_prefix(self, prefix, keep_suffix=None):
+        keys = [key async for key in self.client.scan_iter(match=self.namespace + prefix + "*")]
+        if keep_suffix:
+            keys = [key for key in keys if not key.decode().endswith(keep_suffix)]
+        if keys:
+            await self.client.delete(*keys)
+
+    async def clear(self):
+        await self.delete_prefix("")
+
+BACKENDS = {"memory": MemoryBackend, "redis": RedisBackend}
+
+class ResponseCache:
+    # JSON response bodies keyed by (endpoint, user_id, model_version). Keys
+    # change whenever the model behind an endpoint changes, so a stale body is
+    # never served; invalidate() additionally drops the outdated entries of the
+    # endpoints that depend on a model as soon as it is replaced.
+
+    def __init__(self, backend=RESPONSE_CACHE_BACKEND):
+        self.backend_name = backend
+        self.backend = None
+        # Model name -> endpoints whose responses are computed from it
+        self.dependents = {}
+        # Endpoint -> model name, and model name -> the store tables it is fit on
+        self.models = {}
+        self.model_tables = {}
+        # Single-flight: one computation per key, concurrent misses await it
+        self.pending = {}
+
+    def get_backend(self):
+        if self.backend is None:
+            if self.backend_name not in BACKENDS:
+                raise ValueError(f"Unknown response cache backend: {self.backend_name}")
+            self.backend = BACKENDS[self.backend_name]()
+        return self.backend
+
+    def depends_on(self, endpoint, model_name, model_tables=None):
+        self.dependents.setdefault(model_name, set()).add(endpoint)
+        self.models[endpoint] = model_name
+        if model_tables is not None:
+            self.model_tables[model_name] = list(model_tables)
+
+    def version(self, endpoint, model, tables=()):
+        # The key part for a response of endpoint computed from model, plus
+        # the current data of any other tables the handler reads. The model
+        # version stays last, see invalidate().
+        version = model_version(model, self.model_tables.get(self.models.get(endpoint)))
+        if tables:
+            version = f"{tables_version(tables)}:{version}"
+        return version
+
+    async def get_or_compute(self, endpoint, user_id, version, compute):
+        # compute is an async callable returning a JSON-serializable body.
+        # Returns (body, etag, hit).
+        key = cache_key(endpoint, user_id, version)
+        backend = self.get_backend()
+        body = await backend.get(key)
+        if body is not None:
+            RESPONSE_CACHE_REQUESTS.inc(endpoint=endpoint, result="hit")
+            return body, etag_for(key), True
+
+        RESPONSE_CACHE_REQUESTS.inc(endpoint=endpoint, result="miss")
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._compute(key, compute))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        # Shielded so one cancelled request does not cancel the others waiting on it
+        body = await asyncio.shield(task)
+        return body, etag_for(key), False
+
+    async def _compute(self, key, compute):
+        body = await compute()
+        await self.get_backend().set(key, body)
+        return body
+
+    def not_modified(self, endpoint, user_id, version, if_none_match):
+        if not if_none_match:
+            return None
+        etag = etag_for(cache_key(endpoint, user_id, version))
+        tags = {tag.strip() for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            RESPONSE_CACHE_REQUESTS.inc(endpoint=endpoint, result="not_modified")
+            return etag
+        return None
+
+    async def invalidate(self, model_name, keep_version=None):
+        # Drops the entries of every endpoint computed from model_name, except
+        # those already computed from keep_version
+        keep_suffix = f":{keep_version}" if keep_version is not None else None
+        for endpoint in self.dependents.get(model_name, ()):
+            await self.get_backend().delete_prefix(f"{endpoint}:", keep_suffix)
+
+    def model_changed(self, model_name, model):
+        # FactorModelCache listener; runs inside its async callers
+        if model_name in self.dependents:
+            asyncio.get_running_loop().create_task(self.invalidate(model_name, model_version(model, self.model_tables.get(model_name))))
+
+    async def clear(self):
+        await self.get_backend().clear()
+
+response_cache = ResponseCache()
+factor_models.listeners.append(response_cache.model_changed)
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from config import SIMILARITY_INDEX, SIMILARITY_LSH_BITS, SIMILARITY_LSH_TABLES
+from data_processing import row_scale
+from ranking import DEFAULT_BLOCK_SIZE, top_k
+
+def item_embeddings(model):
+    # Items in the latent space, Σ·Vt per signal (σ recovered from the column
+    # norms of U·Σ), weighted like the blended scores and stacked along k
+    parts = []
+    for user_factors, item_factors, weight in model.signals.values():
+        sigma = np.sqrt(np.square(user_factors, dtype=np.float32).sum(axis=0))
+        parts.append(weight * sigma[:, None] * item_factors)
+    if not parts:
+        return np.zeros((model.shape[1], 1), dtype=np.float32)
+    return np.ascontiguousarray(np.vstack(parts).T, dtype=np.float32)
+
+class ExactIndex:
+    # Blocked cosine search. Vectors are unit-normalized once at build time, so
+    # a query is one matrix product per block. Items with an all-zero embedding
+    # (no signal at fit time) are left out.
+
+    def __init__(self, ids, vectors, block_size=DEFAULT_BLOCK_SIZE):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1)
+        keep = norms > 0
+        self.ids = np.asarray(ids)[keep]
+        self.vectors = vectors[keep] * row_scale(norms[keep])[:, None]
+        self.positions = pd.Index(self.ids)
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position_of(self, item_id):
+        position = self.positions.get_indexer([item_id])[0]
+        return None if position == -1 else int(position)
+
+    def search(self, positions, k):
+        # Top k neighbours of the items at positions, excluding the items
+        # themselves. Returns flat (query row, neighbour position, cosine) arrays.
+        positions = np.asarray(positions, dtype=np.int64)
+        exclude = csr_matrix((np.ones(len(positions), dtype=bool), (np.arange(len(positions)), positions)), shape=(len(positions), len(self)))
+        return top_k(self.vectors[positions], self.vectors.T, k, exclude=exclude, block_size=self.block_size)
+
+    def similar(self, item_id, k=10):
+        position = self.position_of(item_id)
+        if position is None:
+            return None
+        _, neighbours, scores = self.search([position], k)
+        return list(zip(self.ids[neighbours].tolist(), scores.tolist()))
+
+class LSHIndex(ExactIndex):
+    # Random-projection LSH: each of `tables` hash tables keys items by the
+    # signs of `bits` random hyperplane projections. A query is scored exactly
+    # against the union of its buckets, so recall < 1 but the scan covers only
+    # the candidates.
+
+    def __init__(self, ids, vectors, bits=SIMILARITY_LSH_BITS, tables=SIMILARITY_LSH_TABLES, seed=0, block_size=DEFAULT_BLOCK_SIZE):
+        super().__init__(ids, vectors, block_size)
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((tables, bits, self.vectors.shape[1])).astype(np.float32)
+        self.weights = np.int64(1) << np.arange(bits, dtype=np.int64)
+        self.tables = []
+        for planes in self.planes:
+            codes = self.hash(planes, self.vectors)
+            order = np.argsort(codes, kind='stable')
+            keys, starts = np.unique(codes[order], return_index=True)
+            self.tables.append((keys, np.append(starts, len(order)), order))
+
+    def hash(self, planes, vectors):
+        return ((vectors @ planes.T) > 0) @ self.weights
+
+    def candidates(self, position):
+        vector = self.vectors[position:position + 1]
+        found = []
+        for planes, (keys, bounds, order) in zip(self.planes, self.tables):
+            code = self.hash(planes, vector)[0]
+            slot = np.searchsorted(keys, code)
+            if slot < len(keys) and keys[slot] == code:
+                found.append(order[bounds[slot]:bounds[slot + 1]])
+        candidates = np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+        return candidates[candidates != position]
+
+    def search(self, positions, k):
+        query_rows, neighbour_parts, score_parts = [], [], []
+        for row, position in enumerate(np.asarray(positions, dtype=np.int64).tolist()):
+            candidates = self.candidates(position)
+            if not len(candidates):
+                continue
+            _, best, scores = top_k(self.vectors[position:position + 1], self.vectors[candidates].T, k)
+            query_rows.append(np.full(len(best), row, dtype=np.int32))
+            neighbour_parts.append(candidates[best].astype(np.int32))
+            score_parts.append(scores)
+        if not query_rows:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        return np.concatenate(query_rows), np.concatenate(neighbour_parts), np.concatenate(score_parts)
+
+INDEX_TYPES = {"exact": ExactIndex, "lsh": LSHIndex}
+
+def build_index(model, kind=SIMILARITY_INDEX):
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown similarity index: {kind}")
+    return INDEX_TYPES[kind](model.item_ids, item_embeddings(model))
+
+class SimilarityIndexCache:
+    # One index per model name, rebuilt when the model behind it changes
+    # (refit, fold-in or a newly published artifact)
+
+    def __init__(self, kind=SIMILARITY_INDEX):
+        self.kind = kind
+        self.indexes = {}
+
+    def get(self, name, model):
+        key = (id(model), model.version, model.artifact_version, model.shape)
+        cached = self.indexes.get(name)
+        if cached is None or cached[0] != key:
+            cached = key, build_index(model, self.kind)
+            self.indexes[name] = cached
+        return cached[1]
+
+    def clear(self):
+        self.indexes.clear()
+
+similarity_indexes = SimilarityIndexCache()
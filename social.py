@@ -0,0 +1,216 @@
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, diags
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import STREAMING_INGESTION
+from data_processing import row_scale, stream_matrices
+from interaction_store import interaction_store
+from matrices import MAP_LOCK, MatrixAccumulator, build_interaction_matrix, id_map
+
+SOCIAL_TABLES = ['follow', 'game_session']
+# With STREAMING_INGESTION the plays matrix is streamed, not read from the store
+SOCIAL_STORE_TABLES = ['follow'] if STREAMING_INGESTION else SOCIAL_TABLES
+
+PAGERANK_DAMPING = 0.85
+PAGERANK_TOLERANCE = 1e-6
+PAGERANK_MAX_ITERATIONS = 100
+
+def pagerank(adjacency, damping=PAGERANK_DAMPING, tol=PAGERANK_TOLERANCE, max_iter=PAGERANK_MAX_ITERATIONS):
+    # Power iteration on the follower -> followed graph: rank flows along
+    # follows, split evenly over each user's out-edges; users who follow nobody
+    # spread their rank uniformly
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.empty(0, dtype=np.float64)
+    out_degree = np.asarray(adjacency.sum(axis=1), dtype=np.float64).ravel()
+    inverse_degree = row_scale(out_degree).astype(np.float64)
+    dangling = out_degree == 0
+    incoming = adjacency.T.tocsr()
+
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        updated = damping * (incoming @ (rank * inverse_degree) + rank[dangling].sum() / n) + (1 - damping) / n
+        converged = np.abs(updated - rank).sum() < tol
+        rank = updated
+        if converged:
+            break
+    return rank
+
+def resized(matrix, shape):
+    if matrix.shape != shape:
+        matrix = matrix.copy()
+        matrix.resize(shape)
+    return matrix
+
+class SocialGraph:
+    # Follower -> followed adjacency (CSR, one stored 1 per edge) over the
+    # shared user IndexMap. New follow rows are appended as they arrive in the
+    # interaction store; unfollows are not tracked, like the store itself.
+    # Derived results (PageRank, the plays matrix) are cached per version.
+
+    def __init__(self, user_map="user", game_map="game"):
+        self.user_map = id_map(user_map)
+        self.game_map = id_map(game_map)
+        self.adjacency = csr_matrix((0, 0), dtype=np.float32)
+        self.max_follow_id = None
+        self.version = 0
+        self._pagerank = None
+        self._plays = None
+
+    @property
+    def shape(self):
+        with MAP_LOCK:
+            return len(self.user_map), len(self.user_map)
+
+    def update(self, follows):
+        # Adds follow rows past the highest follow_id seen so far
+        if self.max_follow_id is not None:
+            follows = follows[follows['follow_id'] > self.max_follow_id]
+        if follows.empty:
+            return self
+
+        with MAP_LOCK:
+            self.user_map.add(follows['follower_id'].to_numpy())
+            self.user_map.add(follows['following_id'].to_numpy())
+            rows = self.user_map.to_index(follows['follower_id'].to_numpy())
+            cols = self.user_map.to_index(follows['following_id'].to_numpy())
+            shape = len(self.user_map), len(self.user_map)
+
+        edges = coo_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape).tocsr()
+        adjacency = resized(self.adjacency, shape) + edges
+        adjacency.data[:] = 1
+        self.adjacency = adjacency
+        self.max_follow_id = int(follows['follow_id'].max())
+        self.version += 1
+        self._pagerank = None
+        return self
+
+    def current_adjacency(self):
+        # Padded to users added to the shared map by other matrices
+        self.adjacency = resized(self.adjacency, self.shape)
+        return self.adjacency
+
+    def following(self, user_index):
+        return self.current_adjacency()[user_index].indices
+
+    def friends_of_friends(self, user_id, k=10):
+        # Users two hops away, ranked by the number of distinct paths (mutual
+        # follows), excluding the user and the users they already follow
+        user_index = self.user_map.index_of(user_id)
+        if user_index is None:
+            return []
+        adjacency = self.current_adjacency()
+        paths = (adjacency[user_index] @ adjacency).tocoo()
+        exclude = np.append(adjacency[user_index].indices, user_index)
+        keep = ~np.isin(paths.col, exclude)
+        candidates, counts = paths.col[keep], paths.data[keep]
+        order = np.lexsort((candidates, -counts))[:k]
+        return list(zip(self.user_map.to_id(candidates[order]).tolist(), counts[order].astype(int).tolist()))
+
+    def pagerank(self):
+        if self._pagerank is None or self._pagerank[0] != self.shape:
+            self._pagerank = self.shape, pagerank(self.current_adjacency())
+        return self._pagerank[1]
+
+    def influence(self, user_ids):
+        # PageRank scaled so the average user scores 1; unknown users get 0
+        ranks = self.pagerank()
+        ranks = ranks * len(ranks)
+        indices = self.user_map.to_index(user_ids)
+        inside = (indices >= 0) & (indices < len(ranks))
+        influence = np.zeros(len(indices), dtype=np.float64)
+        influence[inside] = ranks[indices[inside]]
+        return influence
+
+    def plays(self, sessions, version):
+        # users x games matrix marking which games each user has played
+        if self._plays is None or self._plays[0] != version:
+            self.set_plays(build_interaction_matrix(sessions, 'user_id', 'game_id', row_map=self.user_map, col_map=self.game_map).matrix, version)
+        return self._plays[1]
+
+    def set_plays(self, matrix, version):
+        # Binarized copy of a users x games play count matrix
+        matrix = matrix.copy()
+        matrix.data[:] = 1
+        self._plays = version, matrix
+        return matrix
+
+    def current_plays(self):
+        return self._plays[1] if self._plays is not None else None
+
+    def games_from_follows(self, user_ids, plays):
+        # For each user, how many of the users they follow played each game:
+        # rows of A · S, as a users x games CSR matrix
+        adjacency = self.current_adjacency()
+        plays = resized(plays, (adjacency.shape[1], len(self.game_map)))
+        indices = self.user_map.to_index(user_ids)
+        indices = indices[indices >= 0]
+        return adjacency[indices] @ plays
+
+    def follow_play_shares(self, user_ids, game_ids, plays):
+        # len(user_ids) x len(game_ids) CSR of the share of each user's follows
+        # that played each game, as one product D⁻¹ · A[users] · S · P where P
+        # selects game_ids' columns; unknown users and games get empty rows/columns
+        adjacency = self.current_adjacency()
+        plays = resized(plays, (adjacency.shape[1], len(self.game_map)))
+        user_indices = self.user_map.to_index(user_ids)
+        known = (user_indices >= 0) & (user_indices < adjacency.shape[0])
+        following = diags(known.astype(np.float32)) @ adjacency[np.where(known, user_indices, 0)]
+        counts = np.asarray(following.sum(axis=1), dtype=np.float32).ravel()
+
+        game_indices = self.game_map.to_index(game_ids)
+        columns = np.flatnonzero((game_indices >= 0) & (game_indices < plays.shape[1]))
+        select = csr_matrix((np.ones(len(columns), dtype=np.float32), (game_indices[columns], columns)), shape=(plays.shape[1], len(game_ids)))
+        return (diags(row_scale(counts)) @ following @ plays @ select).tocsr().astype(np.float32)
+
+social_graph = SocialGraph()
+
+async def get_social_graph(db: AsyncSession):
+    data = await interaction_store.get_data(db, tables=SOCIAL_STORE_TABLES)
+    social_graph.update(data['follow'])
+    return social_graph, data
+
+async def stream_plays(db: AsyncSession, graph):
+    plays, = await stream_matrices(db, 'game_session', [MatrixAccumulator('user_id', 'game_id', row_map=graph.user_map, col_map=graph.game_map)], columns=['user_id', 'game_id'])
+    return graph.set_plays(plays.matrix, None)
+
+async def get_social_plays(db: AsyncSession):
+    # The graph plus its users x games plays matrix
+    graph, data = await get_social_graph(db)
+    if STREAMING_INGESTION:
+        # Refreshed from the play counts of each streamed game model fit
+        # (recommendation.refit_game_model); streamed here only before the first
+        plays = graph.current_plays()
+        return graph, plays if plays is not None else await stream_plays(db, graph)
+    return graph, graph.plays(data['game_session'], interaction_store.version(['game_session']))
+
+async def follow_plays(db: AsyncSession, user_id):
+    # (1 x games CSR counting the user's follows that played each game,
+    # number of users they follow)
+    graph, plays = await get_social_plays(db)
+    user_index = graph.user_map.index_of(user_id)
+    if user_index is None:
+        return None, 0
+    following = len(graph.following(user_index))
+    if not following:
+        return None, 0
+    return graph.games_from_follows([user_id], plays), following
+
+async def games_from_follows(db: AsyncSession, user_id, k=10):
+    # Top games among the users this user follows, with the share of those
+    # follows that played each one
+    counts, following = await follow_plays(db, user_id)
+    if counts is None:
+        return []
+    counts = counts.tocoo()
+    order = np.lexsort((counts.col, -counts.data))[:k]
+    game_ids = social_graph.game_map.to_id(counts.col[order])
+    return [(game_id, count / following) for game_id, count in zip(game_ids.tolist(), counts.data[order].tolist())]
+
+async def follow_play_shares(db: AsyncSession, user_id, game_ids):
+    # Dense share of follows that played each of game_ids, 0 without follows
+    shares = await follow_play_shares_batch(db, [user_id], game_ids)
+    return shares.toarray().ravel()
+
+async def follow_play_shares_batch(db: AsyncSession, user_ids, game_ids):
+    graph, plays = await get_social_plays(db)
+    return graph.follow_play_shares(user_ids, game_ids, plays)
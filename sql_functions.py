@@ -0,0 +1,43 @@
+import re
+import pandas as pd
+from sqlalchemy import Float, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+class interval_seconds(FunctionElement):
+    # Seconds in an interval value. session_total_time is a Postgres interval
+    # (Text in the models), so the conversion is dialect specific.
+    type = Float()
+    name = 'interval_seconds'
+    inherit_cache = True
+
+@compiles(interval_seconds)
+def compile_interval_seconds(element, compiler, **kw):
+    # Elsewhere a SQL function of the same name, see register_sql_functions
+    return "interval_seconds(%s)" % compiler.process(element.clauses, **kw)
+
+@compiles(interval_seconds, 'postgresql')
+def compile_interval_seconds_postgresql(element, compiler, **kw):
+    return "EXTRACT(EPOCH FROM CAST(%s AS INTERVAL))" % compiler.process(element.clauses, **kw)
+
+# '1 day, 2:03:04.5', '1 day 02:03:04' or '02:03:04'
+INTERVAL_PATTERN = re.compile(r'^\s*(?:(-?\d+)\s+days?,?\s*)?(-?\d+):(\d+):(\d+(?:\.\d*)?)\s*$')
+
+def parse_interval_seconds(value):
+    if value is None:
+        return None
+    match = INTERVAL_PATTERN.match(str(value))
+    if match is None:
+        seconds = pd.to_timedelta(value, errors='coerce')
+        return None if pd.isna(seconds) else seconds.total_seconds()
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def register_sql_functions(engine):
+    # SQLite has no interval type; interval_seconds() is provided per connection
+    sync_engine = getattr(engine, 'sync_engine', engine)
+    if sync_engine.dialect.name == 'sqlite':
+        @event.listens_for(sync_engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.create_function('interval_seconds', 1, parse_interval_seconds, deterministic=True)
+    return engine
@@ -6,11 +6,11 @@ redis-server &
 
 # # Start Celery worker
 # echo "Starting Celery worker..."
-# celery -A main.celery worker --loglevel=info &
+# celery -A tasks.celery worker --loglevel=info &
 
 # # Start Celery beat
 # echo "Starting Celery beat..."
-# celery -A main.celery beat --loglevel=info &
+# celery -A tasks.celery beat --loglevel=info &
 
 # Start FastAPI application
 echo "Starting FastAPI application..."
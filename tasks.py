@@ -0,0 +1,37 @@
+import asyncio
+from celery_config import crontab, make_celery
+
+celery = make_celery('pe_data_process')
+
+celery.conf.beat_schedule = {
+    'update-recommendations-every-night': {
+        'task': 'tasks.update_recommendations',
+        'schedule': crontab(hour=0, minute=0),
+    },
+}
+
+# One event loop per worker process: the engine's pooled connections and the
+# module-level asyncio locks are bound to the loop they were first used on
+worker_loop = None
+
+def run_job(kind, **params):
+    # Runs the pipeline through the same JobRunner the API uses and returns the
+    # job record, with its stage timings, as the task result
+    global worker_loop
+    from db import engine
+    from jobs import job_runner
+    from migrations import migrate
+
+    if worker_loop is None:
+        worker_loop = asyncio.new_event_loop()
+        worker_loop.run_until_complete(migrate(engine))
+    job = worker_loop.run_until_complete(job_runner.run_now(kind, **params))
+    return job.to_dict()
+
+@celery.task(name='tasks.update_recommendations')
+def update_recommendations():
+    return run_job('recompute')
+
+@celery.task(name='tasks.update_recommendations_for_user')
+def update_recommendations_for_user(user_id: int):
+    return run_job('recompute_user', user_id=user_id)
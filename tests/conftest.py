@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+
+# Settings are read when config is imported, so they are fixed before any
+# service module loads: a throwaway SQLite database, no refresh throttling and
+# per-process caches only
+DATABASE_PATH = os.path.join(tempfile.mkdtemp(prefix="pe-tests-"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+os.environ["INTERACTION_STORE_REFRESH_SECONDS"] = "0"
+os.environ["RESPONSE_CACHE_BACKEND"] = "memory"
+os.environ["FEED_STORE_BACKEND"] = "memory"
+for name in ("MODEL_ARTIFACT_DIR", "STREAMING_INGESTION", "AGGREGATION_ROLLUPS", "JOB_SCHEDULE_SECONDS"):
+    os.environ.pop(name, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datetime import datetime
+import httpx
+import pytest
+import models
+from db import SessionLocal, engine
+from factor_model import factor_models
+from feed_store import feed_store
+from interaction_store import interaction_store
+from main import app
+from response_cache import response_cache
+
+SEED_TIME = datetime(2026, 1, 1)
+
+# user_id -> game ids played, one session each
+SESSIONS = {
+    1: [1, 2, 3],
+    2: [1, 2],
+    3: [2, 4],
+    4: [3, 4, 5],
+    5: [1, 5],
+    6: [2, 3, 5],
+}
+# (follower_id, following_id)
+FOLLOWS = [(1, 2), (1, 3), (2, 1), (3, 4), (4, 1), (5, 6), (6, 1)]
+# (user_id, playlist_id, completed)
+PLAYLIST_SESSIONS = [(1, 1, True), (1, 2, False), (2, 2, True), (3, 1, True), (4, 3, True), (5, 4, True), (6, 3, False)]
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+def seed_rows():
+    rows = [models.User(id=user_id, username=f"user{user_id}", password="x", created_date=SEED_TIME) for user_id in SESSIONS]
+    rows += [models.Game(id=game_id, user_id=1, title=f"game{game_id}", created_at=SEED_TIME, updated_at=SEED_TIME) for game_id in range(1, 6)]
+    rows += [models.Playlist(id=playlist_id, owner_id=1, created_at=SEED_TIME, updated_at=SEED_TIME) for playlist_id in range(1, 5)]
+    for user_id, game_ids in SESSIONS.items():
+        for position, game_id in enumerate(game_ids):
+            rows.append(models.GameSession(
+                game_id=game_id, user_id=user_id, created_at=SEED_TIME, updated_at=SEED_TIME,
+                session_total_time=f"00:{10 * (position + 1):02d}:00", session_total_score=10,
+            ))
+            rows.append(models.Activity(user_id=user_id, target_id=game_id, activity_type="active", target_type="game", timestamp=SEED_TIME))
+        rows.append(models.Review(user_id=user_id, game_id=game_ids[0], rating=4))
+        rows.append(models.Favorite(user_id=user_id, game_id=game_ids[-1], timestamp=SEED_TIME))
+        rows.append(models.Comment(user_id=user_id, game_id=game_ids[0], comment_text="nice", created_at=SEED_TIME))
+    rows += [models.Follow(follower_id=follower_id, following_id=following_id, timestamp=SEED_TIME) for follower_id, following_id in FOLLOWS]
+    rows += [
+        models.PlaylistSession(user_id=user_id, playlist_id=playlist_id, completed=completed, created_at=SEED_TIME, updated_at=SEED_TIME)
+        for user_id, playlist_id, completed in PLAYLIST_SESSIONS
+    ]
+    return rows
+
+@pytest.fixture
+async def db():
+    # A freshly seeded database and empty process-wide caches per test. The
+    # shared id maps are append-only and keep their ids across tests.
+    async with engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.drop_all)
+        await connection.run_sync(models.Base.metadata.create_all)
+    interaction_store.reset()
+    factor_models.clear()
+    await response_cache.clear()
+    await feed_store.clear()
+    async with SessionLocal() as session:
+        session.add_all(seed_rows())
+        await session.commit()
+        yield session
+    await engine.dispose()
+
+@pytest.fixture
+async def client(db):
+    # Requests run on the test's event loop against the same database
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
@@ -0,0 +1,28 @@
+import asyncio
+import threading
+import time
+import pytest
+from compute import ComputeExecutor, ComputeTimeoutError
+
+pytestmark = pytest.mark.anyio
+
+async def test_thread_lookups_do_not_queue_behind_heavy_jobs():
+    executor = ComputeExecutor(kind="thread", max_workers=4, max_concurrency=1)
+    release = threading.Event()
+    try:
+        heavy = [asyncio.ensure_future(executor.run(release.wait, 5)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        assert await executor.run_in_thread(sum, [1, 2], timeout=1) == 3
+        release.set()
+        assert await asyncio.gather(*heavy) == [True, True]
+    finally:
+        release.set()
+        executor.shutdown()
+
+async def test_jobs_past_their_timeout_raise():
+    executor = ComputeExecutor(kind="thread", max_workers=1)
+    try:
+        with pytest.raises(ComputeTimeoutError):
+            await executor.run(time.sleep, 0.5, timeout=0.05)
+    finally:
+        executor.shutdown()
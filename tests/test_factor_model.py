@@ -0,0 +1,97 @@
+from datetime import datetime
+import numpy as np
+import pytest
+import models
+from artifacts import artifact_store
+from factor_model import factor_models, model_to_artifact
+from matrices import id_map
+from recommendation import GAME_SIGNAL_TABLES, get_game_model
+from response_cache import PROCESS_ID, model_version
+
+pytestmark = pytest.mark.anyio
+
+async def add_session(db, user_id, game_id):
+    now = datetime.utcnow()
+    db.add(models.GameSession(game_id=game_id, user_id=user_id, created_at=now, updated_at=now, session_total_time="00:05:00", session_total_score=1))
+    await db.commit()
+
+async def test_a_folded_user_counts_once_towards_drift(db):
+    await get_game_model(db)
+    await add_session(db, 3, 1)
+    folded = await get_game_model(db)
+
+    assert folded.folded_users == {3}
+    assert folded.drift == pytest.approx(1 / sum(folded.fitted_shape))
+    # needs_refit unions the folded users with the changed ones; user 3 is the same user in both
+    threshold = 1.5 / sum(folded.fitted_shape)
+    assert not folded.needs_refit([3], max_drift=threshold)
+    assert folded.needs_refit([3, 4], max_drift=threshold)
+
+async def test_fold_in_swaps_in_a_new_model(db):
+    model = await get_game_model(db)
+    before = {name: user_factors.copy() for name, (user_factors, _, _) in model.signals.items()}
+    await add_session(db, 3, 1)
+    folded = await get_game_model(db)
+
+    assert folded is not model
+    assert model.folded_users == set()
+    for name, (user_factors, _, _) in model.signals.items():
+        np.testing.assert_array_equal(user_factors, before[name])
+    assert model_version(folded) != model_version(model)
+    assert await get_game_model(db) is folded
+
+async def test_ids_added_by_other_models_are_not_folded_items(db):
+    model = await get_game_model(db)
+    id_map("game").add([424242])
+    await add_session(db, 3, 1)
+    folded = await get_game_model(db)
+
+    assert folded.folded_items == 0
+    assert folded.shape[1] == model.shape[1]
+
+async def test_a_new_game_is_folded_in_as_an_item(db):
+    model = await get_game_model(db)
+    await add_session(db, 3, 616161)
+    folded = await get_game_model(db)
+
+    assert folded.folded_items == 1
+    assert 616161 in folded.item_ids.tolist()
+    assert 616161 not in model.item_ids.tolist()
+
+async def test_fold_in_into_an_artifact_model_updates_the_folded_user(db, tmp_path, monkeypatch):
+    model = await get_game_model(db)
+    # Publish the model as another worker would, with its users in a
+    # different first-seen order than this process's shared map
+    arrays, manifest = model_to_artifact(model)
+    order = np.arange(model.shape[0])[::-1]
+    arrays["row_ids"] = arrays["row_ids"][order]
+    for name in [name for name in arrays if name.endswith("user_factors")]:
+        arrays[name] = arrays[name][order]
+    interactions = model.interactions.tocsr()[order]
+    arrays["interactions_data"], arrays["interactions_indices"], arrays["interactions_indptr"] = interactions.data, interactions.indices, interactions.indptr
+    monkeypatch.setattr(artifact_store, "root", str(tmp_path))
+    monkeypatch.setattr(artifact_store, "poll_interval", 0)
+    monkeypatch.setattr(artifact_store, "loaded", {})
+    artifact_store.save("game", arrays, manifest)
+    factor_models.clear()
+
+    await add_session(db, 3, 1)
+    folded = await get_game_model(db)
+    assert folded.artifact_version is not None
+    assert folded.folded_users == {3}
+    # Named by shared data and artifact, so every worker in this state shares cache entries
+    assert model_version(folded, GAME_SIGNAL_TABLES).endswith(f"@{folded.artifact_version}")
+    assert PROCESS_ID not in model_version(folded, GAME_SIGNAL_TABLES)
+
+    # The same fold-in into the model fitted here
+    monkeypatch.setattr(artifact_store, "root", None)
+    factor_models.models["game"] = model
+    expected = await get_game_model(db)
+    assert expected.folded_users == {3}
+
+    scores = dict(zip(folded.item_ids.tolist(), folded.score_user(3).tolist()))
+    expected_scores = dict(zip(expected.item_ids.tolist(), expected.score_user(3).tolist()))
+    assert scores == pytest.approx(expected_scores, abs=1e-5)
+    assert any(score != 0 for score in scores.values())
+    seen = folded.interactions.tocsr()[folded.user_index(3)].indices
+    assert 1 in folded.item_ids[seen].tolist()
@@ -0,0 +1,113 @@
+import asyncio
+import base64
+from datetime import timedelta
+import pytest
+from sqlalchemy import delete, func, text
+from sqlalchemy.future import select
+import models
+from conftest import SEED_TIME
+from db import engine
+from feed import build_user_feeds
+from feed_store import InvalidCursor, decode_cursor, encode_cursor, feed_store, generation_of, load_feed
+from migrations import migrate
+
+pytestmark = pytest.mark.anyio
+
+async def add_ranked_items(db, user_id, counts):
+    # counts: item_type -> number of items, the first of each type ranked highest
+    items = []
+    for item_type, count in counts.items():
+        for n in range(count):
+            item = models.DynamicItem(item_type=item_type, content={"n": n}, created_at=SEED_TIME)
+            db.add(item)
+            items.append(item)
+    await db.flush()
+    item_ids = [item.item_id for item in items]
+    for rank, item_id in enumerate(item_ids):
+        db.add(models.DynamicItemPriority(item_id=item_id, user_id=user_id, priority_score=1000 - rank))
+    await db.commit()
+    return item_ids
+
+async def read_all(db, user_id, limit):
+    item_ids, cursor = [], None
+    while True:
+        page = await feed_store.page(db, user_id, cursor, limit)
+        item_ids += [item["item_id"] for item in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return item_ids
+
+async def test_migrate_backfills_positions_of_the_old_feed_layout(db):
+    item_ids = await add_ranked_items(db, 1, {"activity": 5})
+    await db.close()
+    # The old layout: no position column, position i stamped build time - i ms,
+    # and rows of an earlier build left behind
+    async with engine.begin() as connection:
+        await connection.execute(text("DROP TABLE dynamic_user_feed"))
+        await connection.execute(text("CREATE TABLE dynamic_user_feed (user_id INTEGER NOT NULL, item_id INTEGER NOT NULL, feed_timestamp TIMESTAMP NOT NULL, PRIMARY KEY (user_id, item_id))"))
+        built = SEED_TIME + timedelta(days=1)
+        layout = [item_ids[2], item_ids[0], item_ids[1]]
+        old_rows = [(item_id, built - timedelta(milliseconds=position)) for position, item_id in enumerate(layout)]
+        old_rows.append((item_ids[4], SEED_TIME))
+        for item_id, stamp in old_rows:
+            await connection.execute(text("INSERT INTO dynamic_user_feed (user_id, item_id, feed_timestamp) VALUES (1, :item_id, :stamp)"), {"item_id": item_id, "stamp": stamp})
+
+    # Applying it again, as every worker does at startup, changes nothing
+    await migrate(engine)
+    await migrate(engine)
+    generation, feed = await load_feed(db, 1)
+    assert generation == generation_of(built)
+    assert feed.tolist() == layout
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(1735689600000, 40)) == (1735689600000, 40)
+
+@pytest.mark.parametrize("cursor", ["%%%", base64.urlsafe_b64encode(b"a:b").decode(), encode_cursor(1, -1)])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+async def test_pages_follow_the_feed_layout(db):
+    await add_ranked_items(db, 1, {"activity": 6, "recommendation": 2, "ad": 1})
+    feed = await build_user_feeds(db)
+    await db.commit()
+    expected = feed[feed["user_id"] == 1]["item_id"].tolist()
+    assert len(expected) == 9
+
+    assert await read_all(db, 1, 4) == expected
+    # The same order is read back from dynamic_user_feed by another worker
+    await feed_store.clear()
+    assert await read_all(db, 1, 4) == expected
+    assert (await load_feed(db, 1))[1].tolist() == expected
+
+async def test_a_cursor_from_an_older_build_restarts_at_the_top(db):
+    await add_ranked_items(db, 1, {"activity": 6, "recommendation": 2, "ad": 1})
+    await build_user_feeds(db)
+    await db.commit()
+    first = await feed_store.page(db, 1, None, 4)
+
+    await asyncio.sleep(0.002)
+    await build_user_feeds(db)
+    await db.commit()
+    page = await feed_store.page(db, 1, first["next_cursor"], 4)
+    assert page["restarted"]
+    assert [item["item_id"] for item in page["items"]] == [item["item_id"] for item in first["items"]]
+
+async def test_a_shrinking_feed_drops_its_old_items(db):
+    item_ids = await add_ranked_items(db, 1, {"activity": 6, "recommendation": 2, "ad": 1})
+    await add_ranked_items(db, 2, {"activity": 3})
+    await build_user_feeds(db)
+    await db.commit()
+    other_feed = (await load_feed(db, 2))[1].tolist()
+
+    kept = item_ids[:3]
+    await db.execute(delete(models.DynamicItemPriority).where(models.DynamicItemPriority.user_id == 1, models.DynamicItemPriority.item_id.notin_(kept)))
+    await build_user_feeds(db, user_ids=[1])
+    await db.commit()
+
+    assert (await load_feed(db, 1))[1].tolist() == kept
+    rows = await db.execute(select(func.count()).select_from(models.DynamicUserFeed).where(models.DynamicUserFeed.user_id == 1))
+    assert rows.scalar() == 3
+    assert (await load_feed(db, 2))[1].tolist() == other_feed
+    await feed_store.clear()
+    assert await read_all(db, 1, 10) == kept
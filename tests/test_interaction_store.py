@@ -0,0 +1,57 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+import models
+from data_processing import fetch_data
+from interaction_store import InteractionStore
+
+pytestmark = pytest.mark.anyio
+
+def add_session(db, session_id, user_id, game_id, minutes):
+    now = datetime.utcnow()
+    db.add(models.GameSession(
+        game_session_id=session_id, game_id=game_id, user_id=user_id, created_at=now, updated_at=now,
+        session_total_time=f"00:{minutes:02d}:00", session_total_score=1,
+    ))
+
+def sorted_frame(frame, key):
+    return frame.sort_values(key).reset_index(drop=True)
+
+async def test_refreshes_hold_changes_apart_until_the_frame_is_read(db):
+    store = InteractionStore(refresh_interval=0)
+    await store.get_data(db, tables=["game_session"])
+    loaded = store.frames["game_session"]
+
+    add_session(db, 1000, 3, 1, 5)
+    await db.commit()
+    await store.refresh(db, ["game_session"])
+    # Nothing changed on a second refresh that re-reads the same rows
+    await store.refresh(db, ["game_session"])
+    assert store.version(["game_session"]) == (2,)
+    assert store.frames["game_session"] is loaded
+    assert len(store.pending["game_session"]) == 1
+
+    session = await db.get(models.GameSession, 1000)
+    session.session_total_time = "00:20:00"
+    session.updated_at = datetime.utcnow()
+    await db.commit()
+    await store.refresh(db, ["game_session"])
+    assert store.version(["game_session"]) == (3,)
+    assert store.changed_users(["game_session"], (1,)).tolist() == [3]
+    assert len(store.pending["game_session"]) == 1
+
+    frame = (await store.get_data(db, tables=["game_session"]))["game_session"]
+    assert "game_session" not in store.pending
+    expected = (await fetch_data(db, tables=["game_session"]))["game_session"]
+    pd.testing.assert_frame_equal(sorted_frame(frame, "game_session_id"), sorted_frame(expected, "game_session_id"))
+
+async def test_pending_rows_are_merged_once_they_pass_the_batch_size(db):
+    store = InteractionStore(refresh_interval=0, compact_rows=2)
+    await store.get_data(db, tables=["game_session"])
+    for session_id in (1000, 1001):
+        add_session(db, session_id, 3, 1, 5)
+        await db.commit()
+        await store.refresh(db, ["game_session"])
+
+    assert "game_session" not in store.pending
+    assert {1000, 1001} <= set(store.frames["game_session"]["game_session_id"])
@@ -0,0 +1,52 @@
+import asyncio
+from contextlib import nullcontext
+import pytest
+from jobs import JobRunner
+
+pytestmark = pytest.mark.anyio
+
+async def test_identical_jobs_share_one_run():
+    release = asyncio.Event()
+    calls = []
+
+    async def pipeline(db, stage, **params):
+        calls.append(params)
+        with stage("wait"):
+            await release.wait()
+        return params
+
+    runner = JobRunner(pipelines={"recompute_user": pipeline}, session_factory=nullcontext)
+    first, created = runner.submit("recompute_user", user_id=1)
+    duplicate, duplicate_created = runner.submit("recompute_user", user_id=1)
+    other, other_created = runner.submit("recompute_user", user_id=2)
+    assert created and other_created and not duplicate_created
+    assert duplicate is first
+
+    release.set()
+    await asyncio.gather(first.task, other.task)
+    assert first.status == "succeeded"
+    assert first.result == {"user_id": 1}
+    assert [stage["name"] for stage in first.stages] == ["wait"]
+    assert len(calls) == 2
+
+    # Once finished, the same job can be submitted again
+    again, created = runner.submit("recompute_user", user_id=1)
+    assert created and again is not first
+    await again.task
+
+async def test_a_failed_job_records_its_error():
+    async def pipeline(db, stage):
+        with stage("boom"):
+            raise RuntimeError("boom")
+
+    runner = JobRunner(pipelines={"recompute": pipeline}, session_factory=nullcontext)
+    job, _ = runner.submit("recompute")
+    await job.task
+    assert job.status == "failed"
+    assert job.error == "boom"
+    assert job.stages[0]["status"] == "failed"
+    assert runner.submit("recompute")[1]
+
+def test_unknown_job_kinds_are_rejected():
+    with pytest.raises(ValueError):
+        JobRunner(pipelines={}).submit("recompute")
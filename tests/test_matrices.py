@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+from matrices import CountAccumulator, IndexMap, MatrixAccumulator, align_matrices, build_interaction_matrix
+
+FRAME = pd.DataFrame({
+    "user_id": [1, 1, 2, 3, 1, 2, 4],
+    "game_id": [10, 10, 11, 10, 12, 11, 13],
+    "rating": [1, 4, 2, 5, 3, 3, 0],
+})
+
+def test_index_map_keeps_first_seen_indices():
+    ids = IndexMap([5, 3])
+    ids.add([3, 7, 5])
+    assert ids.to_index([5, 3, 7, 9]).tolist() == [0, 1, 2, -1]
+    assert ids.to_id([2, 0]).tolist() == [7, 5]
+    assert ids.index_of(9) is None
+
+def test_matrices_built_one_after_another_align():
+    rows, cols = IndexMap(), IndexMap()
+    first = build_interaction_matrix(pd.DataFrame({"user_id": [1, 2], "game_id": [10, 11]}), "user_id", "game_id", row_map=rows, col_map=cols)
+    second = build_interaction_matrix(pd.DataFrame({"user_id": [3], "game_id": [12]}), "user_id", "game_id", row_map=rows, col_map=cols)
+    assert first.shape == (2, 2)
+
+    first, second = align_matrices(first, second)
+    assert first.shape == second.shape == (3, 3)
+    assert first.row(2).tolist() == [0, 1, 0]
+    assert second.row(3).tolist() == [0, 0, 1]
+
+@pytest.mark.parametrize("value, agg", [(None, "sum"), ("rating", "max")])
+def test_accumulator_matches_build_interaction_matrix(value, agg):
+    expected = build_interaction_matrix(FRAME, "user_id", "game_id", value=value, agg=agg, row_map=IndexMap(), col_map=IndexMap())
+    accumulator = MatrixAccumulator("user_id", "game_id", value=value, agg=agg, row_map=IndexMap(), col_map=IndexMap(), compact_size=2)
+    for start in range(0, len(FRAME), 3):
+        accumulator.add(FRAME.iloc[start:start + 3])
+    result = accumulator.result()
+
+    assert result.row_map.ids.tolist() == expected.row_map.ids.tolist()
+    assert result.col_map.ids.tolist() == expected.col_map.ids.tolist()
+    np.testing.assert_array_equal(result.matrix.toarray(), expected.matrix.toarray())
+
+def test_count_accumulator_matches_groupby():
+    accumulator = CountAccumulator(["user_id"])
+    for start in range(0, len(FRAME), 2):
+        accumulator.add(FRAME.iloc[start:start + 2])
+    pd.testing.assert_series_equal(accumulator.result().sort_index(), FRAME.groupby("user_id").size().astype(np.int64), check_names=False)
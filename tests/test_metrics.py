@@ -0,0 +1,19 @@
+from metrics import Counter, Gauge, Histogram, Registry
+
+def test_registry_renders_every_metric_kind():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "Requests", ["route"]))
+    size = registry.register(Gauge("queue_size", "Queue size"))
+    seconds = registry.register(Histogram("stage_seconds", "Stage time", ["stage"], buckets=(0.1, 1.0)))
+    requests.inc(route="/feed")
+    requests.inc(2, route="/feed")
+    size.set(4)
+    seconds.observe(0.5, stage="fit")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{route="/feed"} 3' in lines
+    assert "queue_size 4" in lines
+    assert 'stage_seconds_bucket{stage="fit",le="0.1"} 0' in lines
+    assert 'stage_seconds_bucket{stage="fit",le="+Inf"} 1' in lines
+    assert 'stage_seconds_count{stage="fit"} 1' in lines
@@ -0,0 +1,74 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from sqlalchemy.future import select
+import models
+from conftest import PLAYLIST_SESSIONS, SESSIONS
+from export import RecommendationExport, prepare_export
+from main import get_engagement_model
+from matrices import id_map
+from pipelines import get_playlist_model, update_playlist_recommendations
+from ranking import top_k
+from recommendation import fetch_recommendations, fetch_recommendations_batch, get_game_model
+
+pytestmark = pytest.mark.anyio
+
+GAME_IDS = {game_id for game_ids in SESSIONS.values() for game_id in game_ids}
+
+async def test_non_game_activity_targets_stay_out_of_the_game_models(db):
+    db.add(models.Activity(user_id=1, target_id=987654, activity_type="active", target_type="comment", timestamp=datetime.utcnow()))
+    await db.commit()
+
+    game_model = await get_game_model(db)
+    engagement_model = await get_engagement_model(db)
+    assert 987654 not in game_model.item_ids.tolist()
+    assert 987654 not in engagement_model.item_ids.tolist()
+    assert 987654 not in id_map("game")
+
+async def test_unobserved_games_in_the_shared_map_are_never_recommended(db, client):
+    # Another model put an id into the shared game map before this fit
+    id_map("game").add([555555])
+
+    response = await client.post("/recommendations/batch", json={"user_ids": list(SESSIONS), "k": 20})
+    recommended = {item["item_id"] for user in response.json()["recommendations"] for item in user["recommendations"]}
+    assert recommended
+    assert recommended <= GAME_IDS
+
+    single = {item["item_id"] for item in await fetch_recommendations(1, db)}
+    assert single == GAME_IDS
+
+async def test_users_without_playlist_sessions_get_no_playlist_recommendations(db):
+    # Users other models put into the shared user map have empty rows here
+    id_map("user").add([444444])
+    await db.execute(models.PlaylistSession.__table__.delete().where(models.PlaylistSession.user_id.in_([3, 4])))
+    await db.commit()
+
+    await update_playlist_recommendations(db)
+    rows = await db.execute(select(models.DynamicItemPriority.user_id).distinct())
+    assert set(rows.scalars()) == {user_id for user_id, _, _ in PLAYLIST_SESSIONS} - {3, 4}
+
+    model = await get_playlist_model(db)
+    assert model.user_index(444444) is None
+    assert model.user_index(3) is None
+    users, _, _ = model.top_k(3, user_indices=model.row_map.to_index([1, 3, 444444]))
+    assert set(model.user_ids[users].tolist()) == {1}
+
+async def test_unobserved_users_are_left_out_of_batches_and_exports(db):
+    id_map("user").add([444445])
+    recommendations, unknown = await fetch_recommendations_batch(db, [1, 444445])
+    assert list(recommendations) == [1]
+    assert unknown == [444445]
+
+    export = await prepare_export(db)
+    assert isinstance(export, RecommendationExport)
+    exported = np.concatenate([export.block(start)[0] for start in range(0, export.users, export.block_size)])
+    assert set(exported.tolist()) == set(SESSIONS)
+
+def test_top_k_leaves_masked_items_out():
+    user_factors = np.ones((2, 1), dtype=np.float32)
+    item_factors = np.array([[3.0, 0.0, -1.0, 2.0]], dtype=np.float32)
+    item_mask = np.array([True, False, True, True])
+
+    users, items, scores = top_k(user_factors, item_factors, 4, item_mask=item_mask)
+    assert 1 not in items.tolist()
+    assert items[users == 0].tolist() == [0, 3, 2]
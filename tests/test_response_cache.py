@@ -0,0 +1,81 @@
+from datetime import datetime
+import pytest
+import models
+from interaction_store import InteractionStore
+from recommendation import get_game_model
+from response_cache import PROCESS_ID, ResponseCache, cache_key, model_version
+
+pytestmark = pytest.mark.anyio
+
+async def test_playlist_recommendations_miss_after_a_new_playlist_session(db, client):
+    first = await client.post("/fetch_playlist_recommendations/1")
+    cached = await client.post("/fetch_playlist_recommendations/1")
+    assert cached.headers["x-cache"] == "hit"
+
+    now = datetime.utcnow()
+    db.add(models.PlaylistSession(user_id=1, playlist_id=4, completed=True, created_at=now, updated_at=now))
+    await db.commit()
+
+    fresh = await client.post("/fetch_playlist_recommendations/1")
+    assert fresh.headers["x-cache"] == "miss"
+    assert fresh.headers["etag"] != first.headers["etag"]
+
+async def test_recommendations_are_cached_once_for_all_users(db, client):
+    first = await client.get("/recommendations/1")
+    second = await client.get("/recommendations/2")
+    assert first.headers["x-cache"] == "miss"
+    assert second.headers["x-cache"] == "hit"
+    assert second.headers["etag"] == first.headers["etag"]
+    assert second.json() == first.json()
+
+async def test_invalidate_keeps_entries_of_the_new_model_version():
+    cache = ResponseCache(backend="memory")
+    cache.depends_on("recommendations", "game")
+
+    async def compute():
+        return {"items": []}
+
+    old, new, tables = "1@a", "2@b", "3.4:2@b"
+    for version in (old, new, tables):
+        await cache.get_or_compute("recommendations", 1, version, compute)
+    await cache.get_or_compute("similar", 1, old, compute)
+
+    await cache.invalidate("game", keep_version=new)
+    backend = cache.get_backend()
+    assert await backend.get(cache_key("recommendations", 1, old)) is None
+    assert await backend.get(cache_key("recommendations", 1, new)) is not None
+    assert await backend.get(cache_key("recommendations", 1, tables)) is not None
+    assert await backend.get(cache_key("similar", 1, old)) is not None
+
+async def test_if_none_match_gets_not_modified(db, client):
+    first = await client.get("/recommendations/1")
+    again = await client.get("/recommendations/1", headers={"If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304
+
+async def test_data_keys_agree_across_workers_whatever_their_version_counters(db):
+    now = datetime.utcnow()
+    early, late, other = InteractionStore(refresh_interval=0), InteractionStore(refresh_interval=0), InteractionStore(refresh_interval=0)
+    await early.refresh(db, ["playlist_session"])
+    await other.refresh(db, ["playlist_session"])
+
+    db.add(models.PlaylistSession(session_id=1000, user_id=1, playlist_id=4, completed=True, created_at=now, updated_at=now))
+    await db.commit()
+    await early.refresh(db, ["playlist_session"])
+    await late.refresh(db, ["playlist_session"])
+    assert early.version(["playlist_session"]) == (2,)
+    assert late.version(["playlist_session"]) == (1,)
+    assert early.data_key(["playlist_session"]) == late.data_key(["playlist_session"])
+    assert early.data_key(["playlist_session"], (1,)) != early.data_key(["playlist_session"])
+
+    # Same counter, different data: another worker that saw a different change
+    await db.execute(models.PlaylistSession.__table__.delete().where(models.PlaylistSession.session_id == 1000))
+    db.add(models.PlaylistSession(session_id=1001, user_id=2, playlist_id=4, completed=False, created_at=now, updated_at=now))
+    await db.commit()
+    await other.refresh(db, ["playlist_session"])
+    assert other.version(["playlist_session"]) == early.version(["playlist_session"])
+    assert other.data_key(["playlist_session"]) != early.data_key(["playlist_session"])
+
+async def test_models_fitted_in_this_process_get_process_scoped_versions(db):
+    model = await get_game_model(db)
+    assert model.artifact_version is None
+    assert model_version(model, ["game_session"]).startswith(f"{PROCESS_ID}.")